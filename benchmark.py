@@ -0,0 +1,421 @@
+#!/bin/python3
+
+# Benchmarks of gitz.py, kept out of the script every launch parses.
+#   benchmark.py            Time the requests of every backend on the repository in cwd
+#   benchmark.py --suite    Time the views on synthetic repositories, see runBenchmarkSuite
+#   --trace[=path]          Record a trace like gitz.py
+
+import os
+import sys
+import shutil
+import subprocess
+import time
+import collections
+import json
+
+from gitz import (
+	GLib,
+	Gtk,
+	isGtk3,
+	isGtk4,
+	pygit2,
+	cwdAbs,
+	GitzConfig,
+	GitBackend,
+	Pygit2Backend,
+	MainWindow,
+	PathIndex,
+	displayLine,
+	getCacheDir,
+	getRepoSession,
+	initTracing,
+)
+
+
+#--- Backends
+def benchmarkBackends(commitCount=20):
+	# `benchmark.py` times the startup requests and commit loads of
+	# every available backend on the repository in cwd, without a window.
+	GitzConfig.nativeGraph = True # The log format every backend can read
+	backends = [GitBackend(cwdAbs)]
+	if pygit2 is not None and pygit2.discover_repository(cwdAbs) is not None:
+		backends.append(Pygit2Backend(cwdAbs, pygit2.discover_repository(cwdAbs)))
+
+	loop = GLib.MainLoop()
+	def measure(start):
+		# start(done) begins a request, returns (seconds, result passed to done)
+		results = []
+		def done(*result):
+			results.append(result)
+			loop.quit()
+		t = time.monotonic()
+		start(done)
+		loop.run()
+		return time.monotonic() - t, results[0]
+
+	rows = collections.OrderedDict()
+	def addRow(label, backend, seconds):
+		rows.setdefault(label, {})[backend.name] = seconds
+
+	for backend in backends:
+		startup = 0
+		for label, start in [
+			('refs', lambda done: backend.loadRefSnapshot(['--all'], done)),
+			('files', lambda done: backend.listFiles(lambda paths: None, done)),
+		]:
+			seconds, result = measure(start)
+			addRow(label, backend, seconds)
+			startup += seconds
+
+		logLines = []
+		firstChunk = []
+		def startLog(done):
+			t = time.monotonic()
+			def onLines(lines):
+				if len(firstChunk) == 0:
+					firstChunk.append(time.monotonic() - t)
+				logLines.extend(lines)
+			backend.streamLog([], [], [], onLines, done)
+		seconds, result = measure(startLog)
+		addRow('log first rows', backend, firstChunk[0] if len(firstChunk) > 0 else seconds)
+		addRow('log ({} rows)'.format(len(logLines)), backend, seconds)
+		addRow('startup', backend, startup + (firstChunk[0] if len(firstChunk) > 0 else seconds))
+
+		commitTimes = []
+		for line in logLines[:commitCount]:
+			sha = displayLine(line).split(' ', 1)[0]
+			seconds, result = measure(lambda done: backend.requestCommit(sha, None, done, GitzConfig.lazyPatchBytes))
+			commitTimes.append(seconds)
+		if len(commitTimes) > 0:
+			commitTimes.sort()
+			addRow('commit (median of {})'.format(len(commitTimes)), backend, commitTimes[len(commitTimes) // 2])
+			addRow('commit (max)', backend, commitTimes[-1])
+
+	names = [backend.name for backend in backends]
+	print('{:<24}'.format(cwdAbs[-24:]) + ''.join('{:>12}'.format(name) for name in names))
+	for label, times in rows.items():
+		cells = ['{:>10.1f}ms'.format(times[name] * 1000) if name in times else '{:>12}'.format('-') for name in names]
+		print('{:<24}'.format(label) + ''.join(cells))
+	return 0
+
+
+#--- Benchmark suite
+# `benchmark.py --suite` generates synthetic repositories under the
+# cache dir, times the views on each of them in a child process on a real
+# or virtual display, and compares the results with a stored baseline.
+#   --scale=0.1            Shrink every repository, 1 is the full size
+#   --only=linear,refs     Only run these repositories
+#   --output=results.json  Defaults to <cache dir>/benchmark/results.json
+#   --baseline=base.json   Defaults to <cache dir>/benchmark/baseline.json
+#   --save-baseline        Store the results as the new baseline
+benchmarkVersion = 1 # Bump when a generator changes, the repositories are made again
+
+class FastImportWriter:
+	# Writes a git fast-import stream. Commits and blobs are named by marks.
+	def __init__(self, stream):
+		self.stream = stream
+		self.mark = 0
+		self.time = 1500000000
+
+	def nextMark(self):
+		self.mark += 1
+		return self.mark
+
+	def data(self, content):
+		if isinstance(content, str):
+			content = content.encode('utf-8')
+		self.stream.write(b'data %d\n' % len(content))
+		self.stream.write(content)
+		self.stream.write(b'\n')
+
+	def blob(self, content):
+		mark = self.nextMark()
+		self.stream.write(b'blob\nmark :%d\n' % mark)
+		self.data(content)
+		return mark
+
+	def commit(self, refName, message, parents=(), files=()):
+		# files are (path, content or blob mark)
+		mark = self.nextMark()
+		self.time += 60
+		self.stream.write('commit {}\nmark :{}\n'.format(refName, mark).encode('utf-8'))
+		self.stream.write(b'committer Benchmark <benchmark@example.com> %d +0000\n' % self.time)
+		self.data(message)
+		for i, parent in enumerate(parents):
+			self.stream.write(b'%s :%d\n' % (b'from' if i == 0 else b'merge', parent))
+		for path, content in files:
+			if isinstance(content, int):
+				self.stream.write('M 100644 :{} {}\n'.format(content, path).encode('utf-8'))
+			else:
+				self.stream.write('M 100644 inline {}\n'.format(path).encode('utf-8'))
+				self.data(content)
+		self.stream.write(b'\n')
+		return mark
+
+	def reset(self, refName, mark):
+		self.stream.write('reset {}\nfrom :{}\n\n'.format(refName, mark).encode('utf-8'))
+
+def generateLinearRepo(writer, scale):
+	# Long linear history
+	parent = None
+	for i in range(max(1, int(100000 * scale))):
+		parents = [] if parent is None else [parent]
+		parent = writer.commit('refs/heads/master', 'Commit {}'.format(i), parents, [('file.txt', 'line {}\n'.format(i))])
+
+def generateMergesRepo(writer, scale):
+	# Long-lived lanes merged one at a time keep many lanes of the graph open
+	laneCount = 32
+	master = writer.commit('refs/heads/master', 'Initial commit', [], [('README', 'merges\n')])
+	tips = [master] * laneCount
+	for r in range(max(1, int(20000 * scale) // (laneCount + 1))):
+		for lane in range(laneCount):
+			tips[lane] = writer.commit('refs/heads/lane{}'.format(lane), 'Lane {} change {}'.format(lane, r), [tips[lane]], [('lane{}.txt'.format(lane), 'change {}\n'.format(r))])
+		lane = r % laneCount
+		master = writer.commit('refs/heads/master', 'Merge lane {} round {}'.format(lane, r), [master, tips[lane]])
+
+def generateRefsRepo(writer, scale):
+	# Tens of thousands of branches and tags
+	commits = []
+	parent = None
+	for i in range(max(1, int(2000 * scale))):
+		parents = [] if parent is None else [parent]
+		parent = writer.commit('refs/heads/master', 'Commit {}'.format(i), parents, [('file.txt', 'line {}\n'.format(i))])
+		commits.append(parent)
+	for i in range(max(1, int(30000 * scale))):
+		refName = 'refs/tags/v{}'.format(i) if i % 3 == 0 else 'refs/heads/topic/{}/{}'.format(i % 100, i)
+		writer.reset(refName, commits[i * 7919 % len(commits)])
+	writer.reset('refs/heads/master', commits[-1])
+
+def generateWideCommitRepo(writer, scale):
+	# A commit changing 10k files
+	fileCount = max(1, int(10000 * scale))
+	paths = ['dir{}/file{}.txt'.format(i // 100, i) for i in range(fileCount)]
+	first = writer.commit('refs/heads/master', 'Add files', [], [(path, 'old\n') for path in paths])
+	writer.commit('refs/heads/master', 'Change every file', [first], [(path, 'new\n') for path in paths])
+
+def generateBigPatchRepo(writer, scale):
+	# A commit with a 50 MB patch, half removed lines and half added ones
+	lineCount = max(1, int(50 * 1024 * 1024 * scale) // 2 // 64)
+	first = writer.commit('refs/heads/master', 'Add big file', [], [('big.txt', b''.join(b'%063d\n' % i for i in range(lineCount)))])
+	writer.commit('refs/heads/master', 'Rewrite big file', [first], [('big.txt', b''.join(b'%062dx\n' % i for i in range(lineCount)))])
+
+def generateManyFilesRepo(writer, scale):
+	# A huge ls-files
+	blob = writer.blob('content\n')
+	paths = ['src/d{:03}/s{:02}/file{}.c'.format(i // 1000, i // 50 % 20, i) for i in range(max(1, int(200000 * scale)))]
+	first = writer.commit('refs/heads/master', 'Add many files', [], [(path, blob) for path in paths])
+	writer.commit('refs/heads/master', 'Change one file', [first], [(paths[-1], 'changed\n')])
+
+benchmarkRepos = [
+	# (name, generator, filter, search)
+	('linear', generateLinearRepo, 'Commit 12', 'Commit 9999'),
+	('merges', generateMergesRepo, 'lane 7', 'round 99'),
+	('refs', generateRefsRepo, 'Commit 12', 'topic/42'),
+	('wide-commit', generateWideCommitRepo, 'Change', 'every'),
+	('big-patch', generateBigPatchRepo, 'Rewrite', 'big'),
+	('many-files', generateManyFilesRepo, 'Change', 'one'),
+]
+
+def getBenchmarkRepo(name, generator, scale):
+	# Returns the path of the repository, generated on first use
+	repoPath = os.path.join(getCacheDir(), 'benchmark', '{}-{}'.format(name, scale))
+	stampPath = os.path.join(repoPath, '.git', 'gitz-benchmark')
+	stamp = '{} {}'.format(benchmarkVersion, scale)
+	try:
+		with open(stampPath) as f:
+			if f.read() == stamp:
+				return repoPath
+	except OSError:
+		pass
+
+	print('Generating', repoPath)
+	shutil.rmtree(repoPath, ignore_errors=True)
+	subprocess.run(['git', 'init', '-q', repoPath], check=True)
+	subprocess.run(['git', '-C', repoPath, 'symbolic-ref', 'HEAD', 'refs/heads/master'], check=True)
+	process = subprocess.Popen(['git', '-C', repoPath, 'fast-import', '--quiet'], stdin=subprocess.PIPE)
+	generator(FastImportWriter(process.stdin), scale)
+	process.stdin.close()
+	if process.wait() != 0:
+		raise RuntimeError('git fast-import failed for ' + name)
+	subprocess.run(['git', '-C', repoPath, 'pack-refs', '--all'], check=True)
+	subprocess.run(['git', '-C', repoPath, 'read-tree', 'HEAD'], check=True) # ls-files lists the index
+	with open(stampPath, 'w') as f:
+		f.write(stamp)
+	return repoPath
+
+def getBenchmarkOption(argv, name, default):
+	for arg in argv:
+		if arg.startswith(name + '='):
+			return arg[len(name) + 1:]
+	return default
+
+def runBenchmarkSuite(argv):
+	scale = float(getBenchmarkOption(argv, '--scale', '1'))
+	only = getBenchmarkOption(argv, '--only', '')
+	benchmarkDir = os.path.join(getCacheDir(), 'benchmark')
+	outputPath = getBenchmarkOption(argv, '--output', os.path.join(benchmarkDir, 'results.json'))
+	baselinePath = getBenchmarkOption(argv, '--baseline', os.path.join(benchmarkDir, 'baseline.json'))
+
+	# The views need a display, Xvfb stands in for one when there is none
+	viewsCmd = [sys.executable, os.path.abspath(__file__), '--views']
+	if not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+		if shutil.which('xvfb-run') is None:
+			print('No display, install Xvfb (xvfb-run) to run the benchmark suite headless')
+			return 1
+		viewsCmd = ['xvfb-run', '-a', '-s', '-screen 0 1920x1080x24'] + viewsCmd
+
+	results = {
+		'version': benchmarkVersion,
+		'scale': scale,
+		'git': subprocess.run(['git', '--version'], capture_output=True, text=True).stdout.strip(),
+		'repos': collections.OrderedDict(),
+	}
+	for name, generator, filterText, searchText in benchmarkRepos:
+		if only and name not in only.split(','):
+			continue
+		repoPath = getBenchmarkRepo(name, generator, scale)
+		print('Measuring', name)
+		process = subprocess.run(viewsCmd + [filterText, searchText], cwd=repoPath, capture_output=True, text=True)
+		times = None
+		for line in process.stdout.splitlines():
+			if line.startswith('BENCHMARK '):
+				times = json.loads(line[len('BENCHMARK '):])
+		if times is None:
+			print(process.stdout + process.stderr)
+			return 1
+		results['gtk'] = times.pop('gtk')
+		results['repos'][name] = times
+
+	os.makedirs(os.path.dirname(os.path.abspath(outputPath)), exist_ok=True)
+	with open(outputPath, 'w') as f:
+		json.dump(results, f, indent='\t')
+	print('Wrote', outputPath)
+
+	baseline = None
+	try:
+		with open(baselinePath) as f:
+			baseline = json.load(f)
+	except (OSError, ValueError):
+		pass
+	slower = printBenchmarkResults(results, baseline)
+
+	if '--save-baseline' in argv:
+		shutil.copyfile(outputPath, baselinePath)
+		print('Saved baseline', baselinePath)
+		return 0
+	return 1 if slower > 0 else 0
+
+def printBenchmarkResults(results, baseline, tolerance=1.25):
+	# Returns the number of measurements slower than the baseline by more than tolerance
+	if baseline is not None and baseline.get('scale') != results['scale']:
+		print('Baseline is at scale {}, not comparing'.format(baseline.get('scale')))
+		baseline = None
+	slower = 0
+	print('{:<36}{:>12}{:>12}'.format('', 'baseline', 'now'))
+	for name, times in results['repos'].items():
+		baseTimes = baseline['repos'].get(name, {}) if baseline is not None else {}
+		for label, seconds in times.items():
+			row = '{:<36}'.format(name + ' ' + label)
+			if label in baseTimes:
+				row += '{:>10.1f}ms'.format(baseTimes[label] * 1000)
+			else:
+				row += '{:>12}'.format('-')
+			row += '{:>10.1f}ms'.format(seconds * 1000)
+			# Sub-millisecond changes are noise
+			if label in baseTimes and seconds > baseTimes[label] * tolerance and seconds - baseTimes[label] > 0.001:
+				row += '  slower x{:.2f}'.format(seconds / max(baseTimes[label], 1e-6))
+				slower += 1
+			print(row)
+	return slower
+
+def benchmarkViews(filterText, searchText):
+	# Runs in a repository of the suite. Opens the main window and prints
+	# one BENCHMARK line of JSON with the seconds each step took.
+	GitzConfig.historyCache = False # Always populate from git log
+	GitzConfig.loadCommitDelay = 0
+	GitzConfig.prefetchCommits = 0
+	context = GLib.MainContext.default()
+	def waitFor(isDone, timeout=600):
+		deadline = time.monotonic() + timeout
+		while not isDone():
+			if time.monotonic() > deadline:
+				raise TimeoutError()
+			context.iteration(True)
+	def settle():
+		while context.pending():
+			context.iteration(False)
+
+	times = collections.OrderedDict()
+	def measure(label, start, isDone=lambda: True):
+		settle()
+		t = time.monotonic()
+		start()
+		waitFor(isDone)
+		times[label] = time.monotonic() - t
+
+	win = MainWindow(None, getRepoSession(cwdAbs))
+	if isGtk3:
+		win.show_all()
+	elif isGtk4:
+		win.present()
+	historyView = win.historyView
+	commitView = win.commitView
+	# Commits are loaded by the selectSha steps, not by moving the selection
+	if GitzConfig.historyWidget == 'list':
+		historyView.onShaSelected = None
+	else:
+		historyView.get_buffer().disconnect_by_func(win.onHistoryViewMoveCursor)
+
+	measure('refs', lambda: win.session.backend.loadRefSnapshot(['--all'], lambda refIndex: times.setdefault('refIndex', refIndex)), lambda: 'refIndex' in times)
+	refIndex = times.pop('refIndex')
+	measure('branch search', lambda: refIndex.searchBranches('4', GitzConfig.filterCompletions))
+	pathIndex = PathIndex()
+	measure('ls-files', lambda: win.session.backend.listFiles(pathIndex.append, lambda: times.setdefault('filesDone', True)), lambda: 'filesDone' in times)
+	times.pop('filesDone')
+	measure('file search', lambda: pathIndex.search('file1', GitzConfig.filterCompletions))
+
+	settle()
+	t = time.monotonic()
+	historyView.populate()
+	waitFor(lambda: historyView.getRowCount() > 0)
+	times['populate first rows'] = time.monotonic() - t
+	waitFor(lambda: historyView.logDone and historyView.refIndex is not None)
+	times['populate'] = time.monotonic() - t
+
+	historyView.selectRow(historyView.getRowCount() // 2)
+	measure('history formatVisible', historyView.formatVisible)
+	def formatView(view):
+		view.resetFormatted()
+		view.formatVisible()
+	measure('history formatView', lambda: formatView(historyView), lambda: historyView.formatIdleTimer == 0)
+
+	measure('filter', lambda: historyView.applyFilter(filterText))
+	measure('filter clear', lambda: historyView.applyFilter(''))
+	measure('search', lambda: historyView.applySearch(searchText), lambda: historyView.textSearch is not None and not historyView.searchRunning)
+	historyView.applySearch('')
+
+	shown = []
+	commitView.onCommitShown = shown.append
+	shas = historyView.findShas(range(historyView.getRowCount()), 11)
+	for i, sha in enumerate(shas):
+		# The first is the newest, the large commit of wide-commit and big-patch
+		measure('selectSha' if i == 0 else 'selectSha {}'.format(i), lambda: commitView.selectSha(sha), lambda: len(shown) > i)
+		if i == 0:
+			measure('commit formatView', lambda: formatView(commitView), lambda: commitView.formatIdleTimer == 0)
+	others = sorted(times.pop('selectSha {}'.format(i)) for i in range(1, len(shas)))
+	if len(others) > 0:
+		times['selectSha (median)'] = others[len(others) // 2]
+
+	times['gtk'] = '{}.{}'.format(Gtk.get_major_version(), Gtk.get_minor_version())
+	print('BENCHMARK ' + json.dumps(times))
+	return 0
+
+
+if __name__ == '__main__':
+	argv = initTracing(sys.argv)
+	if '--suite' in argv:
+		sys.exit(runBenchmarkSuite(argv))
+	if '--views' in argv:
+		args = argv[argv.index('--views') + 1:]
+		sys.exit(benchmarkViews(*args[:2]))
+	sys.exit(benchmarkBackends())
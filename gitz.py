@@ -3,25 +3,134 @@
 import os
 import sys
 import signal
+import atexit
 import subprocess
 import re
 import time
+import math
+import collections
+import hashlib
+import json
+import threading
+import bisect
+import array
+import heapq
+import mmap
 
 import gi
+from gi.repository import Gio, GLib
+
+cwd = os.getcwd()
+cwdAbs = os.path.abspath(os.path.expanduser(cwd))
+
+#--- Resident
+# `gitz --resident` (or GITZ_RESIDENT=1) keeps running after its last
+# window closes. Later resident launches hand their paths and cwd to it
+# through Gio.Application's Open method and exit before pygit2 or Gtk are
+# imported, the running App opens their window from its RepoSessions.
+residentAppId = 'com.github.zren.gitz'
+
+def isResidentLaunch(argv):
+	return '--resident' in argv or os.environ.get('GITZ_RESIDENT') in ('1', 'true')
+
+def forwardLaunch(argv):
+	# Returns False when there is no resident instance to open the window
+	paths = [arg for arg in argv[1:] if not arg.startswith('-')]
+	uris = [Gio.File.new_for_commandline_arg(path).get_uri() for path in paths]
+	if len(uris) == 0:
+		uris = [Gio.File.new_for_path(cwdAbs).get_uri()]
+	hint = json.dumps({'cwd': cwdAbs, 'dirPath': len(paths) > 0}) # See App.do_open
+	platformData = {}
+	if os.environ.get('DESKTOP_STARTUP_ID'):
+		platformData['desktop-startup-id'] = GLib.Variant('s', os.environ['DESKTOP_STARTUP_ID'])
+	if os.environ.get('XDG_ACTIVATION_TOKEN'):
+		platformData['activation-token'] = GLib.Variant('s', os.environ['XDG_ACTIVATION_TOKEN'])
+	try:
+		bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+		hasOwner = bus.call_sync(
+			'org.freedesktop.DBus',
+			'/org/freedesktop/DBus',
+			'org.freedesktop.DBus',
+			'NameHasOwner',
+			GLib.Variant('(s)', (residentAppId,)),
+			GLib.VariantType('(b)'),
+			Gio.DBusCallFlags.NONE,
+			-1,
+			None,
+		).unpack()[0]
+		if not hasOwner:
+			return False
+		bus.call_sync(
+			residentAppId,
+			'/' + residentAppId.replace('.', '/'),
+			'org.gtk.Application',
+			'Open',
+			GLib.Variant('(assa{sv})', (uris, hint, platformData)),
+			None,
+			Gio.DBusCallFlags.NONE,
+			-1,
+			None,
+		)
+	except GLib.Error as e:
+		print('forwardLaunch', e)
+		return False # Start a new instance instead
+	return True
+
+if __name__ == '__main__' and isResidentLaunch(sys.argv) and forwardLaunch(sys.argv):
+	sys.exit(0)
+
+try:
+	import pygit2
+except ImportError:
+	pygit2 = None
+
 try:
 	gi.require_version('Gtk', '3.0')
 except:
 	gi.require_version('Gtk', '4.0')
-from gi.repository import Gtk, Gdk, Gio, GLib, Pango
+from gi.repository import Gtk, Gdk, GObject, Pango
 
 isGtk3 = Gtk.get_major_version() == 3
 isGtk4 = Gtk.get_major_version() == 4
 
-cwd = os.getcwd()
-cwdAbs = os.path.abspath(os.path.expanduser(cwd))
-
 class GitzConfig:
 	hideKdeSilentCommits = False
+	streamHistory = True # Append git log output as it arrives instead of waiting for the process to exit
+	streamChunkSize = 64 * 1024
+	historyPageCommits = 0 # Commits streamed before git log is paused until the history is scrolled, searched or filtered further. 0 loads everything
+	historyPageFilterRows = 200 # While filtering, pages are loaded until this many rows match
+	historyWidget = 'text' # 'list' uses the virtualized HistoryListView
+	loadCommitDelay = 50 # ms to wait for the history selection to settle before running git show
+	commitCacheEntries = 256
+	commitCacheBytes = 64 * 1024 * 1024
+	fullShaCacheEntries = 4096 # Abbreviated shas resolved for git diff-tree, for every repo
+	prefetchCommits = 3 # Commits to preload before and after the selected one
+	historyCache = True # Keep the git log of each repo and filter under XDG_CACHE_HOME
+	historyCacheOverlap = 64 # Commits compared against the cache before splicing new commits on top
+	historyCacheFiles = 16 # Logs kept per repo, the least recently used are deleted
+	historyCacheBytes = 256 * 1024 * 1024 # Per repo
+	nativeGraph = False # Lay out the history graph from commit parents and draw it in a gutter instead of git log --graph
+	graphLaneWidth = 12
+	graphMaxLanes = 32 # Lanes beyond this are clipped
+	searchThreadChars = 1024 * 1024 # Search larger texts in a background thread
+	formatBudget = 0.004 # Seconds of line formatting per main loop iteration
+	formatPrefetchLines = 200 # Lines above and below the viewport formatted ahead of scrolling
+	lazyPatchBytes = 4 * 1024 * 1024 # Larger commits show the diffstat first and load each file's patch once it scrolls into view
+	lazyPatchCollapseLines = 5000 # Files changing more lines stay collapsed until their line is clicked
+	gitMaxProcesses = 4 # git commands and busy git workers running at once
+	gitMaxWorkers = 4 # Long-lived git processes (cat-file, diff-tree) kept around
+	backend = 'git' # 'pygit2' reads the repository in-process when pygit2 is installed
+	filterCompletions = 50 # Completions offered while typing in the branch and file filters
+	stallThreshold = 100 # ms a main loop iteration may take before GITZ_TRACE reports it
+	autoRefresh = True # Update the history when a commit, checkout or fetch changes the refs
+	refreshDelay = 300 # ms the refs have to stay unchanged before the history is updated
+	residentRepos = 8 # Repos whose history, refs and commits a --resident process keeps loaded
+	commitGraph = 'suggest' # When path filtered history lacks a commit-graph with changed-path Bloom filters: 'suggest' writing one in the window, 'write' it in the background or 'off'
+	commitGraphStaleCommits = 1000 # Commits missing from the commit-graph before it is written again
+	pathCommitIndex = True # Switch the file filter with an index of the commits that touched each path instead of git log -- path. Only with nativeGraph, --graph rows can't be masked
+	followRenames = True # A file filtered from the index also lists the commits of the file's earlier names
+	blameCacheEntries = 32 # Blames of a file at a revision kept for the repo
+	blameMaxRanges = 100 # A parent blame with more unknown line ranges than this blames the whole file
 
 class SearchBar(Gtk.SearchBar):
 	def add(self, child):
@@ -58,6 +167,20 @@ class HPaned(Gtk.Paned):
 		elif isGtk4:
 			self.set_end_child(child)
 
+class VPaned(Gtk.Paned):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, orientation=Gtk.Orientation.VERTICAL, **kwargs)
+	def add1(self, child):
+		if isGtk3:
+			super().add1(child)
+		elif isGtk4:
+			self.set_start_child(child)
+	def add2(self, child):
+		if isGtk3:
+			super().add2(child)
+		elif isGtk4:
+			self.set_end_child(child)
+
 class GtkIcon:
 	@staticmethod
 	def new_from_icon_name(icon_name):
@@ -67,7 +190,17 @@ class GtkIcon:
 		elif isGtk4:
 			return Gtk.Image.new_from_icon_name(icon_name)
 		else:
-			raise NotImplemented()
+			raise NotImplementedError()
+
+class GtkButton:
+	@staticmethod
+	def new_from_icon_name(icon_name):
+		if isGtk3:
+			return Gtk.Button.new_from_icon_name(icon_name, Gtk.IconSize.BUTTON)
+		elif isGtk4:
+			return Gtk.Button.new_from_icon_name(icon_name)
+		else:
+			raise NotImplementedError()
 
 class GtkBox(Gtk.Box):
 	def __init__(self, *args, **kwargs):
@@ -97,6 +230,9 @@ class VBox(GtkBox):
 			**kwargs
 		)
 
+# Virtualized list widget for HistoryListView
+GtkListWidget = Gtk.TreeView if isGtk3 else Gtk.ListView
+
 def GtkTextBuffer_parseTextIter(obj):
 	if isinstance(obj, Gtk.TextIter):
 		return obj
@@ -104,7 +240,7 @@ def GtkTextBuffer_parseTextIter(obj):
 		result, textIter = obj
 		if isinstance(textIter, Gtk.TextIter):
 			return textIter
-	raise NotImplemented()
+	raise NotImplementedError()
 
 def GtkTextBuffer_get_iter_at_line(buf, line_number):
 	line_iter = buf.get_iter_at_line(line_number)
@@ -116,26 +252,23 @@ def GtkTextBuffer_get_iter_at_line_offset(buf, line_number, char_offset):
 
 
 
-LOG_PATTERN = re.compile(r'^([ \*\|\\\/]+)((\w{6,}) (\([^)]+\) )?(.+))?$', re.MULTILINE)
-OLDLINE_PATTERN = re.compile(r'^\-.*$', re.MULTILINE)
-NEWLINE_PATTERN = re.compile(r'^\+.*$', re.MULTILINE)
-HUNKHEADER_PATTERN = re.compile(r'^@@.+$', re.MULTILINE)
-COMMITHEADER_PATTERN = re.compile(r'^(commit ((.|\n)+?))(\n(---\n)((.|\n)+?))?(\ndiff|$)')
+LOG_PATTERN = re.compile(r'^([ \*\|\\\/]*)((\w{6,}) (\([^)]+\) )?(.+))?$', re.MULTILINE)
 STATFILE_PATTERN = re.compile(r' (.+?)\s+\|\s+(\d+) (\+*)(\-*)')
-DIFF_PATTERN = re.compile(r'\n(diff ((.|\n)+?))\n(\-\-\-|\+\+\+)')
+STATSUMMARY_PATTERN = re.compile(r' \d+ files? changed')
+HEADREF_PATTERN = re.compile(r'(\(|, )(HEAD)( -> (.+?))?(,|\))')
+TAGREF_PATTERN = re.compile(r'(\(|, )(tag: .+?)(,|\))')
+REF_PATTERN = re.compile(r'(\(|, )((HEAD -> )?([^,\)]+))')
 
 #---
 def log(*args):
-	# print(*args) # Comment to hide debug log
-	return
+	# Printed while tracing, see Tracer
+	if tracer.enabled:
+		print(*args)
 
-def applyTagForGroup(buf, match, group, tag, searchOffset=0):
-	start = searchOffset + match.start(group)
-	end = searchOffset + match.end(group)
-	# print(match, start, end)
-	startIter = buf.get_iter_at_offset(start)
-	endIter = buf.get_iter_at_offset(end)
-	buf.apply_tag(tag, startIter, endIter)
+def displayLine(line):
+	# Native graph rows are "sha parents...\0text", only the text is shown
+	end = line.find('\x00')
+	return line if end == -1 else line[end+1:]
 
 def rgba(hexstr):
 	c = Gdk.RGBA()
@@ -148,9 +281,3344 @@ def lerpColor(c1, c2, x):
 	blue = c1.blue + (c2.blue - c1.blue) * x
 	return Gdk.RGBA(red, green, blue)
 
+def isCancelledError(err):
+	return err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED)
+
+#--- Tracing
+class TraceSpan:
+	# A span of the Tracer. Used as a context manager around work on
+	# the current thread, or ended later with end() for async work
+	# like a git process.
+	def __init__(self, tracer, name, category, args, isAsync):
+		self.tracer = tracer
+		self.name = name
+		self.category = category
+		self.args = args
+		self.isAsync = isAsync
+		self.start = time.monotonic()
+		self.tid = threading.get_ident()
+
+	def __enter__(self):
+		self.start = time.monotonic()
+		if self.tid == self.tracer.mainThread:
+			self.tracer.stack.append(self)
+		return self
+
+	def __exit__(self, *exc):
+		if self.tid == self.tracer.mainThread and self.tracer.stack and self.tracer.stack[-1] is self:
+			self.tracer.stack.pop()
+		self.end()
+		return False
+
+	def set(self, **args):
+		self.args.update(args)
+
+	def end(self, **args):
+		self.args.update(args)
+		self.tracer.addSpan(self, time.monotonic())
+
+class NullSpan:
+	# Returned while tracing is off
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+	def set(self, **args):
+		pass
+
+	def end(self, **args):
+		pass
+
+class Tracer:
+	# GITZ_TRACE=trace.json or --trace=trace.json records spans of git
+	# processes, buffer updates, tag passes, filters, searches and caches
+	# as Chrome trace events, for chrome://tracing or ui.perfetto.dev.
+	# A watchdog thread reports main loop iterations longer than
+	# GitzConfig.stallThreshold together with the span they were stuck in.
+	nullSpan = NullSpan()
+
+	def __init__(self):
+		self.enabled = False
+		self.path = None
+		self.events = []
+		self.stack = [] # Spans open on the main thread
+		self.nextId = 0
+		self.startTime = time.monotonic()
+		self.mainThread = threading.get_ident()
+		self.lastBeat = 0
+		self.stallSample = None
+
+	def enable(self, path):
+		self.enabled = True
+		self.path = path
+		self.events.append({'ph': 'M', 'name': 'process_name', 'pid': os.getpid(), 'args': {'name': 'gitz'}})
+		self.events.append({'ph': 'M', 'name': 'thread_name', 'pid': os.getpid(), 'tid': self.mainThread, 'args': {'name': 'main loop'}})
+		atexit.register(self.save)
+		self.startWatchdog()
+
+	def getTimestamp(self, t):
+		return int((t - self.startTime) * 1000000) # Microseconds
+
+	def span(self, name, category, **args):
+		# with tracer.span('set_text', 'view', chars=len(text)):
+		if not self.enabled:
+			return self.nullSpan
+		return TraceSpan(self, name, category, args, False)
+
+	def begin(self, name, category, **args):
+		# Async work that overlaps other spans, call end() on the result
+		if not self.enabled:
+			return self.nullSpan
+		return TraceSpan(self, name, category, args, True)
+
+	def instant(self, name, category, **args):
+		if self.enabled:
+			self.events.append({'ph': 'i', 's': 't', 'name': name, 'cat': category, 'ts': self.getTimestamp(time.monotonic()), 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+	def complete(self, name, category, start, end, args):
+		if self.enabled:
+			self.events.append({'ph': 'X', 'name': name, 'cat': category, 'ts': self.getTimestamp(start), 'dur': self.getTimestamp(end) - self.getTimestamp(start), 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+	def addSpan(self, span, end):
+		event = {'name': span.name, 'cat': span.category, 'pid': os.getpid(), 'tid': span.tid, 'args': span.args}
+		if span.isAsync:
+			self.nextId += 1
+			begin = dict(event, ph='b', id=self.nextId, ts=self.getTimestamp(span.start))
+			self.events.append(begin)
+			self.events.append(dict(event, ph='e', id=self.nextId, ts=self.getTimestamp(end), args={}))
+		else:
+			self.events.append(dict(event, ph='X', ts=self.getTimestamp(span.start), dur=self.getTimestamp(end) - self.getTimestamp(span.start)))
+
+	def save(self):
+		try:
+			os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+			with open(self.path, 'w') as f:
+				json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+			print('gitz: trace written to', self.path)
+		except OSError as e:
+			print('Tracer.save', e)
+
+	#--- Watchdog
+	# A high priority heartbeat on the main loop. When it stops beating
+	# the watchdog thread samples what the main thread is doing, the
+	# stall is reported once the loop beats again.
+	def startWatchdog(self):
+		self.lastBeat = time.monotonic()
+		GLib.timeout_add(GitzConfig.stallThreshold // 4, self.onBeat, priority=GLib.PRIORITY_HIGH)
+		threading.Thread(target=self.watch, daemon=True).start()
+
+	def onBeat(self):
+		now = time.monotonic()
+		interval = GitzConfig.stallThreshold / 4 / 1000
+		if now - self.lastBeat - interval > GitzConfig.stallThreshold / 1000:
+			spans, frames = self.stallSample if self.stallSample is not None else ([], [])
+			start = self.lastBeat + interval
+			self.complete('stall', 'watchdog', start, now, {'spans': spans, 'frames': frames})
+			print('gitz: main loop stalled {:.0f}ms in {} at {}'.format(
+				(now - start) * 1000,
+				' > '.join(spans) or '(no span)',
+				frames[0] if frames else '?',
+			))
+		self.stallSample = None
+		self.lastBeat = now
+		return True
+
+	def watch(self):
+		threshold = GitzConfig.stallThreshold / 1000
+		while True:
+			time.sleep(threshold / 2)
+			beat = self.lastBeat
+			if self.stallSample is None and time.monotonic() - beat > threshold:
+				self.stallSample = self.sampleMainThread()
+
+	def sampleMainThread(self):
+		# Names of the open spans and the innermost frames of the main thread
+		spans = [span.name for span in list(self.stack)]
+		frames = []
+		frame = sys._current_frames().get(self.mainThread)
+		while frame is not None and len(frames) < 5:
+			frames.append('{}:{} {}'.format(os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name))
+			frame = frame.f_back
+		return (spans, frames)
+
+tracer = Tracer()
+
+def getTraceName(cmd):
+	# 'git log' for ['git', '-C', path, 'log', ...]
+	if len(cmd) >= 4 and cmd[1] == '-C':
+		return cmd[0] + ' ' + cmd[3]
+	return ' '.join(cmd[:2])
+
+def initTracing(argv):
+	# Returns argv without --trace, which Gtk.Application would reject
+	path = os.environ.get('GITZ_TRACE')
+	args = []
+	for arg in argv:
+		if arg == '--trace':
+			path = '1'
+		elif arg.startswith('--trace='):
+			path = arg[len('--trace='):]
+		else:
+			args.append(arg)
+	if path in ('1', 'true'):
+		path = os.path.join(getCacheDir(), 'trace', 'gitz-{}.json'.format(os.getpid()))
+	if path:
+		tracer.enable(path)
+	return args
+
+class StepTimer:
+	# timeit() starts timing, timeit(label, *args) records the step since
+	# the previous call as a trace span and logs it.
+	def timeit(self, label=None, *args):
+		t = time.monotonic()
+		if label:
+			start = getattr(self, 't', t)
+			tracer.complete('{} {}'.format(self.__class__.__name__, label), 'timeit', start, t, {'args': [str(arg) for arg in args]})
+			log("{} {}: {:.4f}s".format(self.__class__.__name__, label, t - start), *args)
+		else:
+			log()
+		self.t = t
+
 
 #---
-class MonospaceView(Gtk.TextView):
+class GitStream:
+	# Reads a command's stdout on the main loop without blocking it.
+	# onLines(lines) is called with every batch of complete lines,
+	# onDone() once the process closed stdout. Lines end with separator.
+	def __init__(self, cmd, onLines, onDone=None, separator='\n'):
+		self.cmd = cmd
+		self.onLines = onLines
+		self.onDone = onDone
+		self.separator = separator
+		self.process = None
+		self.stdout = None
+		self.cancellable = None
+		self.partial = b''
+		self.running = False
+		self.reading = False
+		self.paused = False
+		self.bytesRead = 0
+		self.traceSpan = None
+
+	def start(self):
+		self.cancellable = Gio.Cancellable()
+		self.traceSpan = tracer.begin(getTraceName(self.cmd), 'git', argv=self.cmd)
+		self.process = Gio.Subprocess.new(self.cmd, Gio.SubprocessFlags.STDOUT_PIPE)
+		self.stdout = self.process.get_stdout_pipe()
+		self.running = True
+		self.readNext()
+
+	def readNext(self):
+		self.reading = True
+		self.stdout.read_bytes_async(GitzConfig.streamChunkSize, GLib.PRIORITY_DEFAULT, self.cancellable, self.onRead)
+
+	def onRead(self, stream, result, data=None):
+		self.reading = False
+		try:
+			chunk = stream.read_bytes_finish(result).get_data()
+		except GLib.Error as err:
+			if isCancelledError(err):
+				return
+			raise
+		if not self.running:
+			return
+
+		if not chunk: # EOF
+			self.running = False
+			self.traceSpan.end(bytes=self.bytesRead)
+			if self.partial:
+				self.onLines([self.partial.decode('utf-8', 'replace')])
+				self.partial = b''
+			if self.onDone is not None:
+				self.onDone()
+			return
+
+		self.bytesRead += len(chunk)
+		chunk = self.partial + chunk
+		end = chunk.rfind(self.separator.encode())
+		if end == -1:
+			self.partial = chunk
+		else:
+			self.partial = chunk[end+1:]
+			self.onLines(chunk[:end].decode('utf-8', 'replace').split(self.separator))
+		if self.running and not self.paused and not self.reading: # onLines may have resumed
+			self.readNext()
+
+	def pause(self):
+		# Stops reading after the current chunk, the process blocks once the pipe is full
+		self.paused = True
+
+	def resume(self):
+		if not self.paused:
+			return
+		self.paused = False
+		if self.running and not self.reading:
+			self.readNext()
+
+	def cancel(self):
+		if not self.running:
+			return
+		self.running = False
+		self.traceSpan.end(bytes=self.bytesRead, cancelled=True)
+		self.cancellable.cancel()
+		self.process.force_exit()
+
+
+class GitCommand:
+	# Runs a command without blocking the main loop and hands its
+	# whole stdout to onDone(stdout).
+	def __init__(self, cmd, onDone, stdin=None):
+		self.cmd = cmd
+		self.onDone = onDone
+		self.stdin = stdin
+		self.process = None
+		self.cancellable = None
+		self.running = False
+		self.traceSpan = None
+
+	def start(self):
+		self.cancellable = Gio.Cancellable()
+		self.traceSpan = tracer.begin(getTraceName(self.cmd), 'git', argv=self.cmd)
+		flags = Gio.SubprocessFlags.STDOUT_PIPE
+		stdinBytes = None
+		if self.stdin is not None:
+			flags |= Gio.SubprocessFlags.STDIN_PIPE
+			stdinBytes = GLib.Bytes.new(self.stdin.encode('utf-8'))
+		self.process = Gio.Subprocess.new(self.cmd, flags)
+		self.running = True
+		self.process.communicate_async(stdinBytes, self.cancellable, self.onCommunicate)
+
+	def onCommunicate(self, process, result, data=None):
+		try:
+			ok, stdout, stderr = process.communicate_finish(result)
+		except GLib.Error as err:
+			if isCancelledError(err):
+				return
+			raise
+		if not self.running:
+			return
+		self.running = False
+		stdout = stdout.get_data() if stdout is not None else b''
+		self.traceSpan.end(bytes=len(stdout))
+		self.onDone(stdout.decode('utf-8', 'replace'))
+
+	def cancel(self):
+		if not self.running:
+			return
+		self.running = False
+		self.traceSpan.end(cancelled=True)
+		self.cancellable.cancel()
+		self.process.force_exit()
+
+
+class GitWorker:
+	# A long-lived git process answering requests written to its stdin,
+	# like `git cat-file --batch-check` or `git diff-tree --stdin`. The
+	# index, packs and config are only read once. cat-file answers each
+	# line with one line. diff-tree echoes lines that are not a sha, so
+	# every request is followed by a marker that ends its output.
+	def __init__(self, cmd, echoMarker):
+		self.cmd = cmd
+		self.echoMarker = echoMarker
+		self.marker = 'gitz:end:{}'.format(os.urandom(8).hex()).encode('utf-8') + b'\n'
+		self.process = None
+		self.stdin = None
+		self.stdout = None
+		self.cancellable = None
+		self.alive = False
+		self.busy = False
+		self.data = bytearray()
+		self.maxBytes = None
+		self.onDone = None
+		self.traceSpan = None
+
+	def start(self):
+		self.cancellable = Gio.Cancellable()
+		flags = Gio.SubprocessFlags.STDIN_PIPE | Gio.SubprocessFlags.STDOUT_PIPE
+		self.process = Gio.Subprocess.new(self.cmd, flags)
+		self.stdin = self.process.get_stdin_pipe()
+		self.stdout = self.process.get_stdout_pipe()
+		self.alive = True
+		self.process.wait_async(None, self.onExit)
+
+	def onExit(self, process, result, data=None):
+		# An idle worker that exited is started again by the next request
+		self.alive = False
+
+	def send(self, line, maxBytes, onDone):
+		# onDone(stdout, error) where error is None, 'overflow' when the
+		# output grew past maxBytes, or 'died' when git exited.
+		self.busy = True
+		self.data = bytearray()
+		self.maxBytes = maxBytes
+		self.onDone = onDone
+		self.traceSpan = tracer.begin(getTraceName(self.cmd) + ' request', 'git', argv=self.cmd, line=line)
+		request = line + '\n'
+		if self.echoMarker:
+			request += self.marker.decode('utf-8')
+		try:
+			self.stdin.write_all(request.encode('utf-8'), self.cancellable)
+			self.stdin.flush(self.cancellable)
+		except GLib.Error:
+			GLib.idle_add(self.finish, None, 'died') # Not from within GitPool.schedule
+			return
+		self.readNext()
+
+	def readNext(self):
+		self.stdout.read_bytes_async(GitzConfig.streamChunkSize, GLib.PRIORITY_DEFAULT, self.cancellable, self.onRead)
+
+	def onRead(self, stream, result, data=None):
+		try:
+			chunk = stream.read_bytes_finish(result).get_data()
+		except GLib.Error as err:
+			if isCancelledError(err):
+				return
+			self.finish(None, 'died')
+			return
+		if not chunk: # EOF
+			self.finish(None, 'died')
+			return
+
+		searchFrom = max(0, len(self.data) - len(self.marker))
+		self.data += chunk
+		terminator = self.marker if self.echoMarker else b'\n'
+		end = self.data.find(terminator, searchFrom)
+		if end != -1:
+			stdout = self.data[:end + (0 if self.echoMarker else 1)]
+			self.data = bytearray()
+			self.finish(stdout.decode('utf-8', 'replace'), None)
+		elif self.maxBytes is not None and len(self.data) > self.maxBytes:
+			# Draining the rest could take long, start over with a new process
+			self.finish(None, 'overflow')
+		else:
+			self.readNext()
+
+	def finish(self, stdout, error):
+		if self.onDone is None:
+			return False # Aborted
+		self.traceSpan.end(bytes=len(stdout) if stdout is not None else len(self.data), error=error)
+		if error is not None:
+			self.close()
+		self.busy = False
+		onDone = self.onDone
+		self.onDone = None
+		onDone(stdout, error)
+		return False # Cancel idle_add
+
+	def abort(self):
+		# Drops the answer being read. git may still be writing it, so the
+		# process is killed and the next request starts a new one.
+		if self.busy:
+			self.traceSpan.end(bytes=len(self.data), cancelled=True)
+			self.busy = False
+			self.onDone = None
+		self.close()
+
+	def close(self):
+		if not self.alive:
+			return
+		self.alive = False
+		self.cancellable.cancel()
+		self.process.force_exit()
+
+
+class GitRequest:
+	# A git command or worker request queued in a GitPool
+	def __init__(self, pool, cmd, onDone):
+		self.pool = pool
+		self.cmd = cmd
+		self.onDone = onDone
+		self.stdin = None # GitCommand stdin
+		self.line = None # GitWorker request
+		self.echoMarker = True
+		self.maxBytes = None
+		self.process = None
+		self.retried = False
+		self.cancelled = False
+
+	def isWorkerRequest(self):
+		return self.line is not None
+
+	def cancel(self):
+		if self.cancelled:
+			return
+		self.cancelled = True
+		self.pool.cancel(self)
+
+
+class GitPool:
+	# Runs git for every view. At most maxProcesses commands and busy
+	# workers run at once, other requests wait in order. Workers are kept
+	# per command line and started again when their process died.
+	def __init__(self, maxProcesses, maxWorkers):
+		self.maxProcesses = maxProcesses
+		self.maxWorkers = maxWorkers
+		self.queue = []
+		self.running = 0
+		self.workers = []
+
+	def run(self, cmd, onDone, stdin=None):
+		# Runs a one-off command, onDone(stdout) like GitCommand
+		request = GitRequest(self, cmd, onDone)
+		request.stdin = stdin
+		return self.enqueue(request)
+
+	def request(self, cmd, line, onDone, echoMarker=True, maxBytes=None):
+		# Sends line to a worker running cmd, onDone(stdout, error) gets its
+		# answer. stdout is None when error is 'overflow', because it grew
+		# past maxBytes, or 'died', because the worker died twice.
+		request = GitRequest(self, cmd, onDone)
+		request.line = line
+		request.echoMarker = echoMarker
+		request.maxBytes = maxBytes
+		return self.enqueue(request)
+
+	def enqueue(self, request):
+		self.queue.append(request)
+		self.schedule()
+		return request
+
+	def cancel(self, request):
+		if request in self.queue:
+			self.queue.remove(request)
+		elif request.process is not None:
+			if request.isWorkerRequest():
+				request.process.abort() # Instead of letting git finish an answer nobody reads
+			else:
+				request.process.cancel()
+			self.onProcessDone(request)
+
+	def schedule(self):
+		i = 0
+		while i < len(self.queue) and self.running < self.maxProcesses:
+			request = self.queue[i]
+			if request.isWorkerRequest():
+				worker = self.getIdleWorker(request.cmd, request.echoMarker)
+				if worker is None:
+					i += 1 # Every worker is busy, let one-off commands through
+					continue
+				del self.queue[i]
+				self.startWorkerRequest(request, worker)
+			else:
+				del self.queue[i]
+				self.startCommand(request)
+
+	def startCommand(self, request):
+		def onDone(stdout):
+			self.onProcessDone(request)
+			request.onDone(stdout)
+		self.running += 1
+		request.process = GitCommand(request.cmd, onDone, stdin=request.stdin)
+		request.process.start()
+
+	def onProcessDone(self, request):
+		request.process = None
+		self.running -= 1
+		self.schedule()
+
+	def startWorkerRequest(self, request, worker):
+		def onDone(stdout, error):
+			self.onProcessDone(request)
+			if error == 'died' and not request.retried and not request.cancelled:
+				request.retried = True
+				self.enqueue(request)
+			elif not request.cancelled:
+				request.onDone(stdout, error)
+		self.running += 1
+		request.process = worker
+		worker.send(request.line, request.maxBytes, onDone)
+
+	def getIdleWorker(self, cmd, echoMarker):
+		self.workers = [worker for worker in self.workers if worker.alive]
+		for worker in self.workers:
+			if worker.cmd == cmd and not worker.busy:
+				self.workers.remove(worker)
+				self.workers.append(worker) # Least recently used first
+				return worker
+		if len(self.workers) >= self.maxWorkers:
+			# Replace an idle worker of another command
+			idleWorkers = [worker for worker in self.workers if not worker.busy]
+			if len(idleWorkers) == 0:
+				return None
+			idleWorkers[0].close()
+			self.workers.remove(idleWorkers[0])
+		worker = GitWorker(cmd, echoMarker)
+		worker.start()
+		self.workers.append(worker)
+		return worker
+
+gitPool = GitPool(GitzConfig.gitMaxProcesses, GitzConfig.gitMaxWorkers)
+
+
+class DiffTreeRequest:
+	# Sends a commit to a `git diff-tree --stdin` worker. diff-tree only
+	# reads full shas, so abbreviated ones are resolved by a cat-file worker
+	# first. onDone(stdout, error) like GitPool.request.
+	fullShas = collections.OrderedDict() # (cwdAbs, sha): fullSha, least recently used first
+
+	def __init__(self, cwdAbs, sha, cmd, onDone, maxBytes=None):
+		self.cwdAbs = cwdAbs
+		self.sha = sha
+		self.cmd = cmd
+		self.onDone = onDone
+		self.maxBytes = maxBytes
+		self.request = None
+
+	def start(self):
+		key = (self.cwdAbs, self.sha)
+		fullSha = self.fullShas.get(key)
+		if fullSha is not None:
+			self.fullShas.move_to_end(key)
+			self.send(fullSha)
+			return
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'cat-file',
+			'--batch-check=%(objectname)',
+		]
+		self.request = gitPool.request(cmd, self.sha, self.onFullSha, echoMarker=False)
+
+	def onFullSha(self, stdout, error):
+		if error is not None:
+			self.onDone(None, error)
+			return
+		fullSha = stdout.strip()
+		if not re.match(r'^[0-9a-f]+$', fullSha):
+			self.onDone('', None) # Missing
+			return
+		self.fullShas[(self.cwdAbs, self.sha)] = fullSha
+		while len(self.fullShas) > GitzConfig.fullShaCacheEntries:
+			self.fullShas.popitem(last=False)
+		self.send(fullSha)
+
+	def send(self, fullSha):
+		self.request = gitPool.request(self.cmd, fullSha, self.onCommit, maxBytes=self.maxBytes)
+
+	def onCommit(self, stdout, error):
+		if stdout is not None and stdout.startswith('\n'):
+			stdout = stdout[1:] # Separator diff-tree prints before every commit but the first
+		self.onDone(stdout, error)
+
+	def cancel(self):
+		if self.request is not None:
+			self.request.cancel()
+
+
+class CommitCache:
+	# LRU of loaded commits, bounded by entry count and by size.
+	# Keys are (sha, dirPath, showAll), values are (text, spans).
+	def __init__(self, maxEntries, maxBytes):
+		self.maxEntries = maxEntries
+		self.maxBytes = maxBytes
+		self.entries = collections.OrderedDict()
+		self.totalBytes = 0
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			tracer.instant('commitCache miss', 'cache', sha=key[0])
+			return None
+		tracer.instant('commitCache hit', 'cache', sha=key[0])
+		self.entries.move_to_end(key)
+		text, spans, size = entry
+		return text, spans
+
+	def put(self, key, text, spans):
+		size = len(text) + 32 * len(spans)
+		if size > self.maxBytes:
+			return
+		self.remove(key)
+		self.entries[key] = (text, spans, size)
+		self.totalBytes += size
+		while len(self.entries) > self.maxEntries or self.totalBytes > self.maxBytes:
+			oldKey, oldEntry = self.entries.popitem(last=False)
+			self.totalBytes -= oldEntry[2]
+
+	def remove(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.totalBytes -= entry[2]
+
+def getCacheDir():
+	cacheHome = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+	return os.path.join(cacheHome, 'gitz')
+
+class GitBackend:
+	# Reads the repository by running git through gitPool. This is the
+	# default backend, Pygit2Backend overrides what it can do in-process.
+	name = 'git'
+
+	def __init__(self, cwdAbs):
+		self.cwdAbs = cwdAbs
+
+	#--- Log
+	def getLogCommand(self, revisionArgs, filterArgs, pathArgs):
+		if GitzConfig.nativeGraph:
+			cmd = [
+				'git',
+				'-C',
+				self.cwdAbs,
+				'log',
+				'--parents', # Rewrite parents to the commits that are listed
+				'--topo-order',
+				'--format=%H %P%x00%h %s', # Decorated from the RefIndex
+			]
+		else:
+			cmd = [
+				'git',
+				'-C',
+				self.cwdAbs,
+				'log',
+				'--oneline',
+				'--graph',
+				'--decorate',
+			]
+		cmd += revisionArgs
+		cmd += filterArgs
+		cmd += pathArgs
+		return cmd
+
+	def streamLog(self, revisionArgs, filterArgs, pathArgs, onLines, onDone):
+		# Returns the started stream, see GitStream
+		stream = GitStream(self.getLogCommand(revisionArgs, filterArgs, pathArgs), onLines, onDone)
+		stream.start()
+		return stream
+
+	def readLog(self, revisionArgs, filterArgs, pathArgs, onDone):
+		return gitPool.run(self.getLogCommand(revisionArgs, filterArgs, pathArgs), onDone)
+
+	def loadRefSnapshot(self, revisionArgs, onDone):
+		# Calls onDone(refIndex) with every ref and the revs revisionArgs resolve to
+		refs = []
+		def onRefs(stdout):
+			for line in stdout.splitlines():
+				sha, commitSha, commitTime, refName = line.split(' ', 3)
+				refs.append((refName, sha, commitSha or sha, int(commitTime or 0)))
+			cmd = [
+				'git',
+				'-C',
+				self.cwdAbs,
+				'rev-parse',
+				'--symbolic-full-name',
+				'HEAD',
+			]
+			gitPool.run(cmd, onHeadName)
+		def onHeadName(stdout):
+			headName = stdout.strip()
+			def onRevs(stdout):
+				onDone(RefIndex(refs, headName, stdout.split(), revisionArgs))
+			cmd = [
+				'git',
+				'-C',
+				self.cwdAbs,
+				'rev-parse',
+				'HEAD',
+			] + revisionArgs
+			gitPool.run(cmd, onRevs)
+
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'for-each-ref',
+			'--format=%(objectname) %(*objectname) %(committerdate:unix) %(refname)',
+		]
+		gitPool.run(cmd, onRefs)
+
+	#--- Files
+	def listFiles(self, onPaths, onDone):
+		# onPaths(paths) with batches of the tracked files relative to
+		# cwd, then onDone(). Returns something to cancel().
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'ls-files',
+			'-z', # Unquoted paths
+		]
+		stream = GitStream(cmd, onPaths, onDone, separator='\0')
+		stream.start()
+		return stream
+
+	#--- Commits
+	# relativeDir limits a commit to the changes in that folder and shows
+	# paths relative to cwd like git show --relative. None shows everything.
+	def getDiffTreeCommand(self, relativeDir, args):
+		# git diff-tree --stdin prints the same as git show with args
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'diff-tree',
+			'--stdin',
+			'--root',
+			'--cc',
+			'-M', # git show detects renames, plumbing does not by default
+			'--always', # Also print commits without changes
+		]
+		cmd += args
+		if relativeDir is not None:
+			cmd += [
+				'--relative',
+				'--',
+				relativeDir,
+			]
+		return cmd
+
+	def requestCommit(self, sha, relativeDir, onDone, maxBytes=None):
+		# onDone(text, None) with git show --patch-with-stat, or onDone(None,
+		# error) where error is 'overflow' when it is larger than maxBytes
+		# or 'died' when git failed. Returns something to cancel().
+		cmd = self.getDiffTreeCommand(relativeDir, ['--patch-with-stat', '--pretty=medium', '--abbrev'])
+		request = DiffTreeRequest(self.cwdAbs, sha, cmd, onDone, maxBytes=maxBytes)
+		request.start()
+		return request
+
+	def requestStat(self, sha, relativeDir, onDone):
+		cmd = self.getDiffTreeCommand(relativeDir, ['--stat', '--pretty=medium', '--abbrev'])
+		request = DiffTreeRequest(self.cwdAbs, sha, cmd, onDone)
+		request.start()
+		return request
+
+	def requestNumstat(self, sha, relativeDir, onDone):
+		cmd = self.getDiffTreeCommand(relativeDir, ['--numstat', '-z', '--no-commit-id'])
+		request = DiffTreeRequest(self.cwdAbs, sha, cmd, onDone)
+		request.start()
+		return request
+
+	def requestPatch(self, sha, relativeDir, paths, onDone):
+		# paths are from requestNumstat, relative to cwd with relativeDir
+		# or else to the top of the repository.
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'show',
+			sha,
+			'--patch',
+			'--format=',
+		]
+		if relativeDir is not None:
+			cmd.append('--relative')
+			prefix = ':(literal)'
+		else:
+			prefix = ':(top,literal)'
+		cmd += ['--'] + [prefix + path for path in paths]
+		return gitPool.run(cmd, onDone)
+
+def getSnapshotRevs(tips, revs, revisionArgs):
+	# revs are HEAD followed by what revisionArgs resolve to
+	if len(revs) >= 1:
+		tips['HEAD'] = revs[0]
+		if len(revisionArgs) >= 1 and '--all' not in revisionArgs:
+			revs = revs[1:] # git log only walks HEAD by default and for --all
+	return sorted(set(revs))
+
+def getRefLabel(refName):
+	# The name git log --decorate shows for a ref and its kind
+	if refName.startswith('refs/heads/'):
+		return refName[len('refs/heads/'):], 'local'
+	elif refName.startswith('refs/remotes/'):
+		return refName[len('refs/remotes/'):], 'remote'
+	elif refName.startswith('refs/tags/'):
+		return 'tag: ' + refName[len('refs/tags/'):], 'tag'
+	return refName, 'local'
+
+
+class RefIndex:
+	# Every ref of the repository, read at once instead of asking git per
+	# view: the labels of each commit for its decorations, the kind of each
+	# label, the branches for the branch filter and the tips and revs the
+	# history cache is keyed on.
+	def __init__(self, refs, headName, revs, revisionArgs):
+		# refs are (refName, sha, commitSha, commitTime) sorted by refName,
+		# commitSha being the commit an annotated tag points to. headName
+		# is 'HEAD' when detached. revs are HEAD and what revisionArgs
+		# resolve to.
+		self.refs = refs
+		self.tips = {refName: sha for refName, sha, commitSha, commitTime in refs}
+		self.revs = getSnapshotRevs(self.tips, revs, revisionArgs)
+		self.tips['HEAD@symbolic'] = headName
+		self.kinds = {}
+		self.decorations = {}
+		for refName, sha, commitSha, commitTime in reversed(refs):
+			label, kind = getRefLabel(refName)
+			self.kinds[label] = kind
+			if refName != headName:
+				self.decorations.setdefault(commitSha, []).append(label)
+		headSha = self.tips.get('HEAD')
+		if headSha is not None and headSha != 'HEAD': # Unborn
+			headLabel = 'HEAD' if headName == 'HEAD' else 'HEAD -> ' + getRefLabel(headName)[0]
+			self.decorations.setdefault(headSha, []).insert(0, headLabel)
+		self.branchNames = None
+
+	def getKind(self, label):
+		return self.kinds.get(label, 'local')
+
+	#--- Decorations
+	# Native graph rows are "sha parents...\0short subject", their labels
+	# go after the short sha like git log's %d.
+	def decorateLines(self, lines):
+		decorations = self.decorations
+		decorated = []
+		for line in lines:
+			labels = decorations.get(line[:line.find(' ')])
+			if labels is not None:
+				pos = line.find(' ', line.find('\x00'))
+				line = '{} ({}){}'.format(line[:pos], ', '.join(labels), line[pos:])
+			decorated.append(line)
+		return decorated
+
+	def redecorateLine(self, line):
+		# Replaces the labels the row was decorated with before
+		end = line.find('\x00') + 1
+		match = LOG_PATTERN.match(line[end:])
+		if match is not None and match.group(4) is not None:
+			line = line[:end] + match.group(3) + ' ' + match.group(5)
+		return self.decorateLines([line])[0]
+
+	#--- Branches
+	def getBranchNames(self):
+		# Local branches then remote ones, most recent first, like git branch --all
+		if self.branchNames is None:
+			branches = []
+			for refName, sha, commitSha, commitTime in self.refs:
+				if refName.startswith('refs/heads/'):
+					branches.append((False, -commitTime, refName[len('refs/heads/'):]))
+				elif refName.startswith('refs/remotes/'):
+					branches.append((True, -commitTime, refName[len('refs/'):]))
+			branches.sort()
+			self.branchNames = [name for isRemote, commitTime, name in branches]
+		return self.branchNames
+
+	def searchBranches(self, query, limit):
+		# Up to limit branches containing query, most recent first
+		query = query.lower()
+		matches = []
+		for name in self.getBranchNames():
+			if query in name.lower():
+				matches.append(name)
+				if len(matches) >= limit:
+					break
+		return matches
+
+
+class BackendTask:
+	# Runs func(*args) in a worker thread for an in-process backend, then
+	# onDone(result) unless it was cancelled in the meantime.
+	def __init__(self, func, args, onDone):
+		self.func = func
+		self.args = args
+		self.onDone = onDone
+		self.cancelled = False
+		self.fallback = None # A GitBackend request taking over
+
+	def start(self):
+		runInThread(self.func, self.args, self.onResult)
+		return self
+
+	def onResult(self, result):
+		if not self.cancelled:
+			self.onDone(result)
+
+	def cancel(self):
+		self.cancelled = True
+		if self.fallback is not None:
+			self.fallback.cancel()
+
+
+class Pygit2LogWalk:
+	# Walks the history in a worker thread and hands batches of rows in
+	# the native graph format to onLines on the main loop, like GitStream.
+	def __init__(self, backend, revisionArgs, onLines, onDone):
+		self.backend = backend
+		self.revisionArgs = revisionArgs
+		self.onLines = onLines
+		self.onDone = onDone
+		self.cancelled = False
+		self.paused = False
+		self.resumed = threading.Event()
+		self.resumed.set()
+
+	def start(self):
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		repo = self.backend.getRepo()
+		walker = repo.walk(None, pygit2.GIT_SORT_TOPOLOGICAL)
+		for oid in self.backend.getWalkTips(repo, self.revisionArgs):
+			walker.push(oid)
+		lines = []
+		for commit in walker:
+			if self.cancelled:
+				return
+			lines.append('{} {}\x00{} {}'.format(
+				commit.id,
+				' '.join(str(parentId) for parentId in commit.parent_ids),
+				commit.short_id,
+				getSubject(commit.message),
+			))
+			if len(lines) >= GitzConfig.streamChunkSize // 64:
+				GLib.idle_add(self.deliverLines, lines)
+				lines = []
+				self.resumed.wait()
+		GLib.idle_add(self.deliverLines, lines)
+		GLib.idle_add(self.deliverDone)
+
+	def deliverLines(self, lines):
+		if not self.cancelled and len(lines) > 0:
+			self.onLines(lines)
+		return False
+
+	def deliverDone(self):
+		if not self.cancelled and self.onDone is not None:
+			self.onDone()
+		return False
+
+	def pause(self):
+		# The walk stops after the batch it is building
+		self.paused = True
+		self.resumed.clear()
+
+	def resume(self):
+		self.paused = False
+		self.resumed.set()
+
+	def cancel(self):
+		self.cancelled = True
+		self.resumed.set()
+
+
+def getSubject(message):
+	# Like git's %s, the first paragraph on one line
+	paragraph = message.lstrip('\n').split('\n\n', 1)[0]
+	return ' '.join(line.strip() for line in paragraph.strip().split('\n'))
+
+GIT_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+GIT_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def formatGitDate(timestamp, offset):
+	# git's default date format, eg: "Thu Oct 8 05:06:07 2026 +0230"
+	t = time.gmtime(timestamp + offset * 60)
+	sign = '-' if offset < 0 else '+'
+	return '{} {} {} {:02d}:{:02d}:{:02d} {} {}{:02d}{:02d}'.format(
+		GIT_WEEKDAYS[t.tm_wday],
+		GIT_MONTHS[t.tm_mon - 1],
+		t.tm_mday,
+		t.tm_hour,
+		t.tm_min,
+		t.tm_sec,
+		t.tm_year,
+		sign,
+		abs(offset) // 60,
+		abs(offset) % 60,
+	)
+
+
+def fixPatchText(patchText):
+	# libgit2 differs from git in the file header: git ends ---/+++ names
+	# containing spaces with a tab and skips them for files without hunks.
+	hunkStart = patchText.find('\n@@ ') + 1
+	if hunkStart == 0:
+		hunkStart = len(patchText)
+	lines = patchText[:hunkStart].split('\n')
+	fixed = []
+	for line in lines:
+		if line[:4] in ('--- ', '+++ '):
+			if hunkStart == len(patchText):
+				continue
+			if ' ' in line[4:]:
+				line += '\t'
+		fixed.append(line)
+	return '\n'.join(fixed) + patchText[hunkStart:]
+
+GIT_QUOTE_ESCAPES = {7: 'a', 8: 'b', 9: 't', 10: 'n', 11: 'v', 12: 'f', 13: 'r', 34: '"', 92: '\\'}
+
+def quotePath(path):
+	# Like git's quote_c_style with core.quotePath on
+	data = path.encode('utf-8', 'surrogateescape')
+	if all(0x20 <= b < 0x7f and b not in GIT_QUOTE_ESCAPES for b in data):
+		return path
+	quoted = []
+	for b in data:
+		if b in GIT_QUOTE_ESCAPES:
+			quoted.append('\\' + GIT_QUOTE_ESCAPES[b])
+		elif b < 0x20 or b >= 0x7f:
+			quoted.append('\\{:03o}'.format(b))
+		else:
+			quoted.append(chr(b))
+	return '"' + ''.join(quoted) + '"'
+
+GIT_UNQUOTE_ESCAPES = {c: b for b, c in GIT_QUOTE_ESCAPES.items()}
+
+def unquotePath(text):
+	# Reverses quotePath
+	if not (len(text) >= 2 and text.startswith('"') and text.endswith('"')):
+		return text
+	data = bytearray()
+	i = 1
+	end = len(text) - 1
+	while i < end:
+		c = text[i]
+		if c != '\\':
+			data += c.encode('utf-8')
+			i += 1
+		elif text[i+1] in GIT_UNQUOTE_ESCAPES:
+			data.append(GIT_UNQUOTE_ESCAPES[text[i+1]])
+			i += 2
+		else:
+			data.append(int(text[i+1:i+4], 8))
+			i += 4
+	return data.decode('utf-8', 'replace')
+
+class Pygit2Backend(GitBackend):
+	# Reads objects in-process with libgit2, without forking git or parsing
+	# its output. Only used when pygit2 is installed. Requests it cannot
+	# answer the same way as git fall back to GitBackend: the --graph log,
+	# log filters and paths, merge commits and commits limited to a folder.
+	name = 'pygit2'
+
+	def __init__(self, cwdAbs, path):
+		GitBackend.__init__(self, cwdAbs)
+		self.path = path
+		self.repo = pygit2.Repository(path)
+		self.threadRepos = threading.local()
+
+	def getRepo(self):
+		# Repository objects are not shared between threads
+		if threading.current_thread() is threading.main_thread():
+			return self.repo
+		repo = getattr(self.threadRepos, 'repo', None)
+		if repo is None:
+			repo = pygit2.Repository(self.path)
+			self.threadRepos.repo = repo
+		return repo
+
+	def getRefs(self, repo):
+		# (refName, reference) under refs/, sorted like for-each-ref
+		refs = [(ref.name, ref) for ref in repo.references.iterator()]
+		refs.sort(key=lambda item: item[0])
+		return refs
+
+	def getWalkTips(self, repo, revisionArgs):
+		oids = []
+		if '--all' in revisionArgs:
+			for refName, ref in self.getRefs(repo):
+				try:
+					oids.append(ref.peel(pygit2.Commit).id)
+				except (KeyError, ValueError, pygit2.GitError):
+					pass # Tag of a tree or blob
+		if len(revisionArgs) == 0 or '--all' in revisionArgs:
+			oids.append(repo.head.peel(pygit2.Commit).id)
+		else:
+			for rev in revisionArgs:
+				oids.append(repo.revparse_single(rev).peel(pygit2.Commit).id)
+		return oids
+
+	#--- Log
+	def canWalkLog(self, revisionArgs, filterArgs, pathArgs):
+		return GitzConfig.nativeGraph and len(filterArgs) == 0 and len(pathArgs) == 0 and not self.repo.head_is_unborn
+
+	def streamLog(self, revisionArgs, filterArgs, pathArgs, onLines, onDone):
+		if not self.canWalkLog(revisionArgs, filterArgs, pathArgs):
+			return GitBackend.streamLog(self, revisionArgs, filterArgs, pathArgs, onLines, onDone)
+		walk = Pygit2LogWalk(self, revisionArgs, onLines, onDone)
+		walk.start()
+		return walk
+
+	def readLog(self, revisionArgs, filterArgs, pathArgs, onDone):
+		if not self.canWalkLog(revisionArgs, filterArgs, pathArgs):
+			return GitBackend.readLog(self, revisionArgs, filterArgs, pathArgs, onDone)
+		logLines = []
+		def onWalkDone():
+			onDone('\n'.join(logLines))
+		walk = Pygit2LogWalk(self, revisionArgs, logLines.extend, onWalkDone)
+		walk.start()
+		return walk
+
+	def loadRefSnapshot(self, revisionArgs, onDone):
+		task = BackendTask(self.readRefIndex, (revisionArgs,), None)
+		def onRefIndex(refIndex):
+			if refIndex is None:
+				task.fallback = GitBackend.loadRefSnapshot(self, revisionArgs, onDone)
+			else:
+				onDone(refIndex)
+		task.onDone = onRefIndex
+		return task.start()
+
+	def readRefIndex(self, revisionArgs):
+		repo = self.getRepo()
+		try:
+			refs = []
+			for refName, ref in self.getRefs(repo):
+				try:
+					target = repo.get(ref.resolve().target)
+				except (KeyError, pygit2.GitError):
+					continue # Dangling symbolic ref
+				try:
+					commitSha = str(ref.peel(pygit2.Commit).id)
+				except (KeyError, ValueError, pygit2.GitError):
+					commitSha = str(target.id) # Tag of a tree or blob
+				commitTime = target.commit_time if isinstance(target, pygit2.Commit) else 0
+				refs.append((refName, str(target.id), commitSha, commitTime))
+			revs = [str(repo.head.target)]
+			for rev in revisionArgs:
+				if rev == '--all':
+					revs += [sha for refName, sha, commitSha, commitTime in refs]
+				else:
+					revs.append(str(repo.revparse_single(rev).id))
+			headName = 'HEAD' if repo.head_is_detached else repo.head.name
+		except (KeyError, ValueError, pygit2.GitError):
+			return None # Unborn HEAD or a revision libgit2 can't parse
+		return RefIndex(refs, headName, revs, revisionArgs)
+
+	#--- Files
+	def listFiles(self, onPaths, onDone):
+		def onFiles(paths):
+			onPaths(paths)
+			onDone()
+		return BackendTask(self.readFiles, (), onFiles).start()
+
+	def readFiles(self):
+		repo = self.getRepo()
+		prefix = os.path.relpath(self.cwdAbs, repo.workdir)
+		prefix = '' if prefix == '.' else prefix + '/'
+		return [entry.path[len(prefix):] for entry in repo.index if entry.path.startswith(prefix)]
+
+	#--- Commits
+	def requestCommit(self, sha, relativeDir, onDone, maxBytes=None):
+		if relativeDir is not None:
+			return GitBackend.requestCommit(self, sha, relativeDir, onDone, maxBytes)
+		def onFormatted(result):
+			if result is False:
+				task.fallback = GitBackend.requestCommit(self, sha, relativeDir, onDone, maxBytes)
+			elif result is None:
+				onDone(None, 'overflow')
+			else:
+				onDone(result, None)
+		task = BackendTask(self.formatCommit, (sha, maxBytes), onFormatted)
+		return task.start()
+
+	def formatCommit(self, sha, maxBytes):
+		# Runs in a worker thread. Returns the text git show --patch-with-stat
+		# prints, None when it is larger than maxBytes or False for git to answer.
+		repo = self.getRepo()
+		try:
+			commit = repo.revparse_single(sha).peel(pygit2.Commit)
+		except (KeyError, ValueError, pygit2.GitError):
+			return False
+		if len(commit.parents) > 1:
+			return False # Combined diff
+		lines = [
+			'commit {}'.format(commit.id),
+			'Author: {} <{}>'.format(commit.author.name, commit.author.email),
+			'Date:   {}'.format(formatGitDate(commit.author.time, commit.author.offset)),
+			'',
+		]
+		for line in commit.message.rstrip('\n').split('\n'):
+			lines.append('    ' + line)
+		if len(commit.parents) == 1:
+			diff = repo.diff(commit.parents[0], commit)
+		else:
+			diff = commit.tree.diff_to_tree(swap=True)
+		diff.find_similar()
+		header = '\n'.join(lines) + '\n'
+		if len(diff) == 0:
+			return header
+
+		statFiles = []
+		patches = []
+		size = len(header)
+		for patch in diff:
+			delta = patch.delta
+			oldPath = delta.old_file.path
+			newPath = delta.new_file.path
+			name = quotePath(newPath) if oldPath == newPath else formatRenameName(quotePath(oldPath), quotePath(newPath))
+			if delta.is_binary:
+				statFiles.append((name, 0, 0, (delta.old_file.size, delta.new_file.size)))
+			else:
+				context, added, deleted = patch.line_stats
+				statFiles.append((name, added, deleted, None))
+			patchText = patch.text
+			patchText = fixPatchText(patchText)
+			size += len(patchText)
+			if maxBytes is not None and size > maxBytes:
+				return None
+			patches.append(patchText)
+		return header + '---\n' + formatDiffStat(statFiles) + '\n' + ''.join(patches)
+
+def formatRenameName(a, b):
+	# Like git's pprint_rename, eg: "dir/{old => new}/file"
+	prefixLength = 0
+	i = 0
+	while i < len(a) and i < len(b) and a[i] == b[i]:
+		if a[i] == '/':
+			prefixLength = i + 1
+		i += 1
+	suffixLength = 0
+	adjust = 1 if prefixLength else 0
+	i = len(a)
+	j = len(b)
+	while prefixLength - adjust <= i and prefixLength - adjust <= j and (a[i] if i < len(a) else '') == (b[j] if j < len(b) else ''):
+		if i < len(a) and a[i] == '/':
+			suffixLength = len(a) - i
+		i -= 1
+		j -= 1
+	aMiddle = a[prefixLength:max(prefixLength, len(a) - suffixLength)]
+	bMiddle = b[prefixLength:max(prefixLength, len(b) - suffixLength)]
+	if prefixLength + suffixLength:
+		return '{}{{{} => {}}}{}'.format(a[:prefixLength], aMiddle, bMiddle, a[len(a) - suffixLength:])
+	return '{} => {}'.format(aMiddle, bMiddle)
+
+def scaleLinear(it, width, maxChange):
+	if not it:
+		return 0
+	return 1 + (it * (width - 1) // maxChange)
+
+def formatDiffStat(files, width=80):
+	# Like git's --stat for files of (name, added, deleted, binarySizes),
+	# binarySizes being (oldSize, newSize) for binary files or None.
+	maxLength = 0
+	maxChange = 0
+	numberWidth = 0
+	binWidth = 0
+	for name, added, deleted, binarySizes in files:
+		maxLength = max(maxLength, len(name))
+		if binarySizes is not None:
+			binWidth = max(binWidth, 14 + len(str(binarySizes[0])) + len(str(binarySizes[1])))
+			numberWidth = 3 # Change counts line up with "Bin"
+			continue
+		maxChange = max(maxChange, added + deleted)
+	numberWidth = max(numberWidth, len(str(maxChange)))
+	width = max(width, 16 + 6 + numberWidth)
+	graphWidth = maxChange if maxChange + 4 > binWidth else binWidth - 4
+	nameWidth = maxLength
+	if nameWidth + numberWidth + 6 + graphWidth > width:
+		if graphWidth > width * 3 // 8 - numberWidth - 6:
+			graphWidth = max(6, width * 3 // 8 - numberWidth - 6)
+		if nameWidth > width - numberWidth - 6 - graphWidth:
+			nameWidth = width - numberWidth - 6 - graphWidth
+		else:
+			graphWidth = width - numberWidth - 6 - nameWidth
+
+	lines = []
+	insertions = 0
+	deletions = 0
+	for name, added, deleted, binarySizes in files:
+		prefix = ''
+		length = nameWidth
+		if nameWidth < len(name):
+			prefix = '...'
+			length = max(0, nameWidth - 3)
+			name = name[len(name) - length:]
+			slash = name.find('/')
+			if slash != -1:
+				name = name[slash:]
+		line = ' {}{:<{}} |'.format(prefix, name, length)
+		if binarySizes is not None:
+			line += ' {:>{}}'.format('Bin', numberWidth)
+			if binarySizes != (0, 0):
+				line += ' {} -> {} bytes'.format(binarySizes[0], binarySizes[1])
+			lines.append(line)
+			continue
+		insertions += added
+		deletions += deleted
+		add = added
+		delete = deleted
+		if graphWidth <= maxChange:
+			total = scaleLinear(added + deleted, graphWidth, maxChange)
+			if total < 2 and add and delete:
+				total = 2
+			if add < delete:
+				add = scaleLinear(add, graphWidth, maxChange)
+				delete = total - add
+			else:
+				delete = scaleLinear(delete, graphWidth, maxChange)
+				add = total - delete
+		line += ' {:>{}}{}'.format(added + deleted, numberWidth, ' ' if added + deleted else '')
+		line += '+' * add + '-' * delete
+		lines.append(line)
+
+	summary = ' {} file{} changed'.format(len(files), '' if len(files) == 1 else 's')
+	if insertions or deletions == 0:
+		summary += ', {} insertion{}(+)'.format(insertions, '' if insertions == 1 else 's')
+	if deletions or insertions == 0:
+		summary += ', {} deletion{}(-)'.format(deletions, '' if deletions == 1 else 's')
+	lines.append(summary)
+	return '\n'.join(lines) + '\n'
+
+def createRepoBackend(cwdAbs):
+	if GitzConfig.backend == 'pygit2' and pygit2 is not None:
+		path = pygit2.discover_repository(cwdAbs)
+		if path is not None:
+			return Pygit2Backend(cwdAbs, path)
+	return GitBackend(cwdAbs)
+
+
+class HistoryDiskCache:
+	# git log output per repo and log command, stored under XDG_CACHE_HOME
+	# together with the ref tips it was loaded at. The logs used last are
+	# also kept in memory, the rows are shared with the loaded histories.
+	# Loading a file touches it, so the ones used least recently are
+	# deleted once there are too many.
+	version = 1
+	memoryEntries = 8
+
+	def __init__(self, repoPath):
+		repoKey = hashlib.sha1(repoPath.encode('utf-8')).hexdigest()[:16]
+		self.dirPath = os.path.join(getCacheDir(), 'history', repoKey)
+		self.entries = collections.OrderedDict() # tuple(cmd): meta
+
+	def getFilePath(self, cmd):
+		key = hashlib.sha1('\0'.join(cmd).encode('utf-8')).hexdigest()[:16]
+		return os.path.join(self.dirPath, key + '.log')
+
+	def load(self, cmd):
+		# The caller may edit the lines of the result in place
+		meta = self.entries.get(tuple(cmd))
+		if meta is not None:
+			self.entries.move_to_end(tuple(cmd))
+			self.touch(cmd)
+			tracer.instant('historyCache hit', 'cache', cmd=cmd, rows=len(meta['lines']), memory=True)
+			return dict(meta, lines=list(meta['lines']))
+		try:
+			with open(self.getFilePath(cmd), encoding='utf-8') as f:
+				meta = json.loads(f.readline())
+				text = f.read()
+		except (OSError, ValueError):
+			tracer.instant('historyCache miss', 'cache', cmd=cmd)
+			return None
+		if meta.get('version') != self.version or meta.get('cmd') != cmd:
+			tracer.instant('historyCache miss', 'cache', cmd=cmd)
+			return None
+		meta['lines'] = text.split('\n') if text else []
+		self.touch(cmd)
+		tracer.instant('historyCache hit', 'cache', cmd=cmd, rows=len(meta['lines']))
+		self.keep(cmd, dict(meta, lines=list(meta['lines'])))
+		return meta
+
+	def keep(self, cmd, meta):
+		self.entries[tuple(cmd)] = meta
+		self.entries.move_to_end(tuple(cmd))
+		while len(self.entries) > self.memoryEntries:
+			self.entries.popitem(last=False)
+
+	def save(self, cmd, tips, revs, lines):
+		filePath = self.getFilePath(cmd)
+		meta = {
+			'version': self.version,
+			'cmd': cmd,
+			'tips': tips,
+			'revs': revs,
+		}
+		self.keep(cmd, dict(meta, lines=list(lines)))
+		text = '\n'.join(lines)
+		def write():
+			try:
+				os.makedirs(self.dirPath, exist_ok=True)
+				tmpPath = filePath + '.tmp'
+				with open(tmpPath, 'w', encoding='utf-8') as f:
+					f.write(json.dumps(meta) + '\n')
+					f.write(text)
+				os.replace(tmpPath, filePath)
+				self.evict()
+			except OSError as e:
+				print('HistoryDiskCache.save', e)
+		threading.Thread(target=write, daemon=True).start()
+
+	def touch(self, cmd):
+		try:
+			os.utime(self.getFilePath(cmd))
+		except OSError:
+			pass # Not written yet
+
+	def evict(self):
+		# Runs in the save thread
+		files = []
+		for entry in os.scandir(self.dirPath):
+			if entry.name.endswith('.log'):
+				try:
+					stat = entry.stat()
+				except OSError:
+					continue # Deleted by another save
+				files.append((stat.st_mtime, stat.st_size, entry.path))
+		files.sort(reverse=True) # Most recently used first
+		totalBytes = 0
+		for i, (mtime, size, filePath) in enumerate(files):
+			totalBytes += size
+			if i > 0 and (i >= GitzConfig.historyCacheFiles or totalBytes > GitzConfig.historyCacheBytes):
+				try:
+					os.remove(filePath)
+				except OSError:
+					pass
+				tracer.instant('historyCache evict', 'cache', path=filePath, bytes=size)
+
+
+def getLogRowKey(line):
+	# Graph, sha and summary of a log row, without the decorations.
+	end = line.find('\x00')
+	match = LOG_PATTERN.match(line[end+1:])
+	if not match:
+		return line
+	return (line[:end+1], match.group(1), match.group(3), match.group(5))
+
+def countCommitRows(lines):
+	count = 0
+	for line in lines:
+		match = LOG_PATTERN.match(line)
+		if match and match.group(3):
+			count += 1
+	return count
+
+def trimLogEdit(lines, index, removeCount, newLines):
+	# Shrinks an edit of lines to the rows that differ
+	start = 0
+	end = removeCount
+	newEnd = len(newLines)
+	while start < end and start < newEnd and lines[index + start] == newLines[start]:
+		start += 1
+	while start < end and start < newEnd and lines[index + end - 1] == newLines[newEnd - 1]:
+		end -= 1
+		newEnd -= 1
+	return (index + start, end - start, newLines[start:newEnd])
+
+def spliceLogRows(freshLines, cachedLines, newCount):
+	# freshLines are the first rows of the current log, which start with
+	# newCount new commits. When the rows after those match the top of
+	# cachedLines, returns how many cached rows the fresh rows replace.
+	# Returns -1 when the graph changed below the new commits.
+	commitCount = 0
+	start = len(freshLines)
+	for i, line in enumerate(freshLines):
+		match = LOG_PATTERN.match(line)
+		if match and match.group(3):
+			if commitCount == newCount:
+				start = i
+				break
+			commitCount += 1
+
+	tailLength = len(freshLines) - start - 1 # The last row may miss graph lines cut off by --max-count
+	if tailLength < min(GitzConfig.historyCacheOverlap // 2, len(cachedLines)) or tailLength > len(cachedLines):
+		return -1
+	for i in range(tailLength):
+		if getLogRowKey(freshLines[start + i]) != getLogRowKey(cachedLines[i]):
+			return -1
+	return tailLength
+
+
+class HistoryCacheUpdate:
+	# Brings a cached git log up to date with the current refs. Only the
+	# commits that are new since the cached tips are logged, and only rows
+	# of refs that moved are re-decorated. onDone(edits) gets a list of
+	# (index, removeCount, lines) to apply to the cached lines in order,
+	# or None when the whole log has to be reloaded.
+	def __init__(self, logCmd, filterArgs, pathArgs, cached, refIndex, onDone):
+		self.logCmd = logCmd
+		self.filterArgs = filterArgs
+		self.pathArgs = pathArgs
+		self.cached = cached
+		self.refIndex = refIndex
+		self.tips = refIndex.tips
+		self.revs = refIndex.revs
+		self.onDone = onDone
+		self.newCount = 0
+		self.cwdAbs = logCmd[2] # git -C cwdAbs log ...
+
+	def getRevListCommand(self):
+		return [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'rev-list',
+			'--count',
+			'--stdin',
+			'--ignore-missing',
+		] + self.filterArgs + ['--'] + self.pathArgs
+
+	def start(self):
+		# Commits reachable from the new revs that were not in the cache.
+		stdin = ''.join(rev + '\n' for rev in self.revs)
+		stdin += ''.join('^' + rev + '\n' for rev in self.cached['revs'])
+		gitPool.run(self.getRevListCommand(), self.onNewCount, stdin=stdin)
+
+	def onNewCount(self, stdout):
+		if not stdout.strip().isdigit():
+			self.onDone(None)
+			return
+		self.newCount = int(stdout)
+		# Commits that are no longer reachable, eg: deleted branches or a force push.
+		stdin = ''.join(rev + '\n' for rev in self.cached['revs'])
+		stdin += ''.join('^' + rev + '\n' for rev in self.revs)
+		cmd = self.getRevListCommand()[:-1-len(self.pathArgs)]
+		gitPool.run(cmd, self.onVanishedCount, stdin=stdin)
+
+	def onVanishedCount(self, stdout):
+		if stdout.strip() != '0':
+			self.onDone(None)
+			return
+		cmd = self.logCmd[:4] + ['--max-count={}'.format(self.newCount + GitzConfig.historyCacheOverlap)] + self.logCmd[4:]
+		gitPool.run(cmd, self.onFreshLines)
+
+	def onFreshLines(self, stdout):
+		freshLines = stdout.rstrip('\n').split('\n') if stdout.strip() else []
+		if GitzConfig.nativeGraph:
+			freshLines = self.refIndex.decorateLines(freshLines)
+		cachedLines = self.cached['lines']
+		if countCommitRows(freshLines) < self.newCount + GitzConfig.historyCacheOverlap:
+			# The whole history fit in the fresh log
+			self.onDone([(0, len(cachedLines), freshLines)])
+			return
+
+		replaceCount = spliceLogRows(freshLines, cachedLines, self.newCount)
+		if replaceCount == -1:
+			self.onDone(None)
+			return
+		self.topEdit = (0, replaceCount, freshLines[:len(freshLines) - 1])
+		self.redecorate(replaceCount)
+
+	def redecorate(self, firstRow):
+		# Rows below the fresh ones keep their old decorations, fix the
+		# rows of every ref that was added, moved or deleted.
+		oldTips = self.cached['tips']
+		changedShas = set()
+		for refName in set(oldTips) | set(self.tips):
+			if refName == 'HEAD@symbolic':
+				continue
+			if oldTips.get(refName) != self.tips.get(refName):
+				changedShas.add(oldTips.get(refName))
+				changedShas.add(self.tips.get(refName))
+		if oldTips.get('HEAD@symbolic') != self.tips.get('HEAD@symbolic'):
+			changedShas.add(oldTips.get('HEAD'))
+			changedShas.add(self.tips.get('HEAD'))
+		changedShas.discard(None)
+		if len(changedShas) == 0:
+			self.onDone([self.topEdit])
+			return
+		if GitzConfig.nativeGraph:
+			self.onDone(self.redecorateNativeRows(firstRow, changedShas) + [self.topEdit])
+			return
+
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'log',
+			'--no-walk',
+			'--oneline',
+			'--decorate',
+			'--stdin',
+			'--ignore-missing',
+		]
+		def onDecorated(stdout):
+			decorated = {}
+			for line in stdout.splitlines():
+				decorated[line.split(' ', 1)[0]] = line
+			edits = []
+			if len(decorated) >= 1:
+				# Search the joined text instead of matching every row
+				cachedText = '\n'.join(self.cached['lines'])
+				shaPattern = re.compile(r'^([ \*\|\\\/]+|[0-9a-f ]+\x00)(' + '|'.join(map(re.escape, decorated)) + r') .*$', re.MULTILINE)
+				index = 0
+				pos = 0
+				for match in shaPattern.finditer(cachedText):
+					index += cachedText.count('\n', pos, match.start())
+					pos = match.start()
+					newLine = match.group(1) + decorated[match.group(2)]
+					if index >= firstRow and newLine != match.group(0):
+						edits.append((index, 1, [newLine]))
+			edits.reverse()
+			self.onDone(edits + [self.topEdit])
+		gitPool.run(cmd, onDecorated, stdin=''.join(sha + '\n' for sha in changedShas))
+
+	def redecorateNativeRows(self, firstRow, changedShas):
+		# Native graph rows start with their full sha and are decorated
+		# from the RefIndex. An old tip may be a tag object, so every row
+		# showing labels is checked along with the commits of the changed refs.
+		shas = set(changedShas)
+		for refName, sha, commitSha, commitTime in self.refIndex.refs:
+			if sha in changedShas:
+				shas.add(commitSha)
+		cachedText = '\n'.join(self.cached['lines'])
+		rowPattern = re.compile(r'^(?:(?:' + '|'.join(map(re.escape, shas)) + r') .*|[^\n\x00]*\x00\w+ \([^)\n]+\) .*)$', re.MULTILINE)
+		edits = []
+		index = 0
+		pos = 0
+		for match in rowPattern.finditer(cachedText):
+			index += cachedText.count('\n', pos, match.start())
+			pos = match.start()
+			newLine = self.refIndex.redecorateLine(match.group(0))
+			if index >= firstRow and newLine != match.group(0):
+				edits.append((index, 1, [newLine]))
+		edits.reverse()
+		return edits
+
+class RepoWatcher:
+	# Calls onChange once the refs settle after a commit, checkout or
+	# fetch. HEAD, packed-refs and FETCH_HEAD are watched in the git dir,
+	# directory monitors are not recursive so each folder of refs/ gets one.
+	watchedNames = ('HEAD', 'packed-refs', 'FETCH_HEAD')
+
+	def __init__(self, cwdAbs, onChange):
+		self.cwdAbs = cwdAbs
+		self.onChange = onChange
+		self.monitors = {}
+		self.changeTimer = 0
+		self.watching = False # Once every monitor is set up
+		self.stopped = False
+
+	def start(self):
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'rev-parse',
+			'--git-dir',
+			'--git-common-dir',
+		]
+		def onGitDirs(stdout):
+			gitDirs = stdout.splitlines()
+			if len(gitDirs) != 2 or self.stopped:
+				return # Not a repository
+			gitDir, commonDir = [os.path.normpath(os.path.join(self.cwdAbs, path)) for path in gitDirs]
+			self.watchDir(gitDir, self.onGitDirEvent)
+			if commonDir != gitDir: # A worktree, the refs are shared
+				self.watchDir(commonDir, self.onGitDirEvent)
+			self.watchRefsDir(os.path.join(commonDir, 'refs'))
+			self.watching = True
+		gitPool.run(cmd, onGitDirs)
+
+	def stop(self):
+		self.stopped = True
+		self.watching = False
+		for monitor in self.monitors.values():
+			monitor.cancel()
+		self.monitors = {}
+		if self.changeTimer != 0:
+			GLib.source_remove(self.changeTimer)
+			self.changeTimer = 0
+
+	def isSettled(self):
+		# True while the refs are known to be unchanged
+		return self.watching and self.changeTimer == 0
+
+	def watchDir(self, dirPath, onEvent):
+		if dirPath in self.monitors:
+			return
+		try:
+			monitor = Gio.File.new_for_path(dirPath).monitor_directory(Gio.FileMonitorFlags.NONE, None)
+		except GLib.Error as e:
+			print('RepoWatcher.watchDir', dirPath, e)
+			return
+		monitor.connect('changed', onEvent)
+		self.monitors[dirPath] = monitor
+
+	def watchRefsDir(self, dirPath):
+		self.watchDir(dirPath, self.onRefsEvent)
+		try:
+			entries = list(os.scandir(dirPath))
+		except OSError:
+			return
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				self.watchRefsDir(entry.path)
+
+	def onGitDirEvent(self, monitor, file, otherFile, eventType):
+		for changedFile in (file, otherFile):
+			if changedFile is not None and changedFile.get_basename() in self.watchedNames:
+				self.scheduleChange()
+				return
+
+	def onRefsEvent(self, monitor, file, otherFile, eventType):
+		if eventType == Gio.FileMonitorEvent.ATTRIBUTE_CHANGED:
+			return
+		path = file.get_path()
+		if path.endswith('.lock'):
+			return # The ref is renamed into place once written
+		if eventType == Gio.FileMonitorEvent.CREATED and os.path.isdir(path):
+			self.watchRefsDir(path) # eg: the first feature/* branch
+		elif eventType == Gio.FileMonitorEvent.DELETED and path in self.monitors:
+			self.monitors.pop(path).cancel()
+		self.scheduleChange()
+
+	def scheduleChange(self):
+		# A fetch or rebase writes many refs, wait until they are all written
+		if self.changeTimer != 0:
+			GLib.source_remove(self.changeTimer)
+		self.changeTimer = GLib.timeout_add(GitzConfig.refreshDelay, self.onChangeTimer)
+
+	def onChangeTimer(self):
+		self.changeTimer = 0
+		self.onChange()
+		return False # Cancel changeTimer
+
+
+class CommitGraphFile:
+	# The commit lookup and Bloom filter chunks of a commit-graph file,
+	# see gitformat-commit-graph(5).
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		data = self.data
+		if data[:4] != b'CGPH' or data[4] != 1:
+			raise ValueError('Unknown commit-graph format')
+		self.hashLength = 32 if data[5] == 2 else 20
+		self.chunks = {}
+		for i in range(data[6]):
+			entry = 8 + 12 * i
+			self.chunks[bytes(data[entry:entry + 4])] = int.from_bytes(data[entry + 4:entry + 12], 'big')
+		fanoutStart = self.chunks[b'OIDF']
+		self.fanout = [int.from_bytes(data[fanoutStart + 4 * i:fanoutStart + 4 * i + 4], 'big') for i in range(256)]
+		self.oidStart = self.chunks[b'OIDL']
+		self.commitCount = self.fanout[255]
+		self.hasBloomFilters = b'BIDX' in self.chunks and b'BDAT' in self.chunks
+
+	def contains(self, sha):
+		oid = bytes.fromhex(sha)
+		low = self.fanout[oid[0] - 1] if oid[0] > 0 else 0
+		high = self.fanout[oid[0]]
+		while low < high:
+			mid = (low + high) // 2
+			start = self.oidStart + mid * self.hashLength
+			value = self.data[start:start + self.hashLength]
+			if value < oid:
+				low = mid + 1
+			elif value > oid:
+				high = mid
+			else:
+				return True
+		return False
+
+	def close(self):
+		self.data.close()
+
+def readCommitGraphCoverage(infoDir, tips):
+	# Returns (isSplit, hasBloomFilters, missingTips) of the commit-graph
+	# git reads from infoDir, the single file before a split chain, or
+	# None when there is none.
+	paths = [os.path.join(infoDir, 'commit-graph')]
+	isSplit = not os.path.exists(paths[0])
+	if isSplit:
+		graphsDir = os.path.join(infoDir, 'commit-graphs')
+		try:
+			with open(os.path.join(graphsDir, 'commit-graph-chain')) as f:
+				paths = [os.path.join(graphsDir, 'graph-{}.graph'.format(line.strip())) for line in f if line.strip()]
+		except OSError:
+			return None
+	try:
+		graphs = [CommitGraphFile(path) for path in paths]
+	except (OSError, ValueError, KeyError, IndexError) as e:
+		print('readCommitGraphCoverage', e)
+		return None
+	if len(graphs) == 0:
+		return None
+	hasBloomFilters = all(graph.hasBloomFilters for graph in graphs)
+	missingTips = [sha for sha in tips if not any(graph.contains(sha) for graph in graphs)]
+	for graph in graphs:
+		graph.close()
+	return (isSplit, hasBloomFilters, missingTips)
+
+class CommitGraphSetup:
+	# git log -- path diffs the trees of every commit, unless a
+	# commit-graph with changed-path Bloom filters rules out the commits
+	# that can't touch the path. The first path filtered history of a
+	# session checks that the graph has them and covers the branches, and
+	# offers to write it when it doesn't. Loading the same path filtered
+	# log again reports how much faster it got. Windows show the notice
+	# through listeners(notice), notice is (text, canWrite) or None.
+	def __init__(self, cwdAbs):
+		self.cwdAbs = cwdAbs
+		self.state = None # 'checking', 'ok', 'suggested', 'writing', 'written' or 'failed'
+		self.writeCmd = None
+		self.writeProcess = None
+		self.infoDir = None
+		self.slowLogs = {} # tuple(pathArgs): (seconds, rows) of logs loaded without the graph
+		self.notice = None
+		self.listeners = []
+
+	def setNotice(self, text, canWrite=False):
+		self.notice = (text, canWrite)
+		for listener in list(self.listeners):
+			listener(self.notice)
+
+	def check(self, refIndex):
+		if self.state is not None or GitzConfig.commitGraph == 'off':
+			return
+		self.state = 'checking'
+		tips = set(commitSha for refName, sha, commitSha, commitTime in refIndex.refs if refName.startswith(('refs/heads/', 'refs/remotes/')))
+		if refIndex.tips.get('HEAD', 'HEAD') != 'HEAD': # Unborn
+			tips.add(refIndex.tips['HEAD'])
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'rev-parse',
+			'--git-path',
+			'objects/info',
+		]
+		def onInfoDir(stdout):
+			if stdout.strip() == '':
+				self.state = 'failed' # Not a repository
+				return
+			self.infoDir = os.path.join(self.cwdAbs, stdout.strip())
+			runInThread(readCommitGraphCoverage, (self.infoDir, sorted(tips)), self.onCoverage)
+		gitPool.run(cmd, onInfoDir)
+
+	def onCoverage(self, coverage):
+		if coverage is None:
+			self.setUp('there is no commit-graph', False)
+			return
+		isSplit, hasBloomFilters, missingTips = coverage
+		if not hasBloomFilters:
+			self.setUp('the commit-graph has no changed-path Bloom filters', isSplit)
+			return
+		if len(missingTips) == 0:
+			self.state = 'ok'
+			return
+		# The newest commits of the branches that moved since the graph was
+		# written, the graph only needs writing again when many are missing.
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'rev-list',
+			'--max-count={}'.format(GitzConfig.commitGraphStaleCommits + 1),
+			'--stdin',
+		]
+		def onShas(stdout):
+			runInThread(readCommitGraphCoverage, (self.infoDir, stdout.split()), onNewCommits)
+		def onNewCommits(coverage):
+			if coverage is not None and len(coverage[2]) > GitzConfig.commitGraphStaleCommits:
+				self.setUp('more than {} commits are missing from the commit-graph'.format(GitzConfig.commitGraphStaleCommits), isSplit)
+			else:
+				self.state = 'ok'
+		gitPool.run(cmd, onShas, stdin=''.join(sha + '\n' for sha in missingTips))
+
+	def setUp(self, reason, isSplit):
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'commit-graph',
+			'write',
+			'--reachable',
+			'--changed-paths',
+			'--no-progress',
+		]
+		if isSplit:
+			cmd.append('--split') # Add a layer to the chain the repo already uses
+		tracer.instant('commitGraph', 'git', reason=reason)
+		self.writeCmd = cmd
+		if GitzConfig.commitGraph == 'write':
+			self.write()
+		else:
+			self.state = 'suggested'
+			self.setNotice('Path filtered history is slow because {}. Writing a commit-graph runs: git {}'.format(reason, ' '.join(cmd[3:])), canWrite=True)
+
+	def write(self):
+		if self.writeCmd is None or self.writeProcess is not None:
+			return
+		self.state = 'writing'
+		self.setNotice('Writing a commit-graph with changed-path Bloom filters in the background')
+		self.writeProcess = GitCommand(self.writeCmd, self.onWritten) # Not pooled, it may take minutes
+		self.writeProcess.start()
+
+	def onWritten(self, stdout):
+		self.writeProcess = None
+		def onCoverage(coverage):
+			if coverage is not None and coverage[1]:
+				self.state = 'written'
+				self.setNotice('Wrote the commit-graph, path filtered history loads faster from now on')
+			else:
+				# git printed why on stderr, eg: a git before 2.27 without --changed-paths
+				self.state = 'failed'
+				self.setNotice('Writing the commit-graph failed, run git {} in a terminal to see why'.format(' '.join(self.writeCmd[3:])))
+		runInThread(readCommitGraphCoverage, (self.infoDir, []), onCoverage)
+
+	def onPathLogLoaded(self, pathArgs, seconds, rows):
+		# Called when a path filtered git log streamed to its end. Only
+		# the same log loaded before and after writing the graph compares.
+		key = tuple(pathArgs)
+		if self.state in ('checking', 'suggested', 'writing'):
+			self.slowLogs.setdefault(key, (seconds, rows))
+		elif self.state == 'written' and key in self.slowLogs:
+			slowSeconds, slowRows = self.slowLogs.pop(key)
+			self.setNotice('With the commit-graph, git log -- {} loaded {} rows in {:.0f}ms instead of {:.0f}ms ({:.1f}x faster)'.format(
+				' '.join(pathArgs),
+				rows,
+				seconds * 1000,
+				slowSeconds * 1000,
+				slowSeconds / max(seconds, 0.001),
+			))
+
+
+def readNameStatusWalk(cmd, stdin, knownShas):
+	# Runs git log --name-status -z in a worker thread. Returns (shas,
+	# parentCounts, parents, paths, renames) with the commits numbered in
+	# walk order, paths {path: array of commits} and renames {newPath:
+	# [(commit, oldPath)]}, or None when git failed. parents lists the
+	# parents of each commit in turn, numbered after knownShas.
+	#
+	# With -m a merge is listed once per parent it differs from. Like
+	# git log -- path, a merge touched a path, or a folder of it, when it
+	# differs from every parent there. Folders get an entry for merges.
+	shas = []
+	parentShas = [] # Parent shas of each commit
+	paths = {}
+	renames = {}
+	mergeDiffs = None # Paths and folders of each diff of the current merge
+
+	def addMerge():
+		if mergeDiffs is None or len(mergeDiffs) < len(parentShas[-1]):
+			return # Same as a parent
+		commit = len(shas) - 1
+		for path in sorted(set.intersection(*mergeDiffs)):
+			paths.setdefault(path, array.array('I')).append(commit)
+
+	process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+	process.stdin.write(stdin.encode('utf-8'))
+	process.stdin.close()
+	# Tokens are split by \0: '\x01sha parents' starts a commit, then a
+	# status and its path, or two paths for a rename or copy.
+	status = None
+	pending = []
+	rest = b''
+	while True:
+		block = process.stdout.read(1024 * 1024)
+		parts = (rest + block).split(b'\0')
+		rest = parts.pop() if block else b''
+		for part in parts:
+			token = part.decode('utf-8', 'replace')
+			if token.startswith('\x01'):
+				sha, _, parentText = token[1:].partition(' ')
+				status = None
+				if mergeDiffs is not None and sha == shas[-1]:
+					mergeDiffs.append(set()) # Diff to the next parent
+					continue
+				addMerge()
+				shas.append(sha)
+				parentShas.append(parentText.split())
+				mergeDiffs = [set()] if len(parentShas[-1]) > 1 else None
+			elif status is None:
+				status = token.lstrip('\n')
+				pending = []
+			else:
+				pending.append(token)
+				if status[0] in 'RC' and len(pending) < 2:
+					continue
+				if mergeDiffs is not None:
+					for path in pending[-1:] if status[0] == 'C' else pending:
+						mergeDiffs[-1].add(path)
+						while '/' in path:
+							path = path.rsplit('/', 1)[0]
+							mergeDiffs[-1].add(path)
+					status = None
+					continue
+				commit = len(shas) - 1
+				for path in pending[-1:] if status[0] == 'C' else pending:
+					paths.setdefault(path, array.array('I')).append(commit)
+				if status[0] == 'R':
+					renames.setdefault(pending[1], []).append((commit, pending[0]))
+				status = None
+		if not block:
+			break
+	addMerge()
+	if process.wait() != 0:
+		return None
+
+	# Parents outside the walk were indexed before, or are missing from a
+	# shallow clone and left out.
+	commits = {sha: commit for commit, sha in enumerate(shas, len(knownShas))}
+	missing = set(parentSha for parents in parentShas for parentSha in parents if parentSha not in commits)
+	if missing:
+		for commit, sha in enumerate(knownShas):
+			if sha in missing:
+				commits[sha] = commit
+	parentCounts = array.array('I')
+	parents = array.array('I')
+	for commitParents in parentShas:
+		found = [commits[parentSha] for parentSha in commitParents if parentSha in commits]
+		parentCounts.append(len(found))
+		parents.extend(found)
+	return (shas, parentCounts, parents, paths, renames)
+
+class PathFilter:
+	# The commits a file filter shows, matched against the abbreviated
+	# shas of the history rows.
+	def __init__(self, path, shas):
+		self.path = path
+		self.shas = shas
+		self.prefixes = {} # Length: shas cut to it
+
+	def containsSha(self, sha):
+		prefixes = self.prefixes.get(len(sha))
+		if prefixes is None:
+			prefixes = set(fullSha[:len(sha)] for fullSha in self.shas)
+			self.prefixes[len(sha)] = prefixes
+		return sha in prefixes
+
+class PathCommitIndex:
+	# The commits that touched each path, from one git log --name-status
+	# walk of every ref. It is kept under XDG_CACHE_HOME and only the
+	# commits of new refs are walked when the refs move. Renames are kept
+	# so a file's history continues with its earlier names, like --follow,
+	# in the commits each rename descends from. The file is a JSON line
+	# per walk, each one is appended and applies to the refs of the one
+	# before. After maxWalks it is rewritten as a single walk.
+	version = 4
+	maxWalks = 16
+
+	def __init__(self, session):
+		self.session = session
+		self.revs = None # The refs the index covers, None until it is loaded
+		self.shas = []
+		self.parentStarts = array.array('I', [0]) # Where the parents of each commit start in parents
+		self.parents = array.array('I') # Parent commits, renames are followed into their ancestors
+		self.paths = {} # path: array of commits
+		self.renames = {} # newPath: [(commit, oldPath)]
+		self.sortedPaths = None
+		self.walkCount = None # Walks in the file, None when it has to be rewritten
+		self.loadStartTime = None
+		self.loading = False
+		self.waiters = []
+
+	def isReady(self):
+		return self.revs is not None
+
+	def getRevsKey(self, revs):
+		if revs is None:
+			return None
+		return hashlib.sha1('\n'.join(revs).encode('utf-8')).hexdigest()[:16]
+
+	def getFilePath(self):
+		key = hashlib.sha1(self.session.topLevel.encode('utf-8')).hexdigest()[:16]
+		return os.path.join(getCacheDir(), 'paths', key + '.json')
+
+	#--- Load
+	def load(self, onReady=None):
+		# Brings the index up to the current refs, then calls onReady()
+		if onReady is not None:
+			self.waiters.append(onReady)
+		if self.loading:
+			return
+		self.loading = True
+		self.loadStartTime = time.monotonic()
+		self.session.loadTopLevel(self.onTopLevel)
+
+	def onTopLevel(self):
+		if self.session.topLevel is None:
+			self.finishLoad() # Not a repository or a bare one
+			return
+		self.session.loadRefSnapshot(['--all'], self.onRefIndex)
+
+	def onRefIndex(self, refIndex):
+		if self.revs is None:
+			runInThread(self.readFile, (self.getFilePath(),), lambda data: self.onFileRead(data, refIndex))
+		else:
+			self.walk(refIndex.revs)
+
+	def onFileRead(self, data, refIndex):
+		if data is not None and self.revs is None:
+			walks, complete = data
+			self.walkCount = len(walks) if complete else None
+			for baseKey, walk in walks:
+				if baseKey != self.getRevsKey(self.revs):
+					self.walkCount = None # Appended by another gitz from other refs
+					break
+				self.merge(*walk)
+		self.walk(refIndex.revs)
+
+	def walk(self, revs):
+		if revs == self.revs:
+			self.finishLoad()
+			return
+		cmd = [
+			'git',
+			'-C',
+			self.session.topLevel, # Paths relative to the top even with diff.relative
+			'log',
+			'--name-status',
+			'-m', # Diff merges to each parent
+			'-M',
+			'-z',
+			'--format=%x01%H %P',
+			'--stdin',
+			'--ignore-missing',
+		]
+		stdin = ''.join(rev + '\n' for rev in revs)
+		if self.revs is not None:
+			stdin += ''.join('^' + rev + '\n' for rev in self.revs)
+		def onWalk(result):
+			if result is not None:
+				baseKey = self.getRevsKey(self.revs)
+				self.merge(revs, *result)
+				self.save(baseKey, (revs,) + result)
+			self.finishLoad()
+		runInThread(readNameStatusWalk, (cmd, stdin, self.shas), onWalk)
+
+	def merge(self, revs, shas, parentCounts, parents, paths, renames):
+		# Commits of the walk go after the indexed ones. Arrays are replaced
+		# instead of extended so a save in progress sees a consistent index.
+		offset = len(self.shas)
+		self.shas = self.shas + shas
+		parentStarts = array.array('I')
+		parentEnd = self.parentStarts[-1]
+		for count in parentCounts:
+			parentEnd += count
+			parentStarts.append(parentEnd)
+		self.parentStarts = self.parentStarts + parentStarts
+		self.parents = self.parents + parents
+		if offset == 0:
+			self.paths = paths
+			self.renames = renames
+		else:
+			for path, commits in paths.items():
+				self.paths[path] = self.paths.get(path, array.array('I')) + array.array('I', [commit + offset for commit in commits])
+			for newPath, edges in renames.items():
+				self.renames[newPath] = self.renames.get(newPath, []) + [(commit + offset, oldPath) for commit, oldPath in edges]
+		self.revs = revs
+		self.sortedPaths = None
+		log('PathCommitIndex: {} commits, {} paths in {:.3f}s'.format(len(self.shas), len(self.paths), time.monotonic() - self.loadStartTime))
+
+	def finishLoad(self):
+		self.loading = False
+		waiters = self.waiters
+		self.waiters = []
+		for waiter in waiters:
+			waiter()
+
+	#--- Disk
+	def readFile(self, filePath):
+		# ([(baseKey, walk)], complete) with the arguments of merge for
+		# each walk, None without a file
+		walks = []
+		complete = True
+		try:
+			with open(filePath, encoding='utf-8') as f:
+				header = json.loads(f.readline())
+				if header.get('version') != self.version:
+					return None
+				for line in f:
+					try:
+						data = json.loads(line)
+					except ValueError:
+						complete = False # Cut off while it was appended
+						break
+					paths = {path: array.array('I', commits) for path, commits in data['paths'].items()}
+					renames = {newPath: [tuple(edge) for edge in edges] for newPath, edges in data['renames'].items()}
+					walk = (data['revs'], data['shas'], array.array('I', data['parentCounts']), array.array('I', data['parents']), paths, renames)
+					walks.append((data['base'], walk))
+		except (OSError, ValueError, KeyError):
+			return None
+		return (walks, complete)
+
+	def save(self, baseKey, walk):
+		# Appends walk, or rewrites the file with the whole index
+		filePath = self.getFilePath()
+		rewrite = self.walkCount is None or self.walkCount >= self.maxWalks
+		if rewrite:
+			baseKey = None
+			walk = (self.revs, self.shas, self.parentStarts, self.parents, dict(self.paths), dict(self.renames))
+			self.walkCount = 1
+		else:
+			self.walkCount += 1
+		def write():
+			revs, shas, parentCounts, parents, paths, renames = walk
+			if rewrite:
+				parentStarts = parentCounts
+				parentCounts = [parentStarts[i + 1] - parentStarts[i] for i in range(len(shas))]
+			else:
+				parentCounts = parentCounts.tolist()
+			data = {
+				'base': baseKey,
+				'revs': revs,
+				'shas': shas,
+				'parentCounts': parentCounts,
+				'parents': parents.tolist(),
+				'paths': {path: commits.tolist() for path, commits in paths.items()},
+				'renames': renames,
+			}
+			try:
+				os.makedirs(os.path.dirname(filePath), exist_ok=True)
+				if rewrite:
+					tmpPath = filePath + '.tmp'
+					with open(tmpPath, 'w', encoding='utf-8') as f:
+						f.write(json.dumps({'version': self.version}) + '\n')
+						f.write(json.dumps(data) + '\n')
+					os.replace(tmpPath, filePath)
+				else:
+					with open(filePath, 'a', encoding='utf-8') as f:
+						f.write(json.dumps(data) + '\n')
+			except OSError as e:
+				print('PathCommitIndex.save', e)
+		threading.Thread(target=write, daemon=True).start()
+
+	#--- Filter
+	def getFilter(self, fileFilter, dirPath):
+		# A PathFilter when the index can tell the commits of fileFilter
+		if not self.isReady():
+			return None
+		path = self.session.toRepoPath(fileFilter)
+		if not path:
+			return None
+		if dirPath is not None:
+			# The history of dirPath is filtered further, not replaced
+			dirRepoPath = self.session.toRepoPath(dirPath)
+			if dirRepoPath is None or (dirRepoPath != '' and path != dirRepoPath and not path.startswith(dirRepoPath + '/')):
+				return None
+		return PathFilter(fileFilter, self.getShas(path, GitzConfig.followRenames))
+
+	def getShas(self, path, follow):
+		# Commits that touched path or a path in that folder. A file's
+		# history continues with its earlier names when follow is set.
+		commits = set(self.paths.get(path, ()))
+		folderPaths = self.getPathsIn(path)
+		for folderPath in folderPaths:
+			commits.update(self.paths[folderPath])
+		if follow and len(folderPaths) == 0:
+			self.followRenames(path, None, commits, set())
+		return set(self.shas[commit] for commit in commits)
+
+	def followRenames(self, path, ancestors, commits, seen):
+		# The commits of the earlier name that each rename descends from.
+		# ancestors limits the renames to those of an outer rename.
+		for renameCommit, oldPath in self.renames.get(path, ()):
+			if (ancestors is not None and renameCommit not in ancestors) or (renameCommit, oldPath) in seen:
+				continue
+			seen.add((renameCommit, oldPath))
+			renameAncestors = self.getAncestors(renameCommit)
+			commits.update(commit for commit in self.paths.get(oldPath, ()) if commit in renameAncestors)
+			self.followRenames(oldPath, renameAncestors, commits, seen)
+
+	def getAncestors(self, commit):
+		# commit and every commit it descends from
+		parentStarts = self.parentStarts
+		parents = self.parents
+		ancestors = {commit}
+		stack = [commit]
+		while stack:
+			commit = stack.pop()
+			for parent in parents[parentStarts[commit]:parentStarts[commit + 1]]:
+				if parent not in ancestors:
+					ancestors.add(parent)
+					stack.append(parent)
+		return ancestors
+
+	def getPathsIn(self, folder):
+		if self.sortedPaths is None:
+			self.sortedPaths = sorted(self.paths)
+		prefix = folder + '/'
+		start = bisect.bisect_left(self.sortedPaths, prefix)
+		end = bisect.bisect_left(self.sortedPaths, folder + '0') # '0' follows '/'
+		return self.sortedPaths[start:end]
+
+
+#--- Blame
+HUNK_PATTERN = re.compile(r'^@@+ (?:-\d+(?:,\d+)? )+\+(\d+)(?:,(\d+))? @@')
+UNIFIED_HUNK_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@', re.MULTILINE)
+
+def parseHunks(diffStdout):
+	# (oldStart, oldCount, newStart, newCount) of each hunk of a diff -U0
+	return [
+		(int(oldStart), 1 if oldCount == '' else int(oldCount), int(newStart), 1 if newCount == '' else int(newCount))
+		for oldStart, oldCount, newStart, newCount in UNIFIED_HUNK_PATTERN.findall(diffStdout)
+	]
+
+def getUnchangedRuns(hunks, newLineCount):
+	# (oldLine, newLine, count) runs of lines the hunks left unchanged.
+	# A hunk without old lines starts after oldStart, not at it.
+	runs = []
+	old = 0
+	new = 0
+	for oldStart, oldCount, newStart, newCount in hunks:
+		oldFirst = oldStart - 1 if oldCount > 0 else oldStart
+		newFirst = newStart - 1 if newCount > 0 else newStart
+		if oldFirst > old:
+			runs.append((old, new, oldFirst - old))
+		old = oldFirst + oldCount
+		new = newFirst + newCount
+	if newLineCount > new:
+		runs.append((old, new, newLineCount - new))
+	return runs
+
+def getParentLine(runs, line):
+	# Where line of the new file is in the old one, after the unchanged
+	# run before it when the commit changed it
+	parentLine = 0
+	for oldLine, newLine, count in runs:
+		if line < newLine:
+			break
+		parentLine = oldLine + min(line - newLine, count)
+	return parentLine
+
+class BlameCommit:
+	# A commit git blame --incremental attributed lines to
+	def __init__(self, sha):
+		self.sha = sha
+		self.author = ''
+		self.authorTime = 0
+		self.summary = ''
+		self.boundary = False # Blame stopped here, the lines may be older
+		self.previous = None # (sha, path) of the file before this commit
+
+class Blame:
+	# Which commit last changed each line of path at rev. Lines are
+	# attributed while git blame streams, listeners(rows) hear of each
+	# (first, last) range of lines attributed, or None once the text of
+	# the file arrived.
+	def __init__(self, path, rev):
+		self.path = path # Relative to the top of the repository
+		self.rev = rev # Full sha
+		self.lines = None # Text of each line, None until read
+		self.lineCommits = [] # BlameCommit of each line, None until attributed
+		self.commits = {} # sha: BlameCommit
+		self.blamedCount = 0
+		self.done = False
+		self.error = None
+		self.listeners = []
+		self.stream = None
+		self.group = None # (commit, firstLine, lineCount) of the header being read
+
+	def notify(self, rows):
+		for listener in list(self.listeners):
+			listener(rows)
+
+	def setLines(self, lines):
+		self.lines = lines
+		if len(self.lineCommits) < len(lines):
+			self.lineCommits += [None] * (len(lines) - len(self.lineCommits))
+		self.notify(None)
+
+	def setCommit(self, first, count, commit):
+		lineCommits = self.lineCommits
+		if len(lineCommits) < first + count:
+			lineCommits += [None] * (first + count - len(lineCommits))
+		for line in range(first, first + count):
+			if lineCommits[line] is None:
+				self.blamedCount += 1
+			lineCommits[line] = commit
+
+	def onBlameLines(self, lines):
+		# "sha sourceLine resultLine count" starts a group of lines, the
+		# commit's headers follow the first time it is named, then
+		# "filename path" ends the group.
+		first = -1
+		last = -1
+		for line in lines:
+			if self.group is None:
+				fields = line.split(' ')
+				if len(fields) != 4:
+					continue
+				commit = self.commits.get(fields[0])
+				if commit is None:
+					commit = BlameCommit(fields[0])
+					self.commits[fields[0]] = commit
+				self.group = (commit, int(fields[2]) - 1, int(fields[3]))
+				continue
+			key, _, value = line.partition(' ')
+			commit = self.group[0]
+			if key == 'filename':
+				commit, groupFirst, count = self.group
+				self.group = None
+				self.setCommit(groupFirst, count, commit)
+				first = groupFirst if first == -1 else min(first, groupFirst)
+				last = max(last, groupFirst + count)
+			elif key == 'author':
+				commit.author = value
+			elif key == 'author-time':
+				commit.authorTime = int(value)
+			elif key == 'summary':
+				commit.summary = value
+			elif key == 'boundary':
+				commit.boundary = True
+			elif key == 'previous':
+				sha, _, path = value.partition(' ')
+				commit.previous = (sha, unquotePath(path))
+		if first != -1 and self.lines is not None:
+			self.notify((first, min(last, len(self.lines))))
+
+	def onBlameDone(self):
+		self.stream = None
+		self.done = True
+		self.notify((0, 0))
+
+	def cancel(self):
+		if self.stream is not None:
+			self.stream.cancel()
+			self.stream = None
+
+class BlameCache:
+	# Blames of the repository by (path, rev), the most recently used
+	# are kept. Blaming the parent revision of a blame starts from the
+	# lines the commit left unchanged, which keep their commit, and git
+	# blame -L only runs on the lines the commit changed.
+	def __init__(self, session):
+		self.session = session
+		self.entries = collections.OrderedDict() # (path, rev): Blame, least recently used first
+
+	def get(self, path, rev):
+		blame = self.entries.get((path, rev))
+		if blame is None:
+			tracer.instant('blameCache miss', 'cache', path=path, rev=rev)
+			return None
+		tracer.instant('blameCache hit', 'cache', path=path, rev=rev)
+		self.entries.move_to_end((path, rev))
+		return blame
+
+	def put(self, blame):
+		self.entries[(blame.path, blame.rev)] = blame
+		while len(self.entries) > GitzConfig.blameCacheEntries:
+			key, oldBlame = self.entries.popitem(last=False)
+			if len(oldBlame.listeners) == 0:
+				oldBlame.cancel()
+
+	def cancel(self):
+		for blame in self.entries.values():
+			blame.cancel()
+		self.entries.clear()
+
+	def createError(self, path, rev, error):
+		blame = Blame(path, rev)
+		blame.error = error
+		blame.done = True
+		blame.lines = []
+		return blame
+
+	#--- Load
+	def load(self, path, rev, onBlame):
+		# Calls onBlame(blame) with the blame of path, relative to the top
+		# of the repository, once rev is resolved. Its lines fill in later.
+		def onResolved(stdout):
+			# "sha type size" of rev^{commit} then of rev:path
+			lines = stdout.split('\n')
+			commitFields = lines[0].split(' ')
+			if commitFields[1:2] != ['commit']:
+				onBlame(self.createError(path, rev, '{} is not a commit'.format(rev)))
+				return
+			sha = commitFields[0]
+			blame = self.get(path, sha)
+			if blame is None:
+				fileFields = lines[1].split(' ') if len(lines) > 1 else []
+				if fileFields[1:2] != ['blob']:
+					onBlame(self.createError(path, sha, 'not a file in this commit'))
+					return
+				blame = Blame(path, sha)
+				self.put(blame)
+				self.start(blame, None)
+			onBlame(blame)
+		def onTopLevel():
+			if self.session.topLevel is None:
+				onBlame(self.createError(path, rev, 'not in a work tree'))
+				return
+			cmd = [
+				'git',
+				'-C',
+				self.session.cwdAbs,
+				'cat-file',
+				'--batch-check',
+			]
+			gitPool.run(cmd, onResolved, stdin='{}^{{commit}}\n{}:{}\n'.format(rev, rev, path))
+		self.session.loadTopLevel(onTopLevel)
+
+	def start(self, blame, ranges):
+		# Reads the file and runs git blame on the (first, end) ranges of
+		# lines, every line when ranges is None.
+		def onText(text):
+			lines = text.split('\n')
+			if lines[-1] == '':
+				lines.pop()
+			blame.setLines(lines)
+		cmd = [
+			'git',
+			'-C',
+			self.session.cwdAbs,
+			'cat-file',
+			'-p',
+			'{}:{}'.format(blame.rev, blame.path),
+		]
+		gitPool.run(cmd, onText)
+		if ranges is not None and len(ranges) == 0:
+			blame.done = True # Every line was known
+			return
+		cmd = [
+			'git',
+			'-C',
+			self.session.topLevel, # path is relative to the top
+			'blame',
+			'--incremental',
+			'--diff-algorithm=myers', # The same lines as the parent diff
+		]
+		for first, end in ranges or ():
+			cmd += ['-L', '{},{}'.format(first + 1, end)]
+		cmd += [
+			blame.rev,
+			'--',
+			blame.path,
+		]
+		blame.stream = GitStream(cmd, blame.onBlameLines, blame.onBlameDone)
+		blame.stream.start()
+
+	def loadParent(self, blame, line, onBlame):
+		# Calls onBlame(parentBlame, parentLine) with the blame of the file
+		# in the first parent of blame.rev, and where line moved to.
+		def onParent(stdout):
+			parent = stdout.strip()
+			if parent == '':
+				onBlame(self.createError(blame.path, blame.rev, 'the first commit has no parent'), 0)
+				return
+			# The file may have been renamed by the commit
+			cmd = [
+				'git',
+				'-C',
+				self.session.cwdAbs,
+				'diff-tree',
+				'-r',
+				'-M',
+				'-z',
+				'--name-status',
+				parent,
+				blame.rev,
+			]
+			gitPool.run(cmd, lambda stdout: onChanges(parent, stdout))
+
+		def onChanges(parent, stdout):
+			status = None
+			oldPath = blame.path
+			tokens = stdout.split('\0')
+			i = 0
+			while i + 1 < len(tokens):
+				pathCount = 2 if tokens[i][:1] in ('R', 'C') else 1
+				paths = tokens[i + 1:i + 1 + pathCount]
+				if paths[-1] == blame.path:
+					status = tokens[i][:1]
+					oldPath = paths[0]
+					break
+				i += 1 + pathCount
+			if status == 'A':
+				onBlame(self.createError(blame.path, parent, 'the file was added by {}'.format(blame.rev[:8])), 0)
+				return
+			if status is None:
+				onHunks(parent, oldPath, []) # Unchanged, every line is known
+			else:
+				cmd = [
+					'git',
+					'-C',
+					self.session.cwdAbs,
+					'diff',
+					'-U0',
+					'--no-color',
+					'--no-ext-diff',
+					'--diff-algorithm=myers',
+					'{}:{}'.format(parent, oldPath),
+					'{}:{}'.format(blame.rev, blame.path),
+				]
+				gitPool.run(cmd, lambda stdout: onHunks(parent, oldPath, parseHunks(stdout)))
+
+		def onHunks(parent, oldPath, hunks):
+			# A cached parent blame is reused, the line still moves
+			parentLine = getParentLine(getUnchangedRuns(hunks, line + 1), line)
+			cached = self.get(oldPath, parent)
+			if cached is not None:
+				onBlame(cached, parentLine)
+			else:
+				derive(parent, oldPath, hunks, parentLine)
+
+		def derive(parent, oldPath, hunks, parentLine):
+			parentBlame = Blame(oldPath, parent)
+			self.put(parentBlame)
+			if not blame.done or blame.lines is None or blame.error is not None:
+				self.start(parentBlame, None)
+				onBlame(parentBlame, parentLine)
+				return
+			runs = getUnchangedRuns(hunks, len(blame.lines))
+			parentLineCount = len(blame.lines) + sum(oldCount - newCount for oldStart, oldCount, newStart, newCount in hunks)
+			lineCommits = [None] * parentLineCount
+			for oldLine, newLine, count in runs:
+				lineCommits[oldLine:oldLine + count] = blame.lineCommits[newLine:newLine + count]
+			parentBlame.lineCommits = lineCommits
+			parentBlame.commits = dict(blame.commits)
+			parentBlame.blamedCount = parentLineCount - lineCommits.count(None)
+			ranges = []
+			for i, commit in enumerate(lineCommits):
+				if commit is not None:
+					continue
+				if len(ranges) > 0 and ranges[-1][1] == i:
+					ranges[-1] = (ranges[-1][0], i + 1)
+				else:
+					ranges.append((i, i + 1))
+			tracer.instant('blame parent', 'blame', lines=parentLineCount, reused=parentBlame.blamedCount, ranges=len(ranges))
+			self.start(parentBlame, ranges if len(ranges) <= GitzConfig.blameMaxRanges else None)
+			onBlame(parentBlame, parentLine)
+
+		cmd = [
+			'git',
+			'-C',
+			self.session.cwdAbs,
+			'rev-parse',
+			'--verify',
+			'-q',
+			blame.rev + '^',
+		]
+		gitPool.run(cmd, onParent)
+
+
+class RepoSession:
+	# The backend and caches of one working directory, shared by the
+	# windows open on it. A resident App keeps the sessions of recently
+	# used repos, so another window starts from their loaded history,
+	# refs and commits.
+	def __init__(self, cwdAbs):
+		self.cwdAbs = cwdAbs
+		self.backend = createRepoBackend(cwdAbs)
+		self.historyCache = HistoryDiskCache(cwdAbs)
+		self.commitCache = CommitCache(GitzConfig.commitCacheEntries, GitzConfig.commitCacheBytes)
+		self.commitGraphSetup = CommitGraphSetup(cwdAbs)
+		self.pathCommitIndex = PathCommitIndex(self)
+		self.blameCache = BlameCache(self)
+		self.topLevel = None # None until loadTopLevel, and for a bare repository
+		self.prefix = None # cwd relative to topLevel
+		self.topLevelWaiters = None # Waiting for rev-parse
+		self.refIndexes = {} # tuple(revisionArgs): RefIndex, while the watcher sees no ref change
+		self.refLoads = {} # tuple(revisionArgs): (refsVersion, waiters) being read
+		self.refsVersion = 0
+		self.watcher = None
+		self.refsListeners = []
+		self.windowCount = 0
+
+	def loadRefSnapshot(self, revisionArgs, onDone):
+		# Like GitBackend.loadRefSnapshot. Snapshots are reused until the
+		# watcher reports a change, without it every call reads the refs.
+		key = tuple(revisionArgs)
+		refIndex = self.refIndexes.get(key)
+		if refIndex is not None and self.watcher.isSettled():
+			tracer.instant('refIndex hit', 'cache', revisionArgs=revisionArgs)
+			def deliver():
+				onDone(refIndex)
+				return False
+			GLib.idle_add(deliver) # Later, like a backend load
+			return
+		settled = self.watcher is not None and self.watcher.isSettled()
+		refsVersion = self.refsVersion
+		load = self.refLoads.get(key)
+		if settled and load is not None and load[0] == refsVersion:
+			load[1].append(onDone) # Another window is reading the same refs
+			return
+		waiters = [onDone]
+		if settled:
+			self.refLoads[key] = (refsVersion, waiters)
+		def onRefIndex(refIndex):
+			if settled and self.refLoads.get(key, (None, None))[1] is waiters:
+				del self.refLoads[key]
+			if settled and refsVersion == self.refsVersion and self.watcher is not None and self.watcher.isSettled():
+				self.refIndexes[key] = refIndex
+			for waiter in waiters:
+				waiter(refIndex)
+		self.backend.loadRefSnapshot(revisionArgs, onRefIndex)
+
+	def loadTopLevel(self, onDone):
+		# Calls onDone() once topLevel and prefix are known
+		if self.topLevel is not None:
+			onDone()
+			return
+		if self.topLevelWaiters is not None:
+			self.topLevelWaiters.append(onDone)
+			return
+		self.topLevelWaiters = [onDone]
+		def onTopLevel(stdout):
+			lines = stdout.split('\n')
+			if len(lines) >= 2 and lines[0] != '':
+				self.topLevel = lines[0]
+				self.prefix = lines[1]
+			waiters = self.topLevelWaiters
+			self.topLevelWaiters = None
+			for waiter in waiters:
+				waiter()
+		cmd = [
+			'git',
+			'-C',
+			self.cwdAbs,
+			'rev-parse',
+			'--show-toplevel',
+			'--show-prefix',
+		]
+		gitPool.run(cmd, onTopLevel)
+
+	def toRepoPath(self, path):
+		# A path relative to cwd or absolute, relative to the top level.
+		# '' for the top level, None outside of it or for a glob.
+		if path.startswith(':') or any(c in path for c in '*?['):
+			return None
+		if os.path.isabs(path):
+			repoPath = os.path.relpath(path, self.topLevel)
+		else:
+			repoPath = os.path.normpath(os.path.join(self.prefix, path))
+		if repoPath == '..' or repoPath.startswith('..' + os.sep):
+			return None
+		return '' if repoPath == '.' else repoPath.replace(os.sep, '/')
+
+	def watchRefs(self, onChange):
+		self.refsListeners.append(onChange)
+		if self.watcher is None and GitzConfig.autoRefresh:
+			self.watcher = RepoWatcher(self.cwdAbs, self.onRefsChanged)
+			self.watcher.start()
+
+	def unwatchRefs(self, onChange):
+		if onChange in self.refsListeners:
+			self.refsListeners.remove(onChange)
+
+	def onRefsChanged(self):
+		self.refIndexes = {}
+		self.refLoads = {}
+		self.refsVersion += 1
+		for onChange in list(self.refsListeners):
+			onChange()
+
+	def close(self):
+		if self.watcher is not None:
+			self.watcher.stop()
+			self.watcher = None
+		self.refIndexes = {}
+		self.blameCache.cancel()
+
+repoSessions = collections.OrderedDict() # cwdAbs: RepoSession, least recently used first
+
+def getRepoSession(cwdAbs):
+	session = repoSessions.pop(cwdAbs, None)
+	if session is None:
+		session = RepoSession(cwdAbs)
+	repoSessions[cwdAbs] = session
+	# Forget the oldest sessions without a window
+	idleSessions = [other for other in repoSessions.values() if other.windowCount == 0 and other is not session]
+	while len(repoSessions) > GitzConfig.residentRepos and len(idleSessions) > 0:
+		other = idleSessions.pop(0)
+		other.close()
+		del repoSessions[other.cwdAbs]
+	return session
+
+
+def parseGraphRecord(line):
+	# Native graph rows are "sha parents...\0text"
+	end = line.find('\x00')
+	shas = line[:end].split()
+	return shas[0], tuple(shas[1:])
+
+def firstFreeLane(lanes):
+	try:
+		return lanes.index(None)
+	except ValueError:
+		lanes.append(None)
+		return len(lanes) - 1
+
+class CommitGraph:
+	# Lane layout for the native history graph, computed from the parents
+	# of each commit instead of parsing git log --graph. Rows are laid out
+	# lazily. The lanes are checkpointed every checkpointInterval rows so
+	# any window of rows can be replayed from the closest checkpoint.
+	checkpointInterval = 256
+	geometryCacheSize = 4096
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.shas = []
+		self.parents = []
+		self.checkpoints = [()] # Lanes before row i * checkpointInterval
+		self.geometryCache = {}
+
+	def __len__(self):
+		return len(self.shas)
+
+	def append(self, records):
+		for sha, parents in records:
+			self.shas.append(sha)
+			self.parents.append(parents)
+
+	def splice(self, index, removeCount, records):
+		self.shas[index:index + removeCount] = [sha for sha, parents in records]
+		self.parents[index:index + removeCount] = [parents for sha, parents in records]
+		self.invalidate(index)
+
+	def invalidate(self, row):
+		del self.checkpoints[row // self.checkpointInterval + 1:]
+		self.geometryCache.clear()
+
+	def layoutRow(self, lanes, row):
+		# Returns (column, lanesAfter, edges). lanes holds the sha each
+		# column is waiting for. Edges are (fromColumn, fromY, toColumn, toY, colorColumn)
+		# with y going from 0 (top of the row) to 1 (bottom of the row).
+		sha = self.shas[row]
+		edges = []
+		column = -1
+		for i, laneSha in enumerate(lanes):
+			if laneSha is None:
+				continue
+			if laneSha == sha:
+				if column == -1:
+					column = i
+				edges.append((i, 0.0, column, 0.5, i))
+			else:
+				edges.append((i, 0.0, i, 1.0, i))
+
+		lanesAfter = [None if laneSha == sha else laneSha for laneSha in lanes]
+		if column == -1:
+			column = firstFreeLane(lanesAfter)
+		for i, parentSha in enumerate(self.parents[row]):
+			if parentSha in lanesAfter:
+				parentColumn = lanesAfter.index(parentSha)
+			elif i == 0 and lanesAfter[column] is None:
+				parentColumn = column
+			else:
+				parentColumn = firstFreeLane(lanesAfter)
+			lanesAfter[parentColumn] = parentSha
+			edges.append((column, 0.5, parentColumn, 1.0, parentColumn))
+		while len(lanesAfter) >= 1 and lanesAfter[-1] is None:
+			lanesAfter.pop()
+		return column, lanesAfter, edges
+
+	def getLanesBefore(self, row):
+		interval = self.checkpointInterval
+		checkpoint = min(row // interval, len(self.checkpoints) - 1)
+		lanes = list(self.checkpoints[checkpoint])
+		for r in range(checkpoint * interval, row):
+			column, lanes, edges = self.layoutRow(lanes, r)
+			if (r + 1) % interval == 0 and (r + 1) // interval == len(self.checkpoints):
+				self.checkpoints.append(tuple(lanes))
+		return lanes
+
+	def advance(self, budget):
+		# Extends the checkpoints in the background so that jumping deep
+		# into the history does not have to replay it from the top.
+		# Returns True once every row has been laid out.
+		deadline = time.time() + budget
+		interval = self.checkpointInterval
+		while time.time() < deadline:
+			nextRow = len(self.checkpoints) * interval
+			if nextRow > len(self.shas):
+				return True
+			self.getLanesBefore(nextRow)
+		return False
+
+	def getRows(self, first, last):
+		# Returns (column, edges, laneCount) for each row in [first, last]
+		last = min(last, len(self.shas) - 1)
+		if first > last:
+			return []
+		lanes = self.getLanesBefore(first)
+		rows = []
+		for row in range(first, last + 1):
+			laneCount = len(lanes)
+			column, lanes, edges = self.layoutRow(lanes, row)
+			geometry = (column, edges, max(laneCount, len(lanes), column + 1))
+			rows.append(geometry)
+			if len(self.geometryCache) < self.geometryCacheSize:
+				self.geometryCache[row] = geometry
+		return rows
+
+	def getRow(self, row):
+		geometry = self.geometryCache.get(row)
+		if geometry is None:
+			if len(self.geometryCache) >= self.geometryCacheSize:
+				self.geometryCache.clear()
+			rows = self.getRows(max(0, row - 16), row + 64)
+			geometry = self.geometryCache.get(row, rows[0] if len(rows) >= 1 else None)
+		return geometry
+
+
+GRAPH_COLORS = [rgba(c) for c in [
+	'#1abc9c', # Normal
+	'#dfaf8f', # Orange
+	'#93e0e3', # Cyan
+	'#72d5a3', # Green
+	'#f0dfaf', # Yellow
+	'#dca3a3', # Red
+	'#c695c6', # Purple
+	'#a6acb9', # Light Gray
+]]
+
+def drawGraphRow(cr, geometry, x, y, height):
+	column, edges, laneCount = geometry
+	laneWidth = GitzConfig.graphLaneWidth
+	cr.set_line_width(2)
+	for fromColumn, fromY, toColumn, toY, colorColumn in edges:
+		Gdk.cairo_set_source_rgba(cr, GRAPH_COLORS[colorColumn % len(GRAPH_COLORS)])
+		x1 = x + (fromColumn + 0.5) * laneWidth
+		y1 = y + fromY * height
+		x2 = x + (toColumn + 0.5) * laneWidth
+		y2 = y + toY * height
+		cr.move_to(x1, y1)
+		if fromColumn == toColumn:
+			cr.line_to(x2, y2)
+		else:
+			midY = (y1 + y2) / 2
+			cr.curve_to(x1, midY, x2, midY, x2, y2)
+		cr.stroke()
+
+	Gdk.cairo_set_source_rgba(cr, GRAPH_COLORS[column % len(GRAPH_COLORS)])
+	cr.arc(x + (column + 0.5) * laneWidth, y + height / 2, laneWidth / 4, 0, 2 * math.pi)
+	cr.fill()
+
+def getGraphWidth(laneCount):
+	return min(laneCount, GitzConfig.graphMaxLanes) * GitzConfig.graphLaneWidth
+
+
+#---
+class Bitset:
+	# Compact set of non-negative ints, one bit each
+	def __init__(self):
+		self.bits = bytearray()
+
+	def __contains__(self, i):
+		byte = i >> 3
+		return byte < len(self.bits) and (self.bits[byte] >> (i & 7)) & 1 == 1
+
+	def add(self, i):
+		byte = i >> 3
+		if byte >= len(self.bits):
+			self.bits.extend(bytes(byte - len(self.bits) + 1024))
+		self.bits[byte] |= 1 << (i & 7)
+
+	def clear(self):
+		self.bits = bytearray()
+
+	def discardFrom(self, i):
+		# Removes every item >= i
+		byte = i >> 3
+		if byte < len(self.bits):
+			self.bits[byte] &= (1 << (i & 7)) - 1
+			del self.bits[byte + 1:]
+
+
+class LineSpans:
+	# Tag spans of a text grouped by line. Columns are relative to the start
+	# of their line so a block of lines can be moved without touching them.
+	def __init__(self):
+		self.lines = {}
+		self.count = 0
+
+	def __len__(self):
+		return self.count
+
+	def add(self, line, tagName, start, end):
+		self.lines.setdefault(line, []).append((tagName, start, end))
+		self.count += 1
+
+	def getLine(self, line):
+		return self.lines.get(line, ())
+
+	def hasLine(self, line):
+		return line in self.lines
+
+
+class DiffTokenizer:
+	# Classifies the lines of `git show --patch-with-stat` output in a single
+	# pass. Lines can be fed in batches as they stream in, like GitStream's
+	# onLines. The state only changes on a line's first characters:
+	#   header: from 'commit ' up to the '---' line or the first 'diff ' line
+	#   stat: the diffstat after '---'
+	#   diffheader: from 'diff ' up to the '---' or '+++' line
+	#   diff: the hunks
+	def __init__(self):
+		self.lineSpans = LineSpans()
+		self.line = 0
+		self.state = None
+
+	def feed(self, lines):
+		add = self.lineSpans.add
+		for text in lines:
+			line = self.line
+			end = len(text)
+			state = self.state
+			if state is None:
+				state = 'header' if text.startswith('commit ') else 'diff'
+
+			if text.startswith('diff '):
+				state = 'diffheader'
+				add(line, 'diffheader', 0, end)
+			elif state == 'diff':
+				if text.startswith('-'):
+					add(line, 'oldline', 0, end)
+				elif text.startswith('+'):
+					add(line, 'newline', 0, end)
+				elif text.startswith('@@') and end > 2:
+					add(line, 'hunkheader', 0, end)
+			elif state == 'diffheader':
+				if text.startswith('---'):
+					state = 'diff'
+					add(line, 'oldline', 0, end)
+				elif text.startswith('+++'):
+					state = 'diff'
+					add(line, 'newline', 0, end)
+				else:
+					add(line, 'diffheader', 0, end)
+			elif state == 'header':
+				if text == '---':
+					state = 'stat'
+				add(line, 'hunkheader', 0, end)
+			else: # stat
+				add(line, 'commitstat', 0, end)
+				match = STATFILE_PATTERN.match(text)
+				if match is not None:
+					add(line, 'statfilename', match.start(1), match.end(1))
+					if match.start(3) != match.end(3):
+						add(line, 'newline', match.start(3), match.end(3))
+					if match.start(4) != match.end(4):
+						add(line, 'oldline', match.start(4), match.end(4))
+
+			self.state = state
+			self.line = line + 1
+
+
+def runInThread(func, args, onDone):
+	# Calls func(*args) in a worker thread, then onDone(result) on the main loop
+	def deliver(result):
+		onDone(result)
+		return False
+	def run():
+		with tracer.span(func.__name__, 'thread'):
+			result = func(*args)
+		GLib.idle_add(deliver, result)
+	threading.Thread(target=run, daemon=True).start()
+
+
+class TextSearch:
+	# Every match of one query in a snapshot of a view's text, found in a
+	# single pass. Moving to the next or previous match only moves current.
+	def __init__(self, query, useRegex=False):
+		self.query = query
+		self.useRegex = useRegex
+		self.starts = array.array('L')
+		self.ends = array.array('L')
+		self.lines = array.array('L')
+		self.lineStarts = None
+		self.current = -1
+		self.error = None
+
+	def __len__(self):
+		return len(self.starts)
+
+	def run(self, text, lineStarts=None, isLineVisible=None):
+		# Safe to call from a worker thread, it only reads its arguments.
+		if lineStarts is None:
+			lineStarts = getLineStarts(text)
+		self.lineStarts = lineStarts
+		if self.useRegex:
+			try:
+				pattern = re.compile(self.query, re.IGNORECASE | re.MULTILINE)
+			except re.error as e:
+				self.error = str(e)
+				return
+		else:
+			pattern = re.compile(re.escape(self.query), re.IGNORECASE)
+
+		line = 0
+		for match in pattern.finditer(text):
+			start, end = match.span()
+			if start == end:
+				continue # Empty regex matches cannot be highlighted
+			if line + 1 >= len(lineStarts) or start >= lineStarts[line + 1]:
+				line = bisect.bisect_right(lineStarts, start) - 1
+			if isLineVisible is not None and not isLineVisible(line):
+				continue
+			self.starts.append(start)
+			self.ends.append(end)
+			self.lines.append(line)
+
+	def findAfter(self, offset):
+		# First match starting at or after offset, wrapping around
+		if len(self.starts) == 0:
+			return -1
+		return bisect.bisect_left(self.starts, offset) % len(self.starts)
+
+	def findBefore(self, offset):
+		# Last match starting before offset, wrapping around
+		if len(self.starts) == 0:
+			return -1
+		return (bisect.bisect_left(self.starts, offset) - 1) % len(self.starts)
+
+	def getMatchesBetween(self, startOffset, endOffset):
+		# Indexes of the matches that overlap [startOffset, endOffset)
+		first = max(0, bisect.bisect_right(self.starts, startOffset) - 1)
+		if first < len(self.ends) and self.ends[first] <= startOffset:
+			first += 1
+		last = bisect.bisect_left(self.starts, endOffset)
+		return range(first, last)
+
+	def getLabel(self):
+		if self.error is not None:
+			return 'Invalid regex'
+		elif len(self.starts) == 0:
+			return 'No matches'
+		elif self.current == -1:
+			return '{} matches'.format(len(self.starts))
+		else:
+			return '{} of {}'.format(self.current + 1, len(self.starts))
+
+def getLineStarts(text):
+	lineStarts = array.array('L', [0])
+	lineStarts.extend([match.end() for match in re.finditer('\n', text)])
+	return lineStarts
+
+
+class SearchSource:
+	# Searches a view with TextSearch. Subclasses implement getSearchText,
+	# getSearchCursor, showSearchMatch and highlightSearchMatches.
+	def initSearchSource(self):
+		self.currentSearch = ''
+		self.searchRegex = False
+		self.textSearch = None
+		self.searchId = 0
+		self.searchRunning = False
+		self.searchJumpPending = False
+		self.applySearchTimer = 0
+		self.onSearchUpdated = None
+
+	def getSearchText(self):
+		# Returns (text, lineStarts), lineStarts may be None
+		raise NotImplementedError()
+
+	def getSearchCursor(self):
+		# Text offset where a new search starts looking for its first match
+		raise NotImplementedError()
+
+	def isSearchLineVisible(self, line):
+		return True
+
+	def showSearchMatch(self, index):
+		raise NotImplementedError()
+
+	def highlightSearchMatches(self):
+		pass
+
+	def clearAllMatches(self):
+		pass
+
+	def setSearchRegex(self, useRegex):
+		self.searchRegex = useRegex
+		if self.currentSearch != '':
+			self.applySearch(self.currentSearch)
+
+	def getSearchLabel(self):
+		if self.currentSearch == '':
+			return ''
+		elif self.searchRunning:
+			return 'Searching'
+		elif self.textSearch is None:
+			return ''
+		return self.textSearch.getLabel()
+
+	def notifySearchUpdated(self):
+		if self.onSearchUpdated is not None:
+			self.onSearchUpdated(self.getSearchLabel())
+
+	def applySearch(self, newSearch, jump=True):
+		self.resetApplySearchTimer()
+		self.searchJumpPending = False
+		self.searchId += 1
+		self.currentSearch = newSearch
+		self.textSearch = None
+		self.clearAllMatches()
+		if newSearch == '':
+			self.searchRunning = False
+			self.notifySearchUpdated()
+			return False
+
+		textSearch = TextSearch(newSearch, self.searchRegex)
+		text, lineStarts = self.getSearchText()
+		if len(text) < GitzConfig.searchThreadChars:
+			with tracer.span('search', 'search', query=newSearch, chars=len(text)):
+				textSearch.run(text, lineStarts, self.isSearchLineVisible)
+			self.onSearchDone(textSearch, jump)
+			return False
+
+		searchId = self.searchId
+		def onThreadDone():
+			if searchId == self.searchId:
+				self.onSearchDone(textSearch, jump)
+			return False
+		def runSearch():
+			with tracer.span('search', 'search', query=newSearch, chars=len(text)):
+				textSearch.run(text, lineStarts, self.isSearchLineVisible)
+			GLib.idle_add(onThreadDone)
+		self.searchRunning = True
+		self.notifySearchUpdated()
+		threading.Thread(target=runSearch, daemon=True).start()
+		return False # Cancel applySearchTimer interval
+
+	def onSearchDone(self, textSearch, jump):
+		self.searchRunning = False
+		self.textSearch = textSearch
+		index = textSearch.findAfter(self.getSearchCursor())
+		if jump and index == -1 and self.loadMoreSearchText():
+			self.searchJumpPending = True # Jump once the new text was searched
+		if jump and index != -1:
+			self.selectSearchMatch(index)
+		else:
+			self.highlightSearchMatches()
+			self.notifySearchUpdated()
+
+	def selectSearchMatch(self, index):
+		self.textSearch.current = index
+		self.showSearchMatch(index)
+		self.highlightSearchMatches()
+		self.notifySearchUpdated()
+
+	def findNext(self):
+		if self.textSearch is None:
+			return
+		if self.textSearch.current == len(self.textSearch) - 1 and self.loadMoreSearchText():
+			# Past the last match, search the text still to come before wrapping around
+			self.searchJumpPending = True
+			return
+		if len(self.textSearch) == 0:
+			return
+		if self.textSearch.current == -1:
+			index = self.textSearch.findAfter(self.getSearchCursor())
+		else:
+			index = (self.textSearch.current + 1) % len(self.textSearch)
+		self.selectSearchMatch(index)
+
+	def findPrevious(self):
+		if self.textSearch is None or len(self.textSearch) == 0:
+			return
+		if self.textSearch.current == -1:
+			index = self.textSearch.findBefore(self.getSearchCursor())
+		else:
+			index = (self.textSearch.current - 1) % len(self.textSearch)
+		self.selectSearchMatch(index)
+
+	def onSearchTextChanged(self):
+		# Offsets of the old matches are stale, search the new text
+		# once it settles without moving the cursor.
+		if self.currentSearch == '':
+			return
+		self.searchId += 1
+		self.textSearch = None
+		self.resetApplySearchTimer()
+		self.applySearchTimer = GLib.timeout_add(400, self.applySearch, self.currentSearch, self.searchJumpPending)
+
+	def loadMoreSearchText(self):
+		# Returns True when more text is on the way, eg: the next page of the history
+		return False
+
+	def resetApplySearchTimer(self):
+		if self.applySearchTimer != 0:
+			GLib.source_remove(self.applySearchTimer)
+			self.applySearchTimer = 0
+
+	def debouncedApplySearch(self, newSearch):
+		self.resetApplySearchTimer()
+		self.applySearchTimer = GLib.timeout_add(400, self.applySearch, newSearch)
+
+
+
+class MonospaceView(Gtk.TextView, SearchSource, StepTimer):
 	def __init__(self):
 		Gtk.TextView.__init__(self)
 		self.set_monospace(True)
@@ -166,21 +3634,24 @@ class MonospaceView(Gtk.TextView):
 		if isGtk3:
 			self.override_color(Gtk.StateFlags.NORMAL, textColor)
 
-		self.lineFormattedMap = {}
+		self.formattedLines = Bitset()
+		self.formatWindow = None
+		self.formatIdleTimer = 0
 		self.yscoll = None
 		self.formatVisibleTimer = 0
 
 		self.tagsReady = False
 
-		self.searchMatches = []
-		self.currentSearch = ''
-		self.applySearchTimer = 0
+		self.initSearchSource()
+		self.highlightedRange = None
+		self.get_buffer().connect('changed', self.onBufferChanged)
 
 	def initTags(self):
 		if self.tagsReady:
 			return
 		buf = self.get_buffer()
 		self.tag_found = buf.create_tag("found", background="#45452e")
+		self.tag_foundcurrent = buf.create_tag("foundcurrent", background="#8c8c3c")
 		self.tagsReady = True
 
 	def getAllText(self):
@@ -208,16 +3679,8 @@ class MonospaceView(Gtk.TextView):
 			text = buf.get_text(startIter, endIter, include_hidden_chars=True)
 			yield text, startIter, endIter, y
 
-
-	def timeit(self, label=None, *args):
-		if label:
-			t2 = time.time()
-			d = t2 - self.t
-			log("{} {}: {:.4f}s".format(self.__class__.__name__, label, d), *args)
-			self.t = t2
-		else:
-			self.t = time.time()
-			log()
+	def getVisibleLineNumbers(self, y1, y2):
+		return range(y1, y2 + 1)
 
 	def initScroll(self):
 		if not self.yscoll:
@@ -231,7 +3694,6 @@ class MonospaceView(Gtk.TextView):
 
 	def formatVisible(self):
 		self.resetFormatVisibleTimer()
-		buf = self.get_buffer()
 		r = self.get_visible_rect()
 		iterTop, yTop = self.get_line_at_y(r.y)
 		iterBottom, yBottom = self.get_line_at_y(r.y + r.height)
@@ -242,8 +3704,59 @@ class MonospaceView(Gtk.TextView):
 			# The TextView isn't ready yet.
 			self.scheduleFormatVisible(delay=20)
 		else:
-			for text, startIter, endIter, y in self.iterLines(lineTop, lineBottom):
-				self.checkFormatLine(buf, text, startIter, endIter, y)
+			# One budgeted pass now so the viewport is formatted before it
+			# is drawn, the rest continues in idle callbacks between frames.
+			self.formatWindow = (lineTop, lineBottom)
+			if self.formatLines() and self.formatIdleTimer == 0:
+				self.formatIdleTimer = GLib.idle_add(self.onFormatIdle)
+			self.highlightSearchMatches()
+
+	def onFormatIdle(self):
+		if self.formatLines():
+			return True
+		self.formatIdleTimer = 0
+		return False # Cancel formatIdleTimer
+
+	def formatLines(self):
+		# Formats the viewport, then the lines around it, until the time
+		# budget runs out. Returns True when lines are left.
+		if self.formatWindow is None:
+			return False
+		with tracer.span('formatLines', 'view', widget=self.__class__.__name__) as span:
+			return self.formatLinesUntil(time.monotonic() + GitzConfig.formatBudget, span)
+
+	def formatLinesUntil(self, deadline, span):
+		# One tag pass of formatLines()
+		buf = self.get_buffer()
+		lineCount = buf.get_line_count()
+		lineTop, lineBottom = self.formatWindow
+		margin = GitzConfig.formatPrefetchLines
+		formatCount = 0
+		windows = [
+			(lineTop, lineBottom),
+			(lineBottom + 1, min(lineBottom + margin, lineCount - 1)),
+			(max(0, lineTop - margin), lineTop - 1),
+		]
+		for first, last in windows:
+			for y in self.getVisibleLineNumbers(first, last):
+				if y in self.formattedLines:
+					continue
+				for text, startIter, endIter, y in self.iterLines(y, y):
+					self.formatLine(buf, text, startIter, endIter, y)
+				self.formattedLines.add(y)
+				formatCount += 1
+				if time.monotonic() >= deadline:
+					span.set(lines=formatCount)
+					return True
+		span.set(lines=formatCount)
+		return False
+
+	def resetFormatted(self, fromLine=0):
+		# Lines from fromLine on changed and need to be formatted again
+		if fromLine == 0:
+			self.formattedLines.clear()
+		else:
+			self.formattedLines.discardFrom(fromLine)
 
 	def resetFormatVisibleTimer(self):
 		if self.formatVisibleTimer != 0:
@@ -253,80 +3766,989 @@ class MonospaceView(Gtk.TextView):
 	def scheduleFormatVisible(self, delay=400):
 		self.formatVisibleTimer = GLib.timeout_add(delay, self.formatVisible)
 
-	def checkFormatLine(self, buf, text, startIter, endIter, y):
-		if self.lineFormattedMap.get(y, False):
-			return
-
-		self.formatLine(buf, text, startIter, endIter, y)
-		self.lineFormattedMap[y] = True
-
 	def formatLine(self, buf, text, startIter, endIter, y):
 		pass
 
 	#---
-	def clearAllMatches(self):
-		buf = self.get_buffer()
-		buf.remove_tag(self.tag_found, buf.get_start_iter(), buf.get_end_iter())
+	def onBufferChanged(self, buf):
+		self.highlightedRange = None
+		self.onSearchTextChanged()
+
+	def getSearchText(self):
+		return (self.getAllText(), None)
 
-	def highlightAllMatches(self, newSearch):
+	def getSearchCursor(self):
 		buf = self.get_buffer()
-		buf.remove_tag(self.tag_found, buf.get_start_iter(), buf.get_end_iter())
+		return buf.props.cursor_position
 
-	def applySearch(self, newSearch):
-		if newSearch == '':
-			self.clearAllMatches()
-		else:
-			buf = self.get_buffer()
-			if self.currentSearch == newSearch:
-				# Continue from cursor
-				cursor_mark = buf.get_insert()
-				start = buf.get_iter_at_mark(cursor_mark)
-				start.forward_line()
-			else:
-				# Start from top
-				start = buf.get_start_iter()
-			end = buf.get_end_iter()
-			searchFlags = Gtk.TextSearchFlags.CASE_INSENSITIVE
-			match = start.forward_search(newSearch, searchFlags, end)
-			if match is not None:
-				matchStart, matchEnd = match
-				buf.apply_tag(self.tag_found, matchStart, matchEnd)
-				buf.place_cursor(matchStart)
-				self.scroll_to_iter(
-					matchStart,
-					within_margin=0.0,
-					use_align=True,
-					xalign=1.0, # Right Align so that we still see the log graph
-					yalign=0.0, # Top Align
-				)
+	def getVisibleOffsets(self):
+		r = self.get_visible_rect()
+		iterTop, yTop = self.get_line_at_y(r.y)
+		iterBottom, yBottom = self.get_line_at_y(r.y + r.height)
+		iterBottom.forward_to_line_end()
+		return iterTop.get_offset(), iterBottom.get_offset()
 
-		self.currentSearch = newSearch
+	def clearAllMatches(self):
+		if self.highlightedRange is None:
+			return
+		buf = self.get_buffer()
+		startOffset, endOffset = self.highlightedRange
+		startIter = buf.get_iter_at_offset(startOffset)
+		endIter = buf.get_iter_at_offset(endOffset)
+		buf.remove_tag(self.tag_found, startIter, endIter)
+		buf.remove_tag(self.tag_foundcurrent, startIter, endIter)
+		self.highlightedRange = None
+
+	def highlightSearchMatches(self):
+		# Only the matches in view are tagged, scrolling tags the rest
+		self.clearAllMatches()
+		textSearch = self.textSearch
+		if textSearch is None or len(textSearch) == 0 or not self.tagsReady:
+			return
+		buf = self.get_buffer()
+		startOffset, endOffset = self.getVisibleOffsets()
+		matches = textSearch.getMatchesBetween(startOffset, endOffset)
+		if len(matches) == 0:
+			return
+		for index in matches:
+			tag = self.tag_foundcurrent if index == textSearch.current else self.tag_found
+			startIter = buf.get_iter_at_offset(textSearch.starts[index])
+			endIter = buf.get_iter_at_offset(textSearch.ends[index])
+			buf.apply_tag(tag, startIter, endIter)
+		self.highlightedRange = (textSearch.starts[matches[0]], textSearch.ends[matches[-1]])
+
+	def showSearchMatch(self, index):
+		buf = self.get_buffer()
+		matchStart = buf.get_iter_at_offset(self.textSearch.starts[index])
+		buf.place_cursor(matchStart)
+		self.scroll_to_iter(
+			matchStart,
+			within_margin=0.0,
+			use_align=True,
+			xalign=1.0, # Right Align so that we still see the log graph
+			yalign=0.0, # Top Align
+		)
 
-		self.applySearchTimer = 0
-		return False # Cancel applySearchTimer interval
 
-	def resetApplySearchTimer(self):
-		if self.applySearchTimer != 0:
-			GLib.source_remove(self.applySearchTimer)
-			self.applySearchTimer = 0
 
-	def debouncedApplySearch(self, newSearch):
-		self.resetApplySearchTimer()
-		self.applySearchTimer = GLib.timeout_add(400, self.applySearch, newSearch)
+def parseDecorationSpans(decorations, refIndex):
+	# Returns (kind, start, end) spans relative to the "(...) " decorations group.
+	spans = []
+	for subMatch in TAGREF_PATTERN.finditer(decorations):
+		spans.append(('tag', subMatch.start(2), subMatch.end(2)))
+	for subMatch in REF_PATTERN.finditer(decorations):
+		if subMatch.group(3) is not None:
+			spans.append(('head', subMatch.start(3), subMatch.end(3)))
+
+		if refIndex.getKind(subMatch.group(4)) == 'remote':
+			spans.append(('remote', subMatch.start(4), subMatch.end(4)))
+		else:
+			spans.append(('local', subMatch.start(4), subMatch.end(4)))
+	return spans
 
 
+class HistoryStore:
+	# Columnar store of the displayed history rows. The text is kept in a few
+	# large chunks with a table of line start offsets instead of a string per
+	# row. Rows are parsed with LOG_PATTERN once, a block at a time when first
+	# read, into span columns shared by formatting, selection and sha lookup.
+	parseBlockSize = 256
+	denseMatches = 1000
+	UNPARSED = -2
 
-class HistoryView(MonospaceView):
 	def __init__(self):
-		MonospaceView.__init__(self)
-		if isGtk3:
-			self.override_font(Pango.font_description_from_string('Monospace 10'))
-		self.logStdout = ''
+		self.reset([], RefIndex([], 'HEAD', [], []))
+
+	def reset(self, lines, refIndex):
+		self.chunks = []
+		self.chunkRows = array.array('L')
+		self.chunkOffsets = array.array('L')
+		self.lineStarts = array.array('L')
+		self.length = 0
+		self.refIndex = refIndex
+
+		# Offsets within the row, -1 when the row has no such group
+		self.graphEnds = array.array('i')
+		self.shaEnds = array.array('i')
+		self.decorationEnds = array.array('i')
+		self.refSpans = {}
+
+		self.headRow = -1
+		self.headSearchedRows = 0
+		self.append(lines)
+
+	def __len__(self):
+		return len(self.lineStarts)
+
+	def append(self, lines):
+		if len(lines) == 0:
+			return
+		self.chunkRows.append(len(self.lineStarts))
+		self.chunkOffsets.append(self.length)
+		self.chunks.append('\n'.join(lines) + '\n')
+		lineStarts = self.lineStarts
+		pos = self.length
+		for line in lines:
+			lineStarts.append(pos)
+			pos += len(line) + 1
+		self.length = pos
+		unparsed = array.array('i', [self.UNPARSED]) * len(lines)
+		self.graphEnds.extend(unparsed)
+		self.shaEnds.extend(unparsed)
+		self.decorationEnds.extend(unparsed)
+
+	def splice(self, index, removeCount, lines):
+		text = self.getText()
+		start = self.lineStarts[index] if index < len(self) else self.length
+		end = self.lineStarts[index + removeCount] if index + removeCount < len(self) else self.length
+		inserted = ''.join([line + '\n' for line in lines])
+		delta = len(inserted) - (end - start)
+
+		lineStarts = array.array('L')
+		pos = start
+		for line in lines:
+			lineStarts.append(pos)
+			pos += len(line) + 1
+		lineStarts.extend([lineStart + delta for lineStart in self.lineStarts[index + removeCount:]])
+		self.lineStarts[index:] = lineStarts
+		self.chunks = [text[:start] + inserted + text[end:]]
+		self.chunkRows = array.array('L', [0])
+		self.chunkOffsets = array.array('L', [0])
+		self.length += delta
+
+		unparsed = array.array('i', [self.UNPARSED]) * len(lines)
+		self.graphEnds[index:index + removeCount] = unparsed
+		self.shaEnds[index:index + removeCount] = unparsed
+		self.decorationEnds[index:index + removeCount] = unparsed
+		shift = len(lines) - removeCount
+		refSpans = {}
+		for row, spans in self.refSpans.items():
+			if row < index:
+				refSpans[row] = spans
+			elif row >= index + removeCount:
+				refSpans[row + shift] = spans
+		self.refSpans = refSpans
+
+		self.headRow = -1
+		self.headSearchedRows = 0
+
+	#--- Text
+	def getText(self):
+		# Joins the chunks, later appends start new chunks
+		if len(self.chunks) > 1:
+			self.chunks = [''.join(self.chunks)]
+			self.chunkRows = array.array('L', [0])
+			self.chunkOffsets = array.array('L', [0])
+		return self.chunks[0] if len(self.chunks) > 0 else ''
+
+	def getLineEnd(self, row):
+		# Offset of the newline ending the row
+		if row + 1 < len(self.lineStarts):
+			return self.lineStarts[row + 1] - 1
+		return self.length - 1
+
+	def getLine(self, row):
+		i = bisect.bisect_right(self.chunkRows, row) - 1
+		base = self.chunkOffsets[i]
+		return self.chunks[i][self.lineStarts[row] - base:self.getLineEnd(row) - base]
+
+	def getLines(self, first, last):
+		# Rows [first, last) split out of the chunks they are in
+		lines = []
+		row = first
+		while row < last:
+			i = bisect.bisect_right(self.chunkRows, row) - 1
+			chunkLast = min(last, self.chunkRows[i + 1] if i + 1 < len(self.chunkRows) else len(self))
+			base = self.chunkOffsets[i]
+			lines += self.chunks[i][self.lineStarts[row] - base:self.getLineEnd(chunkLast - 1) - base].split('\n')
+			row = chunkLast
+		return lines
+
+	def findRow(self, query, row):
+		# First row at or after row containing query, or -1
+		i = max(0, bisect.bisect_right(self.chunkRows, row) - 1)
+		offset = self.lineStarts[row] if row < len(self) else self.length
+		while i < len(self.chunks):
+			base = self.chunkOffsets[i]
+			pos = self.chunks[i].find(query, max(0, offset - base))
+			if pos != -1:
+				return bisect.bisect_right(self.lineStarts, base + pos) - 1
+			i += 1
+		return -1
+
+	#--- Filter
+	def search(self, query):
+		# Returns the sorted rows containing query
+		matches = array.array('L')
+		for i in range(len(self.chunks)):
+			self.searchChunk(matches, i, query)
+		return matches
+
+	def searchChunk(self, matches, i, query):
+		chunk = self.chunks[i]
+		firstRow = self.chunkRows[i]
+		base = self.chunkOffsets[i]
+		found = 0
+		pos = chunk.find(query)
+		while pos != -1:
+			row = bisect.bisect_right(self.lineStarts, base + pos) - 1
+			matches.append(row)
+			found += 1
+			nextLine = self.getLineEnd(row) + 1 - base
+			if found >= self.denseMatches and found * 8 > row - firstRow:
+				# Most rows match, testing the remaining lines is cheaper than seeking
+				remaining = chunk[nextLine:].split('\n')
+				matches.extend([r for r, line in enumerate(remaining, row + 1) if query in line])
+				return
+			pos = chunk.find(query, nextLine)
+
+	def narrow(self, matches, query):
+		# Rows of matches that also contain query. When query contains the
+		# previous query its result is a subset of the previous result.
+		if len(matches) * 8 > len(self):
+			# Scanning beats testing most of the rows, matches may also be
+			# narrowed by a file filter
+			rows = set(matches)
+			return array.array('L', [row for row in self.search(query) if row in rows])
+		text = self.getText()
+		lineStarts = self.lineStarts
+		getLineEnd = self.getLineEnd
+		return array.array('L', [row for row in matches if text.find(query, lineStarts[row], getLineEnd(row)) != -1])
+
+	def filterShas(self, containsSha, rows=None):
+		# Rows, or every row, whose commit passes containsSha(sha)
+		if rows is None:
+			rows = range(len(self))
+		getSha = self.getSha
+		matches = array.array('L')
+		for row in rows:
+			sha = getSha(row)
+			if sha is not None and containsSha(sha):
+				matches.append(row)
+		return matches
+
+	#--- Columns
+	def parseBlock(self, row):
+		first = row - row % self.parseBlockSize
+		last = min(first + self.parseBlockSize, len(self))
+		graphEnds = array.array('i')
+		shaEnds = array.array('i')
+		decorationEnds = array.array('i')
+		for row, line in enumerate(self.getLines(first, last), first):
+			match = LOG_PATTERN.match(line)
+			if match is None:
+				graphEnds.append(-1)
+				shaEnds.append(-1)
+				decorationEnds.append(-1)
+				continue
+			graphEnds.append(match.end(1))
+			shaEnds.append(match.end(3))
+			decorationEnds.append(match.end(4))
+			if match.group(4):
+				groupStart = match.start(4)
+				self.refSpans[row] = tuple([
+					(kind, groupStart + start, groupStart + end)
+					for kind, start, end in parseDecorationSpans(match.group(4), self.refIndex)
+				])
+		self.graphEnds[first:last] = graphEnds
+		self.shaEnds[first:last] = shaEnds
+		self.decorationEnds[first:last] = decorationEnds
+
+	def getRow(self, row):
+		# Returns (graphEnd, shaEnd, decorationsEnd, refSpans) offsets in the row
+		if self.graphEnds[row] == self.UNPARSED:
+			self.parseBlock(row)
+		return (self.graphEnds[row], self.shaEnds[row], self.decorationEnds[row], self.refSpans.get(row, ()))
+
+	def setRefIndex(self, refIndex):
+		# Returns the rows with refs, their spans are parsed again
+		self.refIndex = refIndex
+		rows = sorted(self.refSpans)
+		for row in rows:
+			self.graphEnds[row] = self.UNPARSED
+		self.refSpans = {}
+		return rows
+
+	def getSha(self, row):
+		graphEnd, shaEnd, decorationsEnd, refSpans = self.getRow(row)
+		if shaEnd == -1:
+			return None
+		return self.getLine(row)[graphEnd:shaEnd]
+
+	def findShaRow(self, sha):
+		row = self.findRow(sha, 0)
+		while row != -1 and self.getSha(row) != sha:
+			row = self.findRow(sha, row + 1) # sha was mentioned in a subject
+		return row
+
+	def findCommitRow(self, fullSha):
+		# Like findShaRow for a full sha, rows show it abbreviated
+		row = self.findRow(fullSha[:7], 0)
+		while row != -1:
+			sha = self.getSha(row)
+			if sha is not None and fullSha.startswith(sha):
+				return row
+			row = self.findRow(fullSha[:7], row + 1)
+		return -1
+
+	def findHeadRow(self):
+		# HEAD rarely appears outside of decorations, only those rows are parsed
+		while self.headRow == -1 and self.headSearchedRows < len(self):
+			row = self.findRow('HEAD', self.headSearchedRows)
+			if row == -1:
+				self.headSearchedRows = len(self)
+				break
+			self.headSearchedRows = row + 1
+			graphEnd, shaEnd, decorationsEnd, refSpans = self.getRow(row)
+			if decorationsEnd != -1 and HEADREF_PATTERN.search(self.getLine(row)[shaEnd:decorationsEnd]):
+				self.headRow = row
+		return self.headRow
+
+
+def getHiddenRanges(matches, start, end):
+	# Runs of rows in [start, end) that are not in the sorted matches
+	ranges = []
+	pos = start
+	for row in matches:
+		if row > pos:
+			ranges.append((pos, row))
+		pos = row + 1
+	if pos < end:
+		ranges.append((pos, end))
+	return ranges
+
+def getDroppedRanges(previousMatches, matches):
+	# Runs of rows that were in previousMatches but not in matches. Runs may
+	# cover rows that were already hidden, they never cover a row in matches.
+	ranges = []
+	rangeStart = -1
+	lastDropped = -1
+	i = 0
+	for row in previousMatches:
+		if i < len(matches) and matches[i] == row:
+			if rangeStart != -1:
+				ranges.append((rangeStart, lastDropped + 1))
+				rangeStart = -1
+			i += 1
+		else:
+			if rangeStart == -1:
+				rangeStart = row
+			lastDropped = row
+	if rangeStart != -1:
+		ranges.append((rangeStart, lastDropped + 1))
+	return ranges
+
+
+class HistorySource:
+	# Loads the git log into a history widget. Subclasses implement
+	# clearRows, appendRows, setRows and selectRow, and hide filtered
+	# rows with clearRowMask, setRowMask and hideRows.
+	def initHistorySource(self, session):
+		self.session = session
+		self.logLines = []
+		self.logStream = None
+		self.logProcess = None
+		self.refIndex = None
+		self.refWaiters = []
+		self.onRefsLoaded = None
+		self.headLine = -1
 		self.currentFilter = ''
+		self.pathFilter = None # A PathFilter when the file filter is answered from the PathCommitIndex
+		self.filterMatches = None
+		self.historyStore = HistoryStore()
 		self.applyFilterTimer = 0
 		self.dirPath = None
 		self.fileFilter = ''
 		self.branchFilter = '--all'
+		self.populateId = 0
+		self.logCmd = None
+		self.logDone = False
+		self.logSnapshot = None
+		self.refreshing = False
+		self.refreshPending = False
+		self.logCommitCount = 0
+		self.pageLimit = 0 # The log pauses once it has this many commits, 0 when not paged
+		self.logStartTime = 0
+		self.jumpSha = None # Selected once its page is loaded
+		self.diskCache = session.historyCache
+		self.commitGraph = CommitGraph()
+		self.graphLayoutTimer = 0
+
+	def setDirPath(self, dirPath):
+		self.dirPath = dirPath
+
+	def setBranchFilter(self, branchFilter):
+		self.branchFilter = branchFilter
+		self.populate()
+
+	def setFileFilter(self, fileFilter):
+		# When the PathCommitIndex knows the commits of fileFilter they are
+		# masked out of the loaded history like the text filter, instead of
+		# loading the history again with git log -- fileFilter. The lanes
+		# of git log --graph would break, so it needs the native graph.
+		self.fileFilter = fileFilter
+		self.pathFilter = None
+		if GitzConfig.pathCommitIndex and GitzConfig.nativeGraph and not (fileFilter is None or fileFilter == ''):
+			index = self.session.pathCommitIndex
+			if index.isReady():
+				self.pathFilter = index.getFilter(fileFilter, self.dirPath)
+			else:
+				index.load() # For the next file filter
+		if self.logCmd is not None and self.logCmd == self.getLogCommand():
+			self.timeit()
+			with tracer.span('filter', 'pathFilter', path=fileFilter) as span:
+				self.refilter()
+				span.set(rows=self.getVisibleRowCount())
+			self.timeit('pathFilter', self.getVisibleRowCount())
+			self.loadPagesForFilter()
+			self.updatePathFilter()
+		else:
+			self.populate()
+
+	def updatePathFilter(self):
+		# The index catches up with refs that moved since it was loaded
+		if self.pathFilter is None:
+			return
+		pathFilter = self.pathFilter
+		index = self.session.pathCommitIndex
+		def onReady():
+			if self.pathFilter is not pathFilter:
+				return
+			newFilter = index.getFilter(pathFilter.path, self.dirPath)
+			if newFilter is not None and newFilter.shas != pathFilter.shas:
+				self.pathFilter = newFilter
+				self.refilter()
+				self.loadPagesForFilter()
+		index.load(onReady)
+
+	def getLogRevisionArgs(self):
+		if self.branchFilter is None or self.branchFilter == '':
+			return []
+		return [self.branchFilter]
+
+	def getLogFilterArgs(self):
+		if GitzConfig.hideKdeSilentCommits:
+			return [
+				'--grep=_SILENT',
+				'--invert-grep',
+			]
+		return []
+
+	def getLogPathArgs(self):
+		if not (self.fileFilter is None or self.fileFilter == '') and self.pathFilter is None:
+			return [self.fileFilter]
+		elif self.dirPath != None:
+			return [self.dirPath]
+		return []
+
+	def getLogCommand(self):
+		# Also the key of the history disk cache
+		return self.session.backend.getLogCommand(self.getLogRevisionArgs(), self.getLogFilterArgs(), self.getLogPathArgs())
+
+	def loadRefs(self):
+		# Runs alongside git log. Native graph rows wait for the refs they
+		# are decorated with. The rows git decorated are formatted again
+		# in case they were parsed with the refs of the previous populate.
+		self.refIndex = None
+		self.refWaiters = []
+		populateId = self.populateId
+		def onRefIndex(refIndex):
+			if populateId != self.populateId:
+				return
+			self.timeit('refs', len(refIndex.refs))
+			self.applyRefIndex(refIndex)
+			waiters = self.refWaiters
+			self.refWaiters = []
+			for waiter in waiters:
+				waiter()
+			self.refreshIfPending()
+		self.session.loadRefSnapshot(self.getLogRevisionArgs(), onRefIndex)
+
+	def applyRefIndex(self, refIndex):
+		self.refIndex = refIndex
+		self.refreshRows(self.historyStore.setRefIndex(refIndex))
+		if self.onRefsLoaded is not None:
+			self.onRefsLoaded(refIndex)
+
+	def whenRefsLoaded(self, callback):
+		if self.refIndex is not None:
+			callback()
+		else:
+			self.refWaiters.append(callback)
+
+	def populate(self):
+		self.cancelPopulate()
+		self.populateId += 1
+		self.timeit()
+		cmd = self.getLogCommand()
+		self.logCmd = cmd
+		self.logDone = False
+		self.refreshing = False
+		self.refreshPending = False
+		self.loadRefs()
+		if len(self.getLogPathArgs()) > 0:
+			self.whenRefsLoaded(lambda: self.session.commitGraphSetup.check(self.refIndex))
+		self.updatePathFilter()
+
+		if GitzConfig.streamHistory:
+			cached = self.diskCache.load(cmd) if GitzConfig.historyCache else None
+			if cached is not None:
+				self.populateFromCache(cmd, cached)
+			else:
+				self.populateStreaming(cmd)
+		else:
+			def onLog(stdout):
+				self.logProcess = None
+				self.timeit('process')
+				lines = stdout.strip().splitlines()
+				if GitzConfig.nativeGraph:
+					self.whenRefsLoaded(lambda: self.populateLines(self.refIndex.decorateLines(lines)))
+				else:
+					self.populateLines(lines)
+			self.logProcess = self.session.backend.readLog(self.getLogRevisionArgs(), self.getLogFilterArgs(), self.getLogPathArgs(), onLog)
+
+	def populateLines(self, logLines):
+		self.logLines = logLines
+		self.resetCommitGraph()
+		self.resetHistoryStore()
+		self.setRows(self.toDisplayLines(self.logLines))
+		self.headLine = self.historyStore.findHeadRow()
+		self.refilter()
+		self.logDone = True
+		self.refreshIfPending()
+
+	def cancelPopulate(self):
+		if self.logStream is not None:
+			self.logStream.cancel()
+			self.logStream = None
+		if self.logProcess is not None:
+			self.logProcess.cancel()
+			self.logProcess = None
+
+	def populateStreaming(self, cmd):
+		self.logCmd = cmd
+		self.logLines = []
+		self.logDone = False
+		self.logSnapshot = None
+		self.logCommitCount = 0
+		# At least the rows a cache update compares, so a refresh of a
+		# paused log never mistakes the loaded pages for the whole history.
+		self.pageLimit = max(GitzConfig.historyPageCommits, GitzConfig.historyCacheOverlap) if GitzConfig.historyPageCommits > 0 else 0
+		self.logStartTime = time.monotonic()
+		self.headLine = -1
+		self.resetCommitGraph()
+		self.resetHistoryStore()
+		self.clearRows()
+		if self.filterMatches is not None:
+			self.filterMatches = array.array('L')
+			self.setRowMask(self.filterMatches)
+
+		if GitzConfig.historyCache:
+			# The ref tips were requested before git log started so the
+			# cache never claims commits it does not contain.
+			def onRefs():
+				self.logSnapshot = (self.refIndex.tips, self.refIndex.revs)
+				self.saveDiskCache()
+			self.whenRefsLoaded(onRefs)
+
+		self.logStream = self.session.backend.streamLog(self.getLogRevisionArgs(), self.getLogFilterArgs(), self.getLogPathArgs(), self.onLogLines, self.onLogDone)
+
+	def populateFromCache(self, cmd, cached):
+		self.logCmd = cmd
+		self.logLines = cached['lines']
+		self.resetCommitGraph()
+		self.resetHistoryStore()
+		self.setRows(self.toDisplayLines(self.logLines))
+		self.headLine = self.historyStore.findHeadRow()
+		self.refilter()
+		self.timeit('diskCache')
+
+		populateId = self.populateId
+		def onRefs():
+			tips = self.refIndex.tips
+			revs = self.refIndex.revs
+			if tips == cached['tips'] and revs == cached['revs']:
+				# Nothing changed since the cache was written
+				self.logDone = True
+				self.logSnapshot = (tips, revs)
+				self.refreshIfPending()
+				return
+
+			def onUpdate(edits):
+				if populateId != self.populateId:
+					return
+				if edits is None:
+					self.populateStreaming(cmd)
+					return
+				self.applyLogEdits(edits)
+				self.timeit('diskCache.update')
+				self.logDone = True
+				self.logSnapshot = (tips, revs)
+				self.saveDiskCache()
+				self.refreshIfPending()
+
+			HistoryCacheUpdate(cmd, self.getLogFilterArgs(), self.getLogPathArgs(), cached, self.refIndex, onUpdate).start()
+		self.whenRefsLoaded(onRefs)
+
+	def saveDiskCache(self):
+		if self.logDone and self.logSnapshot is not None:
+			tips, revs = self.logSnapshot
+			self.diskCache.save(self.logCmd, tips, revs, self.logLines)
+
+	def applyLogEdits(self, edits):
+		# edits are (index, removeCount, lines), ordered so that
+		# applying one does not shift the rows of the next. Unchanged
+		# rows are left in place so the widgets keep their scroll position.
+		selectedRow = self.getSelectedRow()
+		selectedSha = self.historyStore.getSha(selectedRow) if selectedRow != -1 else None
+		wasOnHead = selectedRow != -1 and selectedRow == self.headLine
+		for edit in edits:
+			index, removeCount, lines = trimLogEdit(self.logLines, *edit)
+			if removeCount == 0 and len(lines) == 0:
+				continue
+			self.logLines[index:index + removeCount] = lines
+			if GitzConfig.nativeGraph:
+				self.commitGraph.splice(index, removeCount, [parseGraphRecord(line) for line in lines])
+			lines = self.toDisplayLines(lines)
+			self.historyStore.splice(index, removeCount, lines)
+			self.spliceRows(index, removeCount, lines)
+		self.scheduleGraphLayout()
+
+		self.headLine = self.historyStore.findHeadRow()
+		if self.isFiltered():
+			self.refilter()
+		elif wasOnHead and self.headLine != -1:
+			if self.historyStore.getSha(self.headLine) != selectedSha:
+				self.selectRow(self.headLine) # Follow HEAD to the new commit or branch
+		elif selectedSha is not None:
+			selectedRow = self.getSelectedRow()
+			if selectedRow == -1 or self.historyStore.getSha(selectedRow) != selectedSha:
+				row = self.historyStore.findShaRow(selectedSha)
+				if row != -1:
+					self.selectRow(row)
+
+	#--- Refresh
+	def refresh(self):
+		# Brings the loaded history up to date after the refs changed, eg:
+		# a commit, checkout or fetch. New commits are spliced on top and
+		# moved decorations fixed, only a rewritten history is loaded again.
+		if (not self.logDone and not self.isLogPaused()) or self.refIndex is None or self.refreshing:
+			self.refreshPending = True
+			return
+		self.refreshPending = False
+		self.refreshing = True
+		self.timeit()
+		populateId = self.populateId
+		oldIndex = self.refIndex
+		def onRefIndex(refIndex):
+			if populateId != self.populateId:
+				return
+			if refIndex.tips == oldIndex.tips and refIndex.revs == oldIndex.revs:
+				self.finishRefresh()
+				return
+
+			def onUpdate(edits):
+				if populateId != self.populateId:
+					return
+				if edits is None:
+					self.populate()
+					return
+				self.applyRefIndex(refIndex)
+				self.applyLogEdits(edits)
+				self.updatePathFilter()
+				self.timeit('refresh', len(edits))
+				if self.logSnapshot is not None:
+					self.logSnapshot = (refIndex.tips, refIndex.revs)
+					self.saveDiskCache()
+				self.finishRefresh()
+
+			loaded = {
+				'lines': self.logLines,
+				'tips': oldIndex.tips,
+				'revs': oldIndex.revs,
+			}
+			HistoryCacheUpdate(self.logCmd, self.getLogFilterArgs(), self.getLogPathArgs(), loaded, refIndex, onUpdate).start()
+		self.session.loadRefSnapshot(self.getLogRevisionArgs(), onRefIndex)
+
+	def finishRefresh(self):
+		self.refreshing = False
+		self.refreshIfPending()
+
+	def refreshIfPending(self):
+		if self.refreshPending:
+			self.refresh()
+
+	def toDisplayLines(self, lines):
+		if GitzConfig.nativeGraph:
+			return [displayLine(line) for line in lines]
+		return lines
+
+	#--- Native graph
+	def resetHistoryStore(self):
+		# Until the refs of this populate arrive, keep the previous ones
+		refIndex = self.historyStore.refIndex if self.refIndex is None else self.refIndex
+		self.historyStore.reset(self.toDisplayLines(self.logLines), refIndex)
+
+	def resetCommitGraph(self):
+		self.commitGraph.reset()
+		if GitzConfig.nativeGraph:
+			self.commitGraph.append([parseGraphRecord(line) for line in self.logLines])
+			self.scheduleGraphLayout()
+
+	def scheduleGraphLayout(self):
+		if GitzConfig.nativeGraph and self.graphLayoutTimer == 0:
+			self.graphLayoutTimer = GLib.idle_add(self.onGraphLayoutIdle, priority=GLib.PRIORITY_LOW)
+
+	def onGraphLayoutIdle(self):
+		if self.commitGraph.advance(0.005):
+			self.graphLayoutTimer = 0
+			return False # Cancel graphLayoutTimer
+		return True
+
+	def isGraphVisible(self):
+		# Graph rows only line up with the displayed rows when nothing is filtered out
+		return GitzConfig.nativeGraph and not self.isFiltered()
+
+	def onLogLines(self, lines):
+		if GitzConfig.nativeGraph:
+			if self.refIndex is None:
+				self.refWaiters.append(lambda: self.onLogLines(lines))
+				return
+			lines = self.refIndex.decorateLines(lines)
+		rawLines = lines
+		isFirstChunk = len(self.logLines) == 0
+		self.logLines += lines
+		if GitzConfig.nativeGraph:
+			self.commitGraph.append([parseGraphRecord(line) for line in lines])
+			self.scheduleGraphLayout()
+		lines = self.toDisplayLines(lines)
+		self.historyStore.append(lines)
+
+		rowOffset = self.appendRows(lines)
+		if self.filterMatches is not None:
+			chunkMatches = [rowOffset + i for i, line in enumerate(lines) if self.currentFilter in line]
+			if self.pathFilter is not None:
+				chunkMatches = self.historyStore.filterShas(self.pathFilter.containsSha, chunkMatches)
+			self.filterMatches.extend(chunkMatches)
+			self.hideRows(getHiddenRanges(chunkMatches, rowOffset, rowOffset + len(lines)))
+
+		if self.headLine == -1:
+			self.headLine = self.historyStore.findHeadRow()
+			if self.headLine != -1:
+				if self.isRowVisible(self.headLine):
+					self.selectRow(self.headLine)
+				self.timeit('head')
+		if isFirstChunk or self.getSelectedRow() == -1:
+			self.selectVisibleRow()
+
+		if isFirstChunk:
+			self.timeit('firstChunk')
+
+		if self.pageLimit != 0:
+			self.logCommitCount += countCommitRows(rawLines)
+			if self.logCommitCount >= self.pageLimit and self.logStream is not None:
+				self.logStream.pause()
+				self.timeit('page', self.logCommitCount)
+				self.loadPagesForFilter()
+
+		if self.jumpSha is not None:
+			self.jumpToSha(self.jumpSha)
+
+	def onLogDone(self):
+		if GitzConfig.nativeGraph and self.refIndex is None:
+			self.refWaiters.append(self.onLogDone)
+			return
+		self.logStream = None
+		self.timeit('process')
+		self.logDone = True
+		if len(self.getLogPathArgs()) > 0 and self.pageLimit == 0:
+			self.session.commitGraphSetup.onPathLogLoaded(self.getLogPathArgs(), time.monotonic() - self.logStartTime, len(self.logLines))
+		self.saveDiskCache()
+		self.refreshIfPending()
+
+	#--- Pages
+	def isLogPaused(self):
+		return self.logStream is not None and self.logStream.paused
+
+	def loadNextPage(self):
+		# Returns True when more rows are on the way
+		if not self.isLogPaused():
+			return False
+		self.pageLimit = self.logCommitCount + GitzConfig.historyPageCommits
+		self.logStream.resume()
+		return True
+
+	def loadPagesForFilter(self):
+		# The filter only sees the loaded pages, keep loading until it fills the view
+		if self.isFiltered() and self.getVisibleRowCount() < GitzConfig.historyPageFilterRows:
+			self.loadNextPage()
+
+	def jumpToSha(self, sha):
+		# Selects the commit of a full sha, loading pages until it shows up
+		row = self.historyStore.findCommitRow(sha)
+		if row != -1:
+			self.jumpSha = None
+			if self.isRowVisible(row):
+				self.selectRow(row)
+		elif self.loadNextPage() or self.logStream is not None:
+			self.jumpSha = sha
+		else:
+			self.jumpSha = None
+
+	def onHistoryScroll(self, adjustment):
+		# Within a screen of the last loaded row
+		if adjustment.get_value() + 2 * adjustment.get_page_size() >= adjustment.get_upper():
+			self.loadNextPage()
+
+	#---
+	def getNeighborShas(self, count):
+		# Shas of the commits closest to the selected row, nearest first.
+		rowCount = self.getRowCount()
+		selectedRow = self.getSelectedRow()
+		if selectedRow == -1:
+			return []
+		after = self.findShas(range(selectedRow + 1, rowCount), count)
+		before = self.findShas(range(selectedRow - 1, -1, -1), count)
+		shas = []
+		for i in range(count):
+			if i < len(after):
+				shas.append(after[i])
+			if i < len(before):
+				shas.append(before[i])
+		return shas
+
+	def findShas(self, rows, count):
+		shas = []
+		for index in rows:
+			if len(shas) >= count:
+				break
+			sha = self.historyStore.getSha(index)
+			if sha is not None:
+				shas.append(sha)
+		return shas
+
+	def getRowCount(self):
+		raise NotImplementedError()
+
+	def getVisibleRowCount(self):
+		if self.filterMatches is None:
+			return self.getRowCount()
+		return len(self.filterMatches)
+
+	def getRowText(self, index):
+		return self.historyStore.getLine(index)
+
+	def getSelectedRow(self):
+		raise NotImplementedError()
+
+	def clearRows(self):
+		raise NotImplementedError()
+
+	def appendRows(self, lines):
+		# Returns the row index of the first appended line
+		raise NotImplementedError()
+
+	def setRows(self, lines):
+		raise NotImplementedError()
+
+	def spliceRows(self, index, removeCount, lines):
+		raise NotImplementedError()
+
+	def refreshRows(self, rows):
+		# Render the rows again after their ref spans changed
+		raise NotImplementedError()
+
+	def selectRow(self, index):
+		raise NotImplementedError()
+
+	def clearRowMask(self):
+		raise NotImplementedError()
+
+	def setRowMask(self, matches):
+		# Only the sorted rows in matches stay visible
+		raise NotImplementedError()
+
+	def hideRows(self, ranges):
+		# Hide the (start, end) row ranges on top of the current mask
+		raise NotImplementedError()
+
+	#---
+	def isRowVisible(self, index):
+		if self.filterMatches is None:
+			return True
+		i = bisect.bisect_left(self.filterMatches, index)
+		return i < len(self.filterMatches) and self.filterMatches[i] == index
+
+	def selectVisibleRow(self):
+		# Keep the selection if it survived the filter, else prefer HEAD
+		selectedRow = self.getSelectedRow()
+		if selectedRow != -1 and self.isRowVisible(selectedRow):
+			return
+		if self.headLine != -1 and self.isRowVisible(self.headLine):
+			self.selectRow(self.headLine)
+		elif self.filterMatches is None:
+			if self.getRowCount() > 0:
+				self.selectRow(0)
+		elif len(self.filterMatches) > 0:
+			self.selectRow(self.filterMatches[0])
+
+	def isFiltered(self):
+		return self.currentFilter != '' or self.pathFilter is not None
+
+	def refilter(self):
+		if not self.isFiltered():
+			self.filterMatches = None
+			self.clearRowMask()
+		else:
+			matches = self.historyStore.search(self.currentFilter) if self.currentFilter != '' else None
+			if self.pathFilter is not None:
+				matches = self.historyStore.filterShas(self.pathFilter.containsSha, matches)
+			self.filterMatches = matches
+			self.setRowMask(self.filterMatches)
+		self.selectVisibleRow()
+
+	def applyFilter(self, newFilter):
+		self.applyFilterTimer = 0
+		self.timeit()
+		previousFilter = self.currentFilter
+		previousMatches = self.filterMatches
+		self.currentFilter = newFilter
+		with tracer.span('filter', 'filter', query=newFilter) as span:
+			if newFilter != '' and previousMatches is not None and previousFilter in newFilter:
+				# Every row matching the new filter matched the previous one
+				self.filterMatches = self.historyStore.narrow(previousMatches, newFilter)
+				self.hideRows(getDroppedRanges(previousMatches, self.filterMatches))
+				self.selectVisibleRow()
+				span.set(narrowed=True)
+			else:
+				self.refilter()
+			span.set(rows=self.getVisibleRowCount())
+		self.timeit('applyFilter', self.getVisibleRowCount())
+		self.loadPagesForFilter()
+		return False # Cancel applyFilterTimer interval
+
+	def resetApplyFilterTimer(self):
+		if self.applyFilterTimer != 0:
+			GLib.source_remove(self.applyFilterTimer)
+			self.applyFilterTimer = 0
+
+	def debouncedApplyFilter(self, newFilter):
+		self.resetApplyFilterTimer()
+		self.applyFilterTimer = GLib.timeout_add(400, self.applyFilter, newFilter)
+
+
+
+class HistoryView(MonospaceView, HistorySource):
+	def __init__(self, session):
+		MonospaceView.__init__(self)
+		if isGtk3:
+			self.override_font(Pango.font_description_from_string('Monospace 10'))
+		self.initHistorySource(session)
+		self.appendingChunk = False
+		self.selectedShaRow = -1
+		self.graphGutterReady = False
+		self.graphWindow = (0, [])
+		self.graphArea = None
 
 	def initTags(self):
 		if self.tagsReady:
@@ -341,170 +4763,796 @@ class HistoryView(MonospaceView):
 		self.tag_tag = buf.create_tag("tag", foreground="#f0dfaf") # Yellow / Color4
 		# self.tag_summary = buf.create_tag("summary", foreground="#1abc9c") # Normal
 		self.tag_selected = buf.create_tag("selected", weight=Pango.Weight.BOLD, foreground="#111111", background="#dfaf8f")
+		self.tag_filtered = buf.create_tag("filtered", invisible=True)
 		MonospaceView.initTags(self)
 
-	def setDirPath(self, dirPath):
-		self.dirPath = dirPath
+	def clearRows(self):
+		self.appendingChunk = True
+		buf = self.get_buffer()
+		buf.set_text('')
+		self.appendingChunk = False
+		self.initTags()
+		self.resetFormatted()
+		self.initScroll()
 
-	def setBranchFilter(self, branchFilter):
-		self.branchFilter = branchFilter
-		self.populate()
+	def appendRows(self, lines):
+		buf = self.get_buffer()
+		lineOffset = self.getRowCount()
+		text = '\n'.join(lines)
+		if lineOffset > 0:
+			text = '\n' + text
+
+		# Appending at the end drags the cursor along, keep it where it was
+		self.appendingChunk = True
+		cursorOffset = buf.props.cursor_position
+		with tracer.span('insert', 'view', chars=len(text)):
+			buf.insert(buf.get_end_iter(), text)
+		buf.place_cursor(buf.get_iter_at_offset(cursorOffset))
+		self.appendingChunk = False
+
+		self.scheduleFormatVisibleSoon()
+		return lineOffset
+
+	def setRows(self, lines):
+		self.setAndFormatText('\n'.join(lines))
+
+	def spliceRows(self, index, removeCount, lines):
+		buf = self.get_buffer()
+		rowCount = self.getRowCount()
+		text = '\n'.join(lines)
+		if index + removeCount < rowCount:
+			startIter = GtkTextBuffer_get_iter_at_line(buf, index) # PyGTK GTK4 Workaround
+			endIter = GtkTextBuffer_get_iter_at_line(buf, index + removeCount) # PyGTK GTK4 Workaround
+			if len(lines) >= 1:
+				text += '\n'
+		elif index > 0:
+			startIter = GtkTextBuffer_get_iter_at_line(buf, index - 1) # PyGTK GTK4 Workaround
+			startIter.forward_to_line_end()
+			endIter = buf.get_end_iter()
+			if len(lines) >= 1:
+				text = '\n' + text
+		else:
+			startIter = buf.get_start_iter()
+			endIter = buf.get_end_iter()
+		buf.delete(startIter, endIter)
+		buf.insert(startIter, text)
+
+		# Formatted lines moved
+		buf.remove_tag(self.tag_selected, buf.get_start_iter(), buf.get_end_iter())
+		self.selectedShaRow = -1
+		self.resetFormatted(index)
+		self.scheduleFormatVisibleSoon()
+
+	def getRowCount(self):
+		buf = self.get_buffer()
+		return buf.get_line_count() if buf.get_char_count() > 0 else 0
 
-	def setFileFilter(self, fileFilter):
-		self.fileFilter = fileFilter
-		self.populate()
+	def getSelectedRow(self):
+		buf = self.get_buffer()
+		if buf.get_char_count() == 0:
+			return -1
+		return buf.get_iter_at_mark(buf.get_insert()).get_line()
 
-	def populate(self):
-		self.timeit()
-		cmd = [
-			'git',
-			'-C',
-			cwdAbs,
-			'log',
-			'--oneline',
-			'--graph',
-			'--decorate',
-		]
+	def selectRow(self, index):
+		self.selectLine(index)
+
+	def setAndFormatText(self, text):
+		# This is faster than get_buffer().set_text(logStdout)
+		# textBuffer = Gtk.TextBuffer()
+		# textBuffer.set_text(text)
+		# self.tagsReady = False
+		# self.set_buffer(textBuffer)
+		# self.timeit('TextBuffer')
+
+		buf = self.get_buffer()
+		with tracer.span('set_text', 'view', chars=len(text)):
+			buf.set_text(text)
+		self.timeit('set_text')
+
+		self.initTags()
+		self.timeit('initTags')
+
+		self.selectHead()
+		self.timeit('place_cursor')
+
+		self.resetFormatted()
+		self.formatVisible()
+		self.initScroll()
+		self.timeit('formatVisible')
+
+	def selectHead(self):
+		headIndex = self.historyStore.findHeadRow()
+		if headIndex != -1:
+			self.selectLine(headIndex)
+			return
+
+		# Could not find HEAD, select start of buffer.
+		buf = self.get_buffer()
+		buf.place_cursor(buf.get_start_iter())
+
+	def selectLine(self, lineNumber):
+		buf = self.get_buffer()
+		lineStartIter = GtkTextBuffer_get_iter_at_line(buf, lineNumber) # PyGTK GTK4 Workaround
+		buf.place_cursor(lineStartIter)
+
+		# Scroll to cursor doesn't work this early it seems.
+		self.scroll_to_iter(
+			lineStartIter,
+			within_margin=0.0,
+			use_align=True,
+			xalign=0.0, # Left Align
+			yalign=0.0, # Top Align
+		)
+
+	def onViewScroll(self, adjustment, data=None):
+		MonospaceView.onViewScroll(self, adjustment, data)
+		self.onHistoryScroll(adjustment)
+
+	#--- Search
+	def getSearchText(self):
+		# The store holds the same lines as the buffer
+		return (self.historyStore.getText(), self.historyStore.lineStarts)
+
+	def loadMoreSearchText(self):
+		return self.loadNextPage()
+
+	def isSearchLineVisible(self, line):
+		return self.isRowVisible(line)
+
+	#--- Filter mask
+	def clearRowMask(self):
+		self.initTags()
+		buf = self.get_buffer()
+		buf.remove_tag(self.tag_filtered, buf.get_start_iter(), buf.get_end_iter())
+		self.scheduleFormatVisibleSoon()
+
+	def setRowMask(self, matches):
+		self.clearRowMask()
+		self.hideRows(getHiddenRanges(matches, 0, self.getRowCount()))
+
+	def hideRows(self, ranges):
+		self.initTags()
+		buf = self.get_buffer()
+		rowCount = self.getRowCount()
+		for start, end in ranges:
+			if end < rowCount:
+				startIter = GtkTextBuffer_get_iter_at_line(buf, start) # PyGTK GTK4 Workaround
+				endIter = GtkTextBuffer_get_iter_at_line(buf, end) # PyGTK GTK4 Workaround
+			elif start > 0:
+				# Hide the newline before the last rows, not an empty line after them
+				startIter = GtkTextBuffer_get_iter_at_line(buf, start - 1) # PyGTK GTK4 Workaround
+				startIter.forward_to_line_end()
+				endIter = buf.get_end_iter()
+			else:
+				startIter = buf.get_start_iter()
+				endIter = buf.get_end_iter()
+			buf.apply_tag(self.tag_filtered, startIter, endIter)
+		if len(ranges) > 0:
+			self.scheduleFormatVisibleSoon()
+
+	def scheduleFormatVisibleSoon(self):
+		if self.formatVisibleTimer == 0:
+			self.scheduleFormatVisible(delay=20)
+
+	def getVisibleLineNumbers(self, y1, y2):
+		# The lines between y1 and y2 can be mostly hidden rows
+		if self.filterMatches is None:
+			return range(y1, y2 + 1)
+		first = bisect.bisect_left(self.filterMatches, y1)
+		last = bisect.bisect_right(self.filterMatches, y2)
+		return self.filterMatches[first:last]
+
+	def formatLine(self, buf, text, startIter, endIter, y):
+		graphEnd, shaEnd, decorationsEnd, refSpans = self.historyStore.getRow(y)
+		if graphEnd == -1:
+			return
+		lineOffset = startIter.get_offset()
+		def applyTag(tag, start, end):
+			if start < end:
+				buf.apply_tag(tag, buf.get_iter_at_offset(lineOffset + start), buf.get_iter_at_offset(lineOffset + end))
+
+		applyTag(self.tag_graph, 0, graphEnd)
+		if shaEnd != -1:
+			applyTag(self.tag_sha, graphEnd, shaEnd)
+		if decorationsEnd != -1:
+			applyTag(self.tag_decorations, shaEnd + 1, decorationsEnd)
+		for kind, start, end in refSpans:
+			applyTag(self.getDecorationTag(kind), start, end)
+
+	def refreshRows(self, rows):
+		buf = self.get_buffer()
+		for row in rows:
+			if row >= self.getRowCount() or row not in self.formattedLines:
+				continue
+			for text, startIter, endIter, y in self.iterLines(row, row):
+				buf.remove_tag(self.tag_local, startIter, endIter)
+				buf.remove_tag(self.tag_remote, startIter, endIter)
+				self.formatLine(buf, text, startIter, endIter, y)
+
+	def highlightSelectedRow(self, row):
+		buf = self.get_buffer()
+		if 0 <= self.selectedShaRow < self.getRowCount():
+			startIter = GtkTextBuffer_get_iter_at_line(buf, self.selectedShaRow) # PyGTK GTK4 Workaround
+			endIter = startIter.copy()
+			endIter.forward_to_line_end()
+			buf.remove_tag(self.tag_selected, startIter, endIter)
+		self.selectedShaRow = row
+		graphEnd, shaEnd, decorationsEnd, refSpans = self.historyStore.getRow(row)
+		if shaEnd != -1:
+			startIter = GtkTextBuffer_get_iter_at_line_offset(buf, row, graphEnd) # PyGTK GTK4 Workaround
+			endIter = GtkTextBuffer_get_iter_at_line_offset(buf, row, shaEnd) # PyGTK GTK4 Workaround
+			buf.apply_tag(self.tag_selected, startIter, endIter)
+
+	#--- Native graph
+	def formatVisible(self):
+		MonospaceView.formatVisible(self)
+		if GitzConfig.nativeGraph:
+			self.updateGraphGutter()
 
-		if not (self.branchFilter is None or self.branchFilter == ''):
-			cmd.append(self.branchFilter)
+	def getVisibleLines(self):
+		r = self.get_visible_rect()
+		iterTop, yTop = self.get_line_at_y(r.y)
+		iterBottom, yBottom = self.get_line_at_y(r.y + r.height)
+		return iterTop.get_line(), iterBottom.get_line()
 
-		if GitzConfig.hideKdeSilentCommits:
-			cmd.append('--grep=_SILENT')
-			cmd.append('--invert-grep')
+	def initGraphGutter(self):
+		if self.graphGutterReady:
+			return
+		if isGtk3:
+			self.connect_after('draw', self.onDrawGtk3)
+		elif isGtk4:
+			self.graphArea = Gtk.DrawingArea()
+			self.graphArea.set_draw_func(self.onDrawGraphArea)
+			self.set_gutter(Gtk.TextWindowType.LEFT, self.graphArea)
+		self.graphGutterReady = True
+
+	def updateGraphGutter(self):
+		# Only the rows in view are laid out, the gutter is as wide as
+		# the lanes they use.
+		self.initGraphGutter()
+		lineTop, lineBottom = self.getVisibleLines()
+		rows = self.commitGraph.getRows(lineTop, lineBottom) if self.isGraphVisible() else []
+		self.graphWindow = (lineTop, rows)
+		laneCount = max([laneCount for column, edges, laneCount in rows], default=0)
+		width = getGraphWidth(laneCount)
+		if isGtk3:
+			if self.get_border_window_size(Gtk.TextWindowType.LEFT) != width:
+				self.set_border_window_size(Gtk.TextWindowType.LEFT, width)
+			self.queue_draw()
+		elif isGtk4:
+			self.graphArea.set_content_width(width)
+			self.graphArea.queue_draw()
 
-		if not (self.fileFilter is None or self.fileFilter == ''):
-			cmd.append(self.fileFilter)
-		elif self.dirPath != None:
-			cmd.append(self.dirPath)
+	def drawGraph(self, cr):
+		buf = self.get_buffer()
+		lineTop, rows = self.graphWindow
+		for i, geometry in enumerate(rows):
+			lineIter = GtkTextBuffer_get_iter_at_line(buf, lineTop + i) # PyGTK GTK4 Workaround
+			lineY, lineHeight = self.get_line_yrange(lineIter)
+			if lineHeight == 0:
+				continue
+			windowX, windowY = self.buffer_to_window_coords(Gtk.TextWindowType.LEFT, 0, lineY)
+			drawGraphRow(cr, geometry, 0, windowY, lineHeight)
+
+	# https://docs.gtk.org/gtk3/signal.Widget.draw.html
+	def onDrawGtk3(self, widget, cr):
+		window = self.get_window(Gtk.TextWindowType.LEFT)
+		if window is not None and Gtk.cairo_should_draw_window(cr, window):
+			cr.save()
+			Gtk.cairo_transform_to_window(cr, self, window)
+			self.drawGraph(cr)
+			cr.restore()
+		return False
+
+	# https://docs.gtk.org/gtk4/method.DrawingArea.set_draw_func.html
+	def onDrawGraphArea(self, area, cr, width, height):
+		self.drawGraph(cr)
+
+	def getDecorationTag(self, kind):
+		if kind == 'tag':
+			return self.tag_tag
+		elif kind == 'head':
+			return self.tag_head
+		elif kind == 'remote':
+			return self.tag_remote
+		else:
+			return self.tag_local
 
-		process = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-		self.timeit('process')
-		self.logStdout = process.stdout.strip()
-		self.timeit('strip')
 
-		cmd = [
-			'git',
-			'-C',
-			cwdAbs,
-			'remote',
-		]
-		process = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-		self.timeit('remote.process')
-		self.remoteStdout = process.stdout.strip()
-		self.remoteList = self.remoteStdout.split('\n')
-		self.timeit('remote.strip')
 
-		self.setAndFormatText(self.logStdout)
+class GraphCellRenderer(Gtk.CellRenderer):
+	# Draws one row of the native history graph in the GTK3 HistoryListView.
+	row = GObject.Property(type=int, default=-1)
 
-	def setAndFormatText(self, text):
-		# This is faster than get_buffer().set_text(logStdout)
-		# textBuffer = Gtk.TextBuffer()
-		# textBuffer.set_text(text)
-		# self.tagsReady = False
-		# self.set_buffer(textBuffer)
-		# self.timeit('TextBuffer')
+	def __init__(self, historyView):
+		Gtk.CellRenderer.__init__(self)
+		self.historyView = historyView
 
-		buf = self.get_buffer()
-		buf.set_text(text)
-		self.timeit('set_text')
+	def do_render(self, cr, widget, backgroundArea, cellArea, flags):
+		if self.row == -1 or not self.historyView.isGraphVisible():
+			return
+		geometry = self.historyView.getGraphRow(self.row)
+		if geometry is not None:
+			drawGraphRow(cr, geometry, cellArea.x, backgroundArea.y, backgroundArea.height)
+
+
+
+def appendStoreRows(store, count):
+	# Rows of a GTK3 ListStore without values
+	append = store.append
+	for i in range(count):
+		append()
+
+class HistoryRowModel(GObject.Object, Gio.ListModel):
+	# Gio.ListModel over the rows of the GTK4 HistoryListView. Items are
+	# only created for the positions the ListView asks for. While a filter
+	# is active visibleRows maps positions to rows.
+	def __init__(self, historyStore):
+		GObject.Object.__init__(self)
+		self.historyStore = historyStore
+		self.rowCount = 0
+		self.visibleRows = None
+		self.itemCount = 0
+
+	def do_get_item_type(self):
+		return Gtk.StringObject.__gtype__
+
+	def do_get_n_items(self):
+		if self.visibleRows is None:
+			return self.rowCount
+		return len(self.visibleRows)
+
+	def do_get_item(self, position):
+		if position >= self.do_get_n_items():
+			return None
+		return Gtk.StringObject.new(self.historyStore.getLine(self.getRow(position)))
+
+	def getRow(self, position):
+		if self.visibleRows is None:
+			return position
+		return self.visibleRows[position]
+
+	def getPosition(self, row):
+		# Returns -1 when the row is filtered out
+		if self.visibleRows is None:
+			return row
+		i = bisect.bisect_left(self.visibleRows, row)
+		if i < len(self.visibleRows) and self.visibleRows[i] == row:
+			return i
+		return -1
+
+	def itemsChanged(self, position, removed, added):
+		self.itemCount += added - removed
+		self.items_changed(position, removed, added)
+
+	def setVisibleRows(self, visibleRows):
+		if visibleRows is not None and visibleRows is self.visibleRows:
+			# The same matches, extended while the log streams in
+			self.itemsChanged(self.itemCount, 0, len(visibleRows) - self.itemCount)
+		else:
+			self.visibleRows = visibleRows
+			self.itemsChanged(0, self.itemCount, self.do_get_n_items())
 
-		self.initTags()
-		self.timeit('initTags')
 
-		self.selectHead()
-		self.timeit('place_cursor')
 
-		self.lineFormattedMap.clear()
-		self.formatVisible()
-		self.initScroll()
-		self.timeit('formatVisible')
+class HistoryListView(GtkListWidget, HistorySource, SearchSource, StepTimer):
+	# Virtualized alternative to HistoryView. Rows are only rendered
+	# for the commits that are visible, so memory and layout time do
+	# not grow with the size of the history.
+	rowFont = 'Monospace 10'
+	rebuildRows = 1000 # GTK3 edits of more rows fill a new ListStore instead of signalling each row
 
-	def selectHead(self):
-		buf = self.get_buffer()
-		for match in LOG_PATTERN.finditer(self.getAllText()):
-			if match.group(4):
-				lineStart = match.start(0)
-				groupStart = match.start(4)
-				for subMatch in re.finditer(r'(\(|, )(HEAD)( -> (.+?))?(,|\))', match.group(4)):
-
-					lineStartIter = buf.get_iter_at_offset(lineStart)
-					buf.place_cursor(lineStartIter)
-
-					# Scroll to cursor doesn't work this early it seems.
-					self.scroll_to_iter(
-						lineStartIter,
-						within_margin=0.0,
-						use_align=True,
-						xalign=0.0, # Left Align
-						yalign=0.0, # Top Align
-					)
-					return
+	def __init__(self, session):
+		GtkListWidget.__init__(self)
+		self.initHistorySource(session)
+		self.initSearchSource()
+		self.rowCount = 0
+		self.tagsReady = True # TextSearchBar compatibility
+		self.onShaSelected = None
+		self.graphLaneCount = 0
 
-		# Could not find HEAD, select start of buffer.
-		buf.place_cursor(buf.get_start_iter())
+		if isGtk3:
+			# The stores hold empty rows, their text is in historyStore.
+			# While a filter is active maskStore has a row per visibleRows.
+			self.listStore = Gtk.ListStore(str)
+			self.maskStore = None
+			self.visibleRows = None
+			self.set_model(self.listStore)
+			self.set_headers_visible(False)
+			self.set_fixed_height_mode(True)
+			self.set_enable_search(False)
+			renderer = Gtk.CellRendererText(font=self.rowFont)
+			column = Gtk.TreeViewColumn()
+			column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+			column.set_expand(True)
+			if GitzConfig.nativeGraph:
+				self.graphRenderer = GraphCellRenderer(self)
+				self.graphRenderer.set_fixed_size(0, -1)
+				column.pack_start(self.graphRenderer, False)
+				column.set_cell_data_func(self.graphRenderer, self.onGraphCellData)
+			column.pack_start(renderer, True)
+			column.set_cell_data_func(renderer, self.onCellData)
+			self.append_column(column)
+			self.get_selection().set_mode(Gtk.SelectionMode.BROWSE)
+			self.get_selection().connect('changed', self.onSelectionChanged)
+		elif isGtk4:
+			self.rowModel = HistoryRowModel(self.historyStore)
+			self.selection = Gtk.SingleSelection(model=self.rowModel)
+			self.selection.connect('notify::selected', self.onSelectionChanged)
+			factory = Gtk.SignalListItemFactory()
+			factory.connect('setup', self.onListItemSetup)
+			factory.connect('bind', self.onListItemBind)
+			self.set_model(self.selection)
+			self.set_factory(factory)
+		self.connect('notify::vadjustment', self.onVAdjustmentChanged)
+
+	#--- Rows
+	# Row text lives in historyStore, the models only hold the row count.
+	def getRowCount(self):
+		return self.rowCount
+
+	def clearRows(self):
+		self.onSearchTextChanged()
+		self.rowCount = 0
+		if isGtk3:
+			self.visibleRows = None
+			self.maskStore = None
+			self.listStore = Gtk.ListStore(str) # clear() signals every row
+			self.set_model(self.listStore)
+		elif isGtk4:
+			self.rowModel.rowCount = 0
+			self.rowModel.visibleRows = None
+			self.rowModel.itemsChanged(0, self.rowModel.itemCount, 0)
+
+	def appendRows(self, lines):
+		self.onSearchTextChanged()
+		rowOffset = self.rowCount
+		self.rowCount += len(lines)
+		if isGtk3:
+			if self.visibleRows is None and len(lines) > max(self.rebuildRows, rowOffset):
+				self.listStore = self.createStore(self.rowCount)
+				self.swapModel(self.listStore, self.getSelectedRow(), keepScroll=True)
+			else:
+				appendStoreRows(self.listStore, len(lines))
+		elif isGtk4:
+			self.rowModel.rowCount = self.rowCount
+			if self.rowModel.visibleRows is None:
+				self.rowModel.itemsChanged(rowOffset, 0, len(lines))
+		return rowOffset
+
+	def spliceRows(self, index, removeCount, lines):
+		# While filtering, HistorySource.refilter() remaps the rows afterwards
+		self.onSearchTextChanged()
+		self.rowCount += len(lines) - removeCount
+		if isGtk3:
+			if removeCount + len(lines) > self.rebuildRows:
+				# HistorySource.applyLogEdits() selects the commit again
+				self.listStore = self.createStore(self.rowCount)
+				if self.visibleRows is None:
+					self.set_model(self.listStore)
+			else:
+				for i in range(removeCount):
+					self.listStore.remove(self.listStore.iter_nth_child(None, index))
+				for i in range(len(lines)):
+					self.listStore.insert(index + i)
+		elif isGtk4:
+			self.rowModel.rowCount = self.rowCount
+			if self.rowModel.visibleRows is None:
+				self.rowModel.itemsChanged(index, removeCount, len(lines))
 
-	def formatLine(self, buf, text, startIter, endIter, y):
-		searchOffset = startIter.get_offset()
-		# print('formatLine', searchOffset, text)
+	def refreshRows(self, rows):
+		if isGtk3:
+			self.queue_draw()
+		elif isGtk4:
+			selectedRow = self.getSelectedRow()
+			for row in rows:
+				position = self.rowModel.getPosition(row) if row < self.rowCount else -1
+				if position != -1 and position < self.rowModel.itemCount:
+					self.rowModel.items_changed(position, 1, 1) # Bind the item again
+			if selectedRow != -1 and selectedRow in rows:
+				self.selection.set_selected(self.rowModel.getPosition(selectedRow))
+
+	def onVAdjustmentChanged(self, widget, pspec):
+		# Set by the ScrolledWindow
+		adjustment = Gtk.Scrollable.get_vadjustment(self)
+		if adjustment is not None:
+			adjustment.connect('value-changed', self.onHistoryScroll)
+
+	#--- Filter mask
+	def clearRowMask(self):
+		if isGtk3:
+			if self.visibleRows is not None:
+				selectedRow = self.getSelectedRow()
+				self.visibleRows = None
+				self.maskStore = None
+				self.swapModel(self.listStore, selectedRow)
+		elif isGtk4:
+			if self.rowModel.visibleRows is not None:
+				self.setVisibleRows(None)
 
-		for match in LOG_PATTERN.finditer(text):
-			applyTagForGroup(buf, match, 1, self.tag_graph, searchOffset=searchOffset)
-			applyTagForGroup(buf, match, 3, self.tag_sha, searchOffset=searchOffset)
-			applyTagForGroup(buf, match, 4, self.tag_decorations, searchOffset=searchOffset)
-			# applyTagForGroup(buf, match, 5, self.tag_summary, searchOffset=searchOffset)
+	def setRowMask(self, matches):
+		self.setVisibleRows(matches)
 
-			if match.group(4):
-				groupOffset = searchOffset + match.start(4)
-				for subMatch in re.finditer(r'(\(|, )(tag: .+?)(,|\))', match.group(4)):
-					applyTagForGroup(buf, subMatch, 2, self.tag_tag, searchOffset=groupOffset)
-				for subMatch in re.finditer(r'(\(|, )((HEAD -> )?([^,\)]+))', match.group(4)):
-					if subMatch.group(3) is not None:
-						applyTagForGroup(buf, subMatch, 3, self.tag_head, searchOffset=groupOffset)
-
-					refName = subMatch.group(4)
-					isRemote = False
-					for remoteName in self.remoteList:
-						if refName.startswith(remoteName + '/'):
-							isRemote = True
-							break
-					if isRemote:
-						applyTagForGroup(buf, subMatch, 4, self.tag_remote, searchOffset=groupOffset)
-					else:
-						applyTagForGroup(buf, subMatch, 4, self.tag_local, searchOffset=groupOffset)
+	def hideRows(self, ranges):
+		# The rows of ranges were dropped from filterMatches
+		self.setVisibleRows(self.filterMatches)
 
-	#---
-	def applyFilter(self, newFilter):
-		if newFilter == '':
-			self.setAndFormatText(self.logStdout)
+	def setVisibleRows(self, visibleRows):
+		selectedRow = self.getSelectedRow()
+		if isGtk3:
+			if visibleRows is not None and visibleRows is self.visibleRows:
+				# The same matches, extended while the log streams in
+				appendStoreRows(self.maskStore, len(visibleRows) - len(self.maskStore))
+				return
+			self.visibleRows = visibleRows
+			self.maskStore = self.createStore(len(visibleRows))
+			self.swapModel(self.maskStore, selectedRow)
+		elif isGtk4:
+			self.rowModel.setVisibleRows(visibleRows)
+			position = self.rowModel.getPosition(selectedRow) if selectedRow != -1 else -1
+			if position != -1:
+				self.selection.set_selected(position)
+
+	def createStore(self, rowCount):
+		# Filled before a view is attached, so no row is signalled
+		store = Gtk.ListStore(str)
+		appendStoreRows(store, rowCount)
+		return store
+
+	def swapModel(self, model, selectedRow, keepScroll=False):
+		# The TreeView reads the new model in one go. The selected row
+		# stays selected, scrolled to unless the rows above are the same.
+		adjustment = Gtk.Scrollable.get_vadjustment(self)
+		value = adjustment.get_value() if adjustment is not None else 0
+		self.set_model(model)
+		if selectedRow != -1 and not keepScroll:
+			self.selectRow(selectedRow)
+			return
+		path = self.getModelPath(selectedRow) if selectedRow != -1 else None
+		if path is not None:
+			self.set_cursor(path, None, False)
+		if adjustment is not None:
+			adjustment.set_value(value)
+
+	def setRows(self, lines):
+		self.clearRows()
+		self.appendRows(lines)
+		headIndex = self.historyStore.findHeadRow()
+		if headIndex != -1:
+			self.selectRow(headIndex)
+		elif len(lines) >= 1:
+			self.selectRow(0)
+
+	def selectRow(self, index):
+		if isGtk3:
+			path = self.getModelPath(index)
+			if path is None:
+				return
+			self.set_cursor(path, None, False)
+			self.scroll_to_cell(path, None, True, 0.0, 0.0)
+		elif isGtk4:
+			position = self.rowModel.getPosition(index)
+			if position == -1:
+				return
+			self.selection.set_selected(position)
+			self.activate_action('list.scroll-to-item', GLib.Variant('u', position))
 
-			pass
+	def getSelectedRow(self):
+		if isGtk3:
+			model, treeIter = self.get_selection().get_selected()
+			if treeIter is None:
+				return -1
+			return self.getPathRow(model, model.get_path(treeIter))
+		elif isGtk4:
+			position = self.selection.get_selected()
+			if position == Gtk.INVALID_LIST_POSITION:
+				return -1
+			return self.rowModel.getRow(position)
+
+	def getModelPath(self, index):
+		# TreePath of the row in the model shown by the GTK3 TreeView,
+		# None when it is filtered out
+		if self.visibleRows is None:
+			return Gtk.TreePath.new_from_indices([index])
+		i = bisect.bisect_left(self.visibleRows, index)
+		if i < len(self.maskStore) and self.visibleRows[i] == index:
+			return Gtk.TreePath.new_from_indices([i])
+		return None
+
+	def getPathRow(self, model, path):
+		if model is self.maskStore:
+			return self.visibleRows[path.get_indices()[0]]
+		return path.get_indices()[0]
+
+	def onSelectionChanged(self, *args):
+		index = self.getSelectedRow()
+		if index == -1:
+			return
+		sha = self.historyStore.getSha(index)
+		if sha is not None and self.onShaSelected is not None:
+			self.onShaSelected(sha)
+
+	#--- Rendering
+	def formatMarkup(self, row, selected=False):
+		line = self.historyStore.getLine(row)
+		graphEnd, shaEnd, decorationsEnd, refSpans = self.historyStore.getRow(row)
+		if graphEnd == -1:
+			return GLib.markup_escape_text(line)
+
+		def span(text, foreground, bold=False, background=None):
+			if text == '':
+				return ''
+			attrs = 'foreground="{}"'.format(foreground)
+			if bold:
+				attrs += ' weight="bold"'
+			if background is not None:
+				attrs += ' background="{}"'.format(background)
+			return '<span {}>{}</span>'.format(attrs, GLib.markup_escape_text(text))
+
+		markup = span(line[:graphEnd], '#1abc9c')
+		if shaEnd == -1:
+			return markup
+		if selected:
+			markup += span(line[graphEnd:shaEnd], '#111111', bold=True, background='#dfaf8f')
 		else:
-			# We need to re-populate then filter
-			filteredLines = []
-			for line in self.logStdout.splitlines():
-				if newFilter in line:
-					filteredLines.append(line)
-			self.setAndFormatText('\n'.join(filteredLines))
-
-		self.currentFilter = newFilter
-
-		self.applyFilterTimer = 0
-		return False # Cancel applyFilterTimer interval
+			markup += span(line[graphEnd:shaEnd], '#dfaf8f')
+		markup += ' '
+		pos = shaEnd + 1
+		if decorationsEnd != -1:
+			for kind, start, end in sorted(refSpans, key=lambda s: s[1]):
+				if start < pos:
+					continue # "tag: " refs are matched as both a tag and a ref name
+				markup += span(line[pos:start], '#dca3a3')
+				if kind == 'tag':
+					markup += span(line[start:end], '#f0dfaf', bold=True)
+				elif kind == 'head':
+					markup += span(line[start:end], '#93e0e3', bold=True)
+				elif kind == 'remote':
+					markup += span(line[start:end], '#dca3a3', bold=True)
+				else:
+					markup += span(line[start:end], '#72d5a3', bold=True)
+				pos = end
+			markup += span(line[pos:decorationsEnd], '#dca3a3')
+			pos = decorationsEnd
+		markup += span(line[pos:], '#1abc9c')
+		return markup
+
+	# https://docs.gtk.org/gtk3/method.TreeViewColumn.set_cell_data_func.html
+	def onCellData(self, column, cell, model, treeIter, data=None):
+		row = self.getPathRow(model, model.get_path(treeIter))
+		selected = self.get_selection().iter_is_selected(treeIter)
+		cell.set_property('markup', self.formatMarkup(row, selected))
+
+	def onGraphCellData(self, column, cell, model, treeIter, data=None):
+		cell.row = self.getPathRow(model, model.get_path(treeIter))
+		cell.set_fixed_size(getGraphWidth(self.graphLaneCount), -1)
+
+	def getGraphRow(self, row):
+		# Rows share the widest lane count seen so far so the summaries line up
+		geometry = self.commitGraph.getRow(row)
+		if geometry is not None and geometry[2] > self.graphLaneCount:
+			self.graphLaneCount = geometry[2]
+			if isGtk3:
+				self.graphRenderer.set_fixed_size(getGraphWidth(self.graphLaneCount), -1)
+				self.columns_autosize()
+		return geometry
+
+	# https://docs.gtk.org/gtk4/class.SignalListItemFactory.html
+	def onListItemSetup(self, factory, listItem):
+		label = Gtk.Label(xalign=0.0)
+		label.add_css_class('monospace')
+		if GitzConfig.nativeGraph:
+			box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+			box.append(Gtk.DrawingArea())
+			box.append(label)
+			listItem.set_child(box)
+		else:
+			listItem.set_child(label)
+		listItem.connect('notify::selected', self.onListItemSelected)
 
-	def resetApplyFilterTimer(self):
-		if self.applyFilterTimer != 0:
-			GLib.source_remove(self.applyFilterTimer)
-			self.applyFilterTimer = 0
+	def onListItemBind(self, factory, listItem):
+		self.renderListItem(listItem)
 
-	def debouncedApplyFilter(self, newFilter):
-		self.resetApplyFilterTimer()
-		self.applyFilterTimer = GLib.timeout_add(400, self.applyFilter, newFilter)
+	def onListItemSelected(self, listItem, pspec):
+		self.renderListItem(listItem)
 
+	def renderListItem(self, listItem):
+		item = listItem.get_item()
+		if item is None:
+			return
+		label = listItem.get_child()
+		row = self.rowModel.getRow(listItem.get_position())
+		if GitzConfig.nativeGraph:
+			graphArea = label.get_first_child()
+			label = graphArea.get_next_sibling()
+			geometry = self.getGraphRow(row) if self.isGraphVisible() else None
+			graphArea.set_content_width(getGraphWidth(self.graphLaneCount) if geometry is not None else 0)
+			graphArea.set_draw_func(self.onDrawListItemGraph, geometry)
+		label.set_markup(self.formatMarkup(row, listItem.get_selected()))
+
+	def onDrawListItemGraph(self, area, cr, width, height, geometry):
+		if geometry is not None:
+			drawGraphRow(cr, geometry, 0, 0, height)
+
+	#--- Search
+	def getSearchText(self):
+		return (self.historyStore.getText(), self.historyStore.lineStarts)
+
+	def getSearchCursor(self):
+		# Start looking after the selected row
+		selectedRow = self.getSelectedRow()
+		if selectedRow == -1:
+			return 0
+		return self.historyStore.getLineEnd(selectedRow) + 1
+
+	def isSearchLineVisible(self, line):
+		return self.isRowVisible(line)
+
+	def showSearchMatch(self, index):
+		self.selectRow(self.textSearch.lines[index])
+
+	def loadMoreSearchText(self):
+		return self.loadNextPage()
+
+
+
+class LazyPatch:
+	# A file of a large commit, its patch is only loaded once shown
+	def __init__(self, index, paths, added, deleted):
+		self.index = index
+		self.paths = paths # (path,) or (oldPath, newPath) when renamed
+		self.added = added
+		self.deleted = deleted
+		isLarge = added + deleted > GitzConfig.lazyPatchCollapseLines
+		self.state = 'collapsed' if isLarge else 'pending' # Then 'loading', 'loaded'
+
+	def getPlaceholder(self):
+		label = ' => '.join(self.paths)
+		if self.added < 0:
+			counts = 'binary'
+		else:
+			counts = '+{} -{}'.format(self.added, self.deleted)
+		if self.state == 'collapsed':
+			return 'diff {} ({}, click to load)'.format(label, counts)
+		else:
+			return 'diff {} ({})'.format(label, counts)
+
+def parseNumstat(numstatStdout):
+	# Parses `git show --numstat -z` into LazyPatches
+	lazyPatches = []
+	tokens = numstatStdout.split('\0')
+	i = 0
+	while i < len(tokens):
+		token = tokens[i].lstrip('\n')
+		i += 1
+		if token == '':
+			continue
+		added, deleted, path = token.split('\t', 2)
+		if path == '': # Renamed, the old and new paths follow
+			paths = (tokens[i], tokens[i+1])
+			i += 2
+		else:
+			paths = (path,)
+		if added == '-': # Binary
+			added = deleted = -1
+		lazyPatches.append(LazyPatch(len(lazyPatches), paths, int(added), int(deleted)))
+	return lazyPatches
+
+def formatStatHeader(statStdout):
+	# Splits `git show --stat` into lines and separates the diffstat with
+	# '---' like --patch-with-stat does.
+	lines = statStdout.rstrip('\n').split('\n')
+	if STATSUMMARY_PATTERN.match(lines[-1]):
+		i = len(lines) - 1
+		while i > 0 and lines[i-1] != '':
+			i -= 1
+		if i > 0:
+			lines[i-1] = '---'
+	return lines
 
 
 class CommitView(MonospaceView):
-	def __init__(self):
+	def __init__(self, session):
 		MonospaceView.__init__(self)
 		# self.set_wrap_mode(Gtk.WrapMode.WORD)
 		if isGtk3:
@@ -512,6 +5560,19 @@ class CommitView(MonospaceView):
 		self.dirPath = None
 		self.currentSha = ''
 		self.showingAll = False
+		self.commitProcess = None
+		self.loadCommitTimer = 0
+		self.session = session
+		self.commitCache = session.commitCache # Shared by the windows of the repo
+		self.prefetchQueue = []
+		self.prefetchProcess = None
+		self.sectionSpans = [] # LineSpans of the header, then of each file in lazy mode
+		self.sectionStarts = [] # First line of each section
+		self.lazyPatches = []
+		self.patchQueue = []
+		self.patchProcess = None
+		self.onCommitShown = None
+		self.get_buffer().connect('notify::cursor-position', self.onCursorMoved)
 
 	def initTags(self):
 		if self.tagsReady:
@@ -552,29 +5613,88 @@ class CommitView(MonospaceView):
 		if sha == self.currentSha and showAll == self.showingAll:
 			return
 
-		self.timeit()
-		cmd = [
-			'git',
-			'-C',
-			cwdAbs,
-			'show',
-			sha,
-			'--patch-with-stat',
-		]
 		if self.dirPath is None:
 			showAll = True
-		if self.dirPath is not None and not showAll:
-			cmd += [
-				'--relative',
-				self.dirPath,
-			]
+		self.currentSha = sha
+		self.showingAll = showAll
 
-		self.commitProcess = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-		commitStdout = self.commitProcess.stdout
-		self.timeit('process')
+		self.cancelLoadCommit()
+		cached = self.commitCache.get(self.getCommitKey(sha, showAll))
+		if cached is not None:
+			self.timeit()
+			commitStdout, spans = cached
+			self.setCommitText(commitStdout, spans)
+			return
+
+		# Holding an arrow key selects a new commit every key repeat.
+		# Only load the commit once the selection settles, and drop
+		# any git show that is still running for an older selection.
+		self.loadCommitTimer = GLib.timeout_add(GitzConfig.loadCommitDelay, self.loadCommit, sha, showAll)
 
+	def getCommitKey(self, sha, showAll):
+		return (sha, self.dirPath, showAll)
+
+	def getRelativeDir(self, showAll):
+		if self.dirPath is not None and not showAll:
+			return self.dirPath
+		return None
+
+	def requestCommit(self, sha, showAll, onDone):
+		# onDone(None) when the commit is larger than lazyPatchBytes
+		return self.session.backend.requestCommit(sha, self.getRelativeDir(showAll), onDone, maxBytes=GitzConfig.lazyPatchBytes)
+
+	def cancelLoadCommit(self):
+		if self.loadCommitTimer != 0:
+			GLib.source_remove(self.loadCommitTimer)
+			self.loadCommitTimer = 0
+		if self.commitProcess is not None:
+			self.commitProcess.cancel()
+			self.commitProcess = None
+		if self.patchProcess is not None:
+			self.patchProcess.cancel()
+			self.patchProcess = None
+
+	def loadCommit(self, sha, showAll):
+		self.loadCommitTimer = 0
+		self.timeit()
+		self.cancelPrefetch()
+
+		def onSpans(result):
+			commitStdout, spans = result
+			self.commitCache.put(self.getCommitKey(sha, showAll), commitStdout, spans)
+			if sha == self.currentSha and showAll == self.showingAll:
+				self.timeit('computeViewSpans')
+				self.setCommitText(commitStdout, spans)
+
+		def onDone(commitStdout, error):
+			self.commitProcess = None
+			self.timeit('process')
+			if error == 'overflow':
+				self.loadLazyCommit(sha, showAll)
+				return
+			if error is not None:
+				self.showCommitError(sha)
+				return
+			runInThread(self.computeCommit, (commitStdout,), onSpans)
+			self.prefetchNext()
+
+		self.commitProcess = self.requestCommit(sha, showAll, onDone)
+		return False # Cancel loadCommitTimer
+
+	def setCommitText(self, commitStdout, lineSpans):
+		self.setSections(commitStdout, [lineSpans], [0], [])
+
+	def showCommitError(self, sha):
+		# Not cached, selecting the commit again runs git again
+		text = 'git exited before showing commit {}'.format(sha)
+		self.setCommitText(text, self.computeViewSpans(text))
+
+	def setSections(self, text, sectionSpans, sectionStarts, lazyPatches):
 		buf = self.get_buffer()
-		buf.set_text(commitStdout)
+		self.lazyPatches = []
+		self.patchQueue = []
+		with tracer.span('set_text', 'view', chars=len(text)):
+			buf.set_text(text)
 		self.timeit('set_text')
 
 		self.initTags()
@@ -583,50 +5703,405 @@ class CommitView(MonospaceView):
 		buf.place_cursor(buf.get_start_iter())
 		self.timeit('place_cursor')
 
-		self.formatView()
-		self.timeit('formatView')
-
-		self.lineFormattedMap.clear()
+		self.sectionSpans = sectionSpans
+		self.sectionStarts = sectionStarts
+		self.lazyPatches = lazyPatches
+		self.resetFormatted()
 		self.formatVisible()
 		self.initScroll()
 		self.timeit('formatVisible')
+		if self.onCommitShown is not None:
+			self.onCommitShown(self.currentSha)
+
+	#--- Lazy patches
+	def loadLazyCommit(self, sha, showAll):
+		# The commit is too large to show at once. Show the header and the
+		# diffstat, with one line per file standing in for its patch.
+		def onNumstat(numstatStdout, error):
+			self.commitProcess = None
+			self.timeit('numstat')
+			if sha != self.currentSha or showAll != self.showingAll:
+				return
+			if error is not None:
+				self.showCommitError(sha)
+				return
+			self.setLazyCommit(statStdout, parseNumstat(numstatStdout))
+
+		def onStat(stdout, error):
+			nonlocal statStdout
+			statStdout = stdout
+			self.timeit('stat')
+			if error is not None:
+				self.commitProcess = None
+				self.showCommitError(sha)
+				return
+			self.commitProcess = self.session.backend.requestNumstat(sha, self.getRelativeDir(showAll), onNumstat)
+
+		statStdout = None
+		self.commitProcess = self.session.backend.requestStat(sha, self.getRelativeDir(showAll), onStat)
+
+	def setLazyCommit(self, statStdout, lazyPatches):
+		lines = formatStatHeader(statStdout)
+		lines.append('')
+		tokenizer = DiffTokenizer()
+		tokenizer.feed(lines)
+		sectionSpans = [tokenizer.lineSpans]
+		sectionStarts = [0]
+		for patch in lazyPatches:
+			tokenizer = DiffTokenizer()
+			tokenizer.feed([patch.getPlaceholder()])
+			sectionSpans.append(tokenizer.lineSpans)
+			sectionStarts.append(len(lines))
+			lines.append(patch.getPlaceholder())
+		self.setSections('\n'.join(lines), sectionSpans, array.array('L', sectionStarts), lazyPatches)
+
+	def getSectionAt(self, line):
+		return bisect.bisect_right(self.sectionStarts, line) - 1
+
+	def getFileAtCursor(self):
+		# (path, deleted, line) of the diff at the cursor, with path as the
+		# diff shows it and line the file's line at the cursor. None outside
+		# of a diff.
+		buf = self.get_buffer()
+		cursorLine = buf.get_iter_at_mark(buf.get_insert()).get_line()
+		section = self.getSectionAt(cursorLine)
+		if section >= 1 and self.lazyPatches[section - 1].state != 'loaded':
+			return (self.lazyPatches[section - 1].paths[-1], False, 0)
+
+		# Up to the diff header, counting the lines of the new file
+		fileLine = 0
+		newLines = 0
+		headerLine = -1
+		for y in range(cursorLine, -1, -1):
+			text = self.getLineAt(GtkTextBuffer_get_iter_at_line(buf, y).get_offset())
+			if text.startswith('diff --git ') or text.startswith('diff --cc ') or text.startswith('diff --combined '):
+				headerLine = y
+				break
+			match = HUNK_PATTERN.match(text)
+			if match is not None:
+				if newLines >= 0:
+					fileLine = int(match.group(1)) - 1 + newLines
+					newLines = -1 # Only the nearest hunk
+				continue
+			if newLines >= 0 and y < cursorLine and not text.startswith('-'):
+				newLines += 1
+		if headerLine == -1:
+			return None
+
+		oldPath = None
+		newPath = None
+		for text, startIter, endIter, y in self.iterLines(headerLine + 1, min(headerLine + 8, buf.get_line_count() - 1)):
+			if text.startswith('@@') or text.startswith('diff '):
+				break
+			elif text.startswith('--- '):
+				oldPath = parseDiffPath(text[4:], 'a/')
+			elif text.startswith('+++ '):
+				newPath = parseDiffPath(text[4:], 'b/')
+			elif text.startswith('rename from '):
+				oldPath = unquotePath(text[len('rename from '):])
+			elif text.startswith('rename to '):
+				newPath = unquotePath(text[len('rename to '):])
+		if newPath is not None:
+			return (newPath, False, fileLine)
+		elif oldPath is not None:
+			return (oldPath, True, 0)
+		return None # A binary or mode change
 
-		self.currentSha = sha
-		self.showingAll = showAll
+	def formatVisible(self):
+		MonospaceView.formatVisible(self)
+		self.loadVisiblePatches()
+
+	def loadVisiblePatches(self):
+		if len(self.lazyPatches) == 0 or self.formatWindow is None:
+			return
+		lineTop, lineBottom = self.formatWindow
+		first = max(1, self.getSectionAt(lineTop))
+		last = self.getSectionAt(lineBottom)
+		# Sections after the header are the lazy patches, one off
+		self.patchQueue = [patch for patch in self.lazyPatches[first-1:last] if patch.state == 'pending']
+		self.loadNextPatch()
+
+	def onCursorMoved(self, buf, data=None):
+		if len(self.lazyPatches) == 0:
+			return
+		section = self.getSectionAt(buf.get_iter_at_mark(buf.get_insert()).get_line())
+		if section >= 1:
+			patch = self.lazyPatches[section - 1]
+			if patch.state == 'collapsed':
+				patch.state = 'pending'
+				self.patchQueue.insert(0, patch)
+				self.loadNextPatch()
+
+	def loadNextPatch(self):
+		while len(self.patchQueue) > 0 and self.patchQueue[0].state != 'pending':
+			self.patchQueue.pop(0)
+		if self.patchProcess is not None or len(self.patchQueue) == 0:
+			return
+		patch = self.patchQueue.pop(0)
+		patch.state = 'loading'
+		sha = self.currentSha
+		showAll = self.showingAll
+
+		def onDone(patchStdout):
+			self.patchProcess = None
+			if sha == self.currentSha and showAll == self.showingAll:
+				self.insertPatch(patch, patchStdout)
+			self.loadNextPatch()
+
+		self.patchProcess = self.session.backend.requestPatch(sha, self.getRelativeDir(showAll), patch.paths, onDone)
+
+	def insertPatch(self, patch, patchStdout):
+		# Replaces the placeholder line of the patch with its diff
+		patch.state = 'loaded'
+		patchStdout = patchStdout.rstrip('\n')
+		if patchStdout == '':
+			return
+		section = patch.index + 1
+		lineStart = self.sectionStarts[section]
+		lines = patchStdout.split('\n')
+		tokenizer = DiffTokenizer()
+		tokenizer.feed(lines)
+
+		buf = self.get_buffer()
+		startIter = GtkTextBuffer_get_iter_at_line(buf, lineStart) # PyGTK GTK4 Workaround
+		endIter = startIter.copy()
+		endIter.forward_to_line_end()
+		buf.delete(startIter, endIter)
+		buf.insert(startIter, patchStdout)
+
+		lineDelta = len(lines) - 1
+		sectionStarts = self.sectionStarts
+		for i in range(section + 1, len(sectionStarts)):
+			sectionStarts[i] += lineDelta
+		self.sectionSpans[section] = tokenizer.lineSpans
+		self.resetFormatted(lineStart)
+		self.formatVisible()
+
+	#--- Prefetch
+	def prefetch(self, shas):
+		# Warm the cache with the commits around the selection so browsing
+		# with the arrow keys does not wait on git show.
+		showAll = self.dirPath is None
+		self.prefetchQueue = [sha for sha in shas if self.getCommitKey(sha, showAll) not in self.commitCache]
+		if self.commitProcess is None and self.loadCommitTimer == 0:
+			self.prefetchNext()
+
+	def prefetchNext(self):
+		if self.prefetchProcess is not None or len(self.prefetchQueue) == 0:
+			return
+		sha = self.prefetchQueue.pop(0)
+		showAll = self.dirPath is None
+
+		def onSpans(result):
+			commitStdout, spans = result
+			self.commitCache.put(self.getCommitKey(sha, showAll), commitStdout, spans)
+
+		def onDone(commitStdout, error):
+			self.prefetchProcess = None
+			if error is None: # Large commits load lazily once selected, failed ones are tried again
+				runInThread(self.computeCommit, (commitStdout,), onSpans)
+			self.prefetchNext()
+
+		self.prefetchProcess = self.requestCommit(sha, showAll, onDone)
+
+	def cancelPrefetch(self):
+		if self.prefetchProcess is not None:
+			self.prefetchProcess.cancel()
+			self.prefetchProcess = None
 
 	def showAll(self):
 		self.selectSha(self.currentSha, showAll=True)
 
 	def formatLine(self, buf, text, startIter, endIter, y):
-		searchOffset = startIter.get_offset()
-		# print('formatLine', searchOffset, text)
+		if len(self.sectionSpans) == 0:
+			return
+		section = self.getSectionAt(y)
+		spans = self.sectionSpans[section].getLine(y - self.sectionStarts[section])
+		if len(spans) == 0:
+			return
+		tagTable = buf.get_tag_table()
+		for tagName, start, end in spans:
+			spanStart = startIter.copy()
+			spanStart.set_line_offset(start)
+			spanEnd = startIter.copy()
+			spanEnd.set_line_offset(end)
+			buf.apply_tag(tagTable.lookup(tagName), spanStart, spanEnd)
+
+	def computeCommit(self, allText):
+		# Runs in a worker thread
+		return (allText, self.computeViewSpans(allText))
+
+	def computeViewSpans(self, allText):
+		# Returns the LineSpans of the commit header, diffstat, diff headers and diff lines.
+		tokenizer = DiffTokenizer()
+		tokenizer.feed(allText.split('\n'))
+		return tokenizer.lineSpans
+
+
+def parseDiffPath(text, prefix):
+	# The path of a ---/+++ line, None for /dev/null
+	path = unquotePath(text.rstrip('\t')) # A tab follows paths with spaces
+	if path == '/dev/null':
+		return None
+	return path[len(prefix):] if path.startswith(prefix) else path
+
+
+class BlameView(MonospaceView):
+	# The lines of a Blame behind a gutter with the commit that last
+	# changed each one. The gutter fills in while git blame runs, moving
+	# the cursor into it calls onCommitActivated(sha).
+	gutterWidth = 36
+
+	def __init__(self):
+		MonospaceView.__init__(self)
+		if isGtk3:
+			self.override_font(Pango.font_description_from_string('Monospace 13'))
+		self.blame = None
+		self.pendingLine = None # Scrolled to once the text of the file arrives
+		self.settingText = False
+		self.onCommitActivated = None
+		self.onBlameChanged = None
+		self.get_buffer().connect('notify::cursor-position', self.onCursorMoved)
+
+	def initTags(self):
+		if self.tagsReady:
+			return
+		buf = self.get_buffer()
+		self.tag_blamegutter = buf.create_tag("blamegutter", foreground="#a6acb9") # Light Gray
+		MonospaceView.initTags(self)
+
+	def formatGutter(self, commit):
+		if commit is None:
+			return ' ' * (self.gutterWidth - 2) + '│ '
+		sha = '^' + commit.sha[:7] if commit.boundary else commit.sha[:8]
+		date = time.strftime('%Y-%m-%d', time.localtime(commit.authorTime))
+		return '{:8} {:13.13} {:10} │ '.format(sha, commit.author, date)
+
+	def setBlame(self, blame, line=0):
+		self.clearBlame()
+		self.blame = blame
+		self.pendingLine = line if blame.lines is None else None
+		blame.listeners.append(self.onBlameRows)
+		self.setBlameText(line)
+
+	def clearBlame(self):
+		if self.blame is not None:
+			self.blame.listeners.remove(self.onBlameRows)
+			self.blame = None
+
+	def getCursorLine(self):
+		buf = self.get_buffer()
+		return buf.get_iter_at_mark(buf.get_insert()).get_line()
 
-		if len(startIter.get_tags()) >= 1:
-			return # formatView already handled this line
+	def setBlameText(self, line):
+		blame = self.blame
+		lines = blame.lines or []
+		text = '\n'.join([self.formatGutter(commit) + lineText for commit, lineText in zip(blame.lineCommits, lines)])
+		buf = self.get_buffer()
+		self.settingText = True
+		with tracer.span('set_text', 'view', chars=len(text)):
+			buf.set_text(text)
+		self.timeit('set_text')
+		self.initTags()
+		if len(lines) > 0:
+			lineIter = GtkTextBuffer_get_iter_at_line_offset(buf, min(line, len(lines) - 1), self.gutterWidth) # PyGTK GTK4 Workaround
+		else:
+			lineIter = buf.get_start_iter()
+		buf.place_cursor(lineIter)
+		self.settingText = False
+		self.resetFormatted()
+		self.formatVisible()
+		self.initScroll()
+		self.scroll_to_iter(
+			lineIter,
+			within_margin=0.0,
+			use_align=True,
+			xalign=0.0, # Left Align
+			yalign=0.3,
+		)
+		self.timeit('formatVisible')
 
-		for match in OLDLINE_PATTERN.finditer(text):
-			applyTagForGroup(buf, match, 0, self.tag_oldline, searchOffset=searchOffset)
-		for match in NEWLINE_PATTERN.finditer(text):
-			applyTagForGroup(buf, match, 0, self.tag_newline, searchOffset=searchOffset)
-		for match in HUNKHEADER_PATTERN.finditer(text):
-			applyTagForGroup(buf, match, 0, self.tag_hunkheader, searchOffset=searchOffset)
+	def onBlameRows(self, rows):
+		if rows is None:
+			line = self.pendingLine if self.pendingLine is not None else self.getCursorLine()
+			self.pendingLine = None
+			self.setBlameText(line)
+		else:
+			self.updateGutters(*rows)
+		if self.onBlameChanged is not None:
+			self.onBlameChanged(self.blame)
 
-	def formatView(self):
+	def updateGutters(self, first, last):
+		# Only the gutters are replaced, the view keeps its scroll position
 		buf = self.get_buffer()
-		allText = self.getAllText()
+		lineCommits = self.blame.lineCommits
+		self.settingText = True
+		for y in range(first, last):
+			startIter = GtkTextBuffer_get_iter_at_line(buf, y) # PyGTK GTK4 Workaround
+			endIter = startIter.copy()
+			endIter.set_line_offset(self.gutterWidth)
+			buf.delete(startIter, endIter)
+			buf.insert(startIter, self.formatGutter(lineCommits[y]))
+			gutterStart = startIter.copy()
+			gutterStart.set_line_offset(0)
+			buf.apply_tag(self.tag_blamegutter, gutterStart, startIter)
+		self.settingText = False
+
+	def formatLine(self, buf, text, startIter, endIter, y):
+		if len(text) < self.gutterWidth:
+			return
+		gutterEnd = startIter.copy()
+		gutterEnd.set_line_offset(self.gutterWidth)
+		buf.apply_tag(self.tag_blamegutter, startIter, gutterEnd)
+
+	def onCursorMoved(self, buf, data=None):
+		if self.settingText or self.blame is None or self.onCommitActivated is None:
+			return
+		cursorIter = buf.get_iter_at_mark(buf.get_insert())
+		line = cursorIter.get_line()
+		if cursorIter.get_line_offset() >= self.gutterWidth or line >= len(self.blame.lineCommits):
+			return
+		commit = self.blame.lineCommits[line]
+		if commit is not None:
+			self.onCommitActivated(commit.sha)
+
+
+class BlamePanel(VBox):
+	# A BlameView below the file and revision it blames
+	def __init__(self):
+		VBox.__init__(self)
+		self.label = Gtk.Label()
+		self.label.set_xalign(0.0)
+		self.label.set_ellipsize(Pango.EllipsizeMode.START)
+		self.parentButton = Gtk.Button.new_with_label("Blame Parent")
+		self.closeButton = GtkButton.new_from_icon_name('window-close')
 
-		for match in COMMITHEADER_PATTERN.finditer(allText):
-			applyTagForGroup(buf, match, 1, self.tag_hunkheader)
-			applyTagForGroup(buf, match, 5, self.tag_hunkheader)
-			applyTagForGroup(buf, match, 6, self.tag_commitstat)
+		self.headerRow = HBox()
+		self.headerRow.pack_start(self.label, expand=True, fill=True, padding=0)
+		self.headerRow.pack_start(self.parentButton, expand=False, fill=True, padding=0)
+		self.headerRow.pack_start(self.closeButton, expand=False, fill=True, padding=0)
 
-			for statFileMatch in STATFILE_PATTERN.finditer(allText, match.start(6), match.end(6)):
-				applyTagForGroup(buf, statFileMatch, 1, self.tag_statfilename)
-				applyTagForGroup(buf, statFileMatch, 3, self.tag_newline)
-				applyTagForGroup(buf, statFileMatch, 4, self.tag_oldline)
+		self.blameView = BlameView()
+		self.blameView.onBlameChanged = self.updateLabel
 
-		for match in DIFF_PATTERN.finditer(allText):
-			applyTagForGroup(buf, match, 1, self.tag_diffheader)
+		self.scrolledWindow = ScrolledWindow()
+		self.scrolledWindow.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+		self.scrolledWindow.add(self.blameView)
+
+		self.pack_start(self.headerRow, expand=False, fill=True, padding=0)
+		self.pack_start(self.scrolledWindow, expand=True, fill=True, padding=0)
+
+	def setBlame(self, blame, line=0):
+		self.blameView.setBlame(blame, line)
+		self.updateLabel(blame)
+
+	def updateLabel(self, blame):
+		text = '{} at {}'.format(blame.path, blame.rev[:8])
+		if blame.error is not None:
+			text += ': ' + blame.error
+		elif not blame.done and blame.lines is not None:
+			text += ' ({}/{} lines)'.format(min(blame.blamedCount, len(blame.lines)), len(blame.lines))
+		self.label.set_text(text)
 
 
 class TextSearchBar(SearchBar):
@@ -635,33 +6110,206 @@ class TextSearchBar(SearchBar):
 		self.set_show_close_button(True)
 
 		self.entry = Gtk.SearchEntry()
+		self.entry.set_hexpand(True)
 		if isGtk3:
 			self.entry.set_placeholder_text('Search (Ctrl+F)')
-		self.entry.connect('activate', self.onSearchChanged)
+		self.entry.connect('search-changed', self.onSearchChanged)
+		self.entry.connect('activate', self.onSearchActivate)
+		self.entry.connect('next-match', self.onNextMatch)
+		self.entry.connect('previous-match', self.onPreviousMatch)
 		self.entry.connect('stop-search', self.onStopSearch)
 		self.connect_entry(self.entry)
-		self.add(self.entry)
+
+		self.regexButton = Gtk.ToggleButton(label='.*')
+		self.regexButton.set_tooltip_text('Regular Expression')
+		self.regexButton.connect('toggled', self.onRegexToggled)
+
+		self.matchLabel = Gtk.Label()
+		self.matchLabel.set_width_chars(12)
+
+		self.previousButton = GtkButton.new_from_icon_name('go-up-symbolic')
+		self.previousButton.set_tooltip_text('Previous Match (Shift+Ctrl+G)')
+		self.previousButton.connect('clicked', self.onPreviousMatch)
+		self.nextButton = GtkButton.new_from_icon_name('go-down-symbolic')
+		self.nextButton.set_tooltip_text('Next Match (Ctrl+G)')
+		self.nextButton.connect('clicked', self.onNextMatch)
+
+		self.box = HBox(spacing=4)
+		self.box.pack_start(self.entry, expand=True, fill=True, padding=0)
+		self.box.pack_start(self.regexButton, expand=False, fill=True, padding=0)
+		self.box.pack_start(self.matchLabel, expand=False, fill=True, padding=0)
+		self.box.pack_start(self.previousButton, expand=False, fill=True, padding=0)
+		self.box.pack_start(self.nextButton, expand=False, fill=True, padding=0)
+		self.add(self.box)
 
 		self.textView = None
 
 	def setTextView(self, textView):
 		self.textView = textView
+		self.textView.onSearchUpdated = self.onSearchUpdated
 
-	def onSearchChanged(self, buffer, data=None):
+	def checkTextView(self):
 		if not self.textView:
 			raise Exception("TextSearchBar.textView not set")
 		if not self.textView.tagsReady:
 			raise Exception("TextSearchBar.tagsReady=False. Call initTags().")
 
+	def onSearchChanged(self, entry, data=None):
+		self.checkTextView()
 		newSearch = self.entry.get_text()
 		self.textView.debouncedApplySearch(newSearch)
 
+	def onSearchActivate(self, entry, data=None):
+		self.checkTextView()
+		newSearch = self.entry.get_text()
+		if newSearch != self.textView.currentSearch or self.textView.applySearchTimer != 0:
+			self.textView.applySearch(newSearch)
+		else:
+			self.textView.findNext()
+
+	def onNextMatch(self, widget, data=None):
+		self.checkTextView()
+		self.textView.findNext()
+
+	def onPreviousMatch(self, widget, data=None):
+		self.checkTextView()
+		self.textView.findPrevious()
+
+	def onRegexToggled(self, button):
+		self.checkTextView()
+		self.textView.setSearchRegex(button.get_active())
+
+	def onSearchUpdated(self, label):
+		self.matchLabel.set_text(label)
+
 	def onStopSearch(self, entry, user_data=None):
 		print('onStopSearch')
 		self.textView.grab_focus()
-		self.textView.clearAllMatches()
+		self.textView.applySearch('')
 
-class HistoryFilterComboBox(Gtk.ComboBoxText):
+class PathIndex:
+	# The files of the repository and their folders for the file filter.
+	# Paths are kept in one '\0' separated string instead of a string per
+	# path and matched with a regex over it. Folders end in '/'.
+	scanMatches = 1000 # Matches a scan collects before it stops and ranks them
+
+	def __init__(self):
+		self.chunks = []
+		self.text = None
+		self.lowerText = None
+		self.dirs = set()
+		self.count = 0
+		self.narrowed = None # (query, text, lowerText) of every path matching query
+
+	def append(self, paths):
+		# Paths come sorted from git ls-files, so the folders of a path
+		# were mostly added by the path before it.
+		if self.text is not None:
+			self.chunks = [self.text[1:-1]]
+			self.text = None
+			self.lowerText = None
+		dirs = self.dirs
+		newDirs = []
+		for path in paths:
+			end = path.rfind('/')
+			while end != -1:
+				dirPath = path[:end + 1]
+				if dirPath in dirs:
+					break
+				dirs.add(dirPath)
+				newDirs.append(dirPath)
+				end = path.rfind('/', 0, end)
+		self.chunks.append('\0'.join(paths))
+		self.chunks.append('\0'.join(newDirs))
+		self.count += len(paths) + len(newDirs)
+		self.narrowed = None
+
+	def getText(self):
+		if self.text is None:
+			self.text, self.lowerText = self.joinPaths(chunk for chunk in self.chunks if chunk)
+			self.chunks = []
+		return self.text, self.lowerText
+
+	def getTopLevel(self):
+		# The files and folders directly in cwd
+		text, lowerText = self.getText()
+		return sorted(re.findall('(?<=\0)[^\0/]+/?(?=\0)', text))
+
+	def joinPaths(self, paths):
+		text = '\0' + '\0'.join(paths) + '\0'
+		# Matching a lowercase copy is faster than re.IGNORECASE,
+		# lower() only keeps the offsets the same for ASCII text.
+		lowerText = text.lower() if text.isascii() else None
+		return text, lowerText
+
+	def scan(self, pattern, text, lowerText, ignoreCase, maxMatches):
+		# Returns the paths with a match of pattern and whether all of them
+		# were found. Patterns start with a character of the query so re
+		# can skip ahead to it instead of trying every offset.
+		searchText = text
+		flags = 0
+		if ignoreCase:
+			if lowerText is not None:
+				searchText = lowerText
+			else:
+				flags = re.IGNORECASE
+		search = re.compile(pattern, flags).search
+		paths = []
+		pos = 0
+		while len(paths) < maxMatches:
+			match = search(searchText, pos)
+			if match is None:
+				return paths, True
+			start = text.rfind('\0', 0, match.start()) + 1
+			pos = text.find('\0', match.end())
+			paths.append(text[start:pos])
+		return paths, False
+
+	def search(self, query, limit):
+		# Up to limit paths matching query, best first: query in the file
+		# name, then anywhere in the path, then its characters in order.
+		# Shorter paths rank first within each group.
+		if query == '':
+			return []
+		ignoreCase = query == query.lower() # Smart case
+		text, lowerText = self.getText()
+		if self.narrowed is not None and query.startswith(self.narrowed[0]):
+			# Paths matching query also matched the shorter query
+			text, lowerText = self.narrowed[1:]
+
+		# Each character matches its first occurrence after the previous
+		# one, so a path that does not match fails without backtracking.
+		chars = [re.escape(c) for c in query]
+		fuzzy = chars[0] + ''.join('[^\\0{0}]*{0}'.format(c) for c in chars[1:])
+		fuzzyMatches, complete = self.scan(fuzzy, text, lowerText, ignoreCase, self.scanMatches)
+		if complete:
+			text, lowerText = self.joinPaths(fuzzyMatches)
+			self.narrowed = (query, text, lowerText)
+
+		literal = ''.join(chars)
+		results = []
+		found = set()
+		for pattern in (
+			literal + '(?=[^\0/]*/?\0)', # In the last name of the path
+			literal,
+			None,
+		):
+			if pattern is None:
+				paths = fuzzyMatches
+			else:
+				paths, complete = self.scan(pattern, text, lowerText, ignoreCase, self.scanMatches)
+			for path in heapq.nsmallest(limit, paths, key=len):
+				if path not in found:
+					found.add(path)
+					results.append(path)
+					if len(results) >= limit:
+						return results
+		return results
+
+
+class HistoryFilterComboBox(Gtk.ComboBoxText, StepTimer):
+	# A few rows to pick from. Anything else is completed from
+	# getCompletions() while typing and applied with Enter or a completion.
 	def __init__(self):
 		super().__init__(has_entry=True)
 		self.dirPath = None
@@ -675,15 +6323,15 @@ class HistoryFilterComboBox(Gtk.ComboBoxText):
 
 		self.connect('changed', self.onChange)
 
-	def timeit(self, label=None, *args):
-		if label:
-			t2 = time.time()
-			d = t2 - self.t
-			log("{} {}: {:.4f}s".format(self.__class__.__name__, label, d), *args)
-			self.t = t2
-		else:
-			self.t = time.time()
-			log()
+		self.completionStore = Gtk.ListStore(str)
+		completion = Gtk.EntryCompletion(model=self.completionStore)
+		completion.set_text_column(0)
+		completion.set_match_func(lambda *args: True) # Matched by getCompletions()
+		completion.connect('match-selected', self.onMatchSelected)
+		entry = self.get_child()
+		entry.set_completion(completion)
+		entry.connect('changed', self.onEntryChanged)
+		entry.connect('activate', self.onEntryActivate)
 
 	def setDirPath(self, dirPath):
 		self.dirPath = dirPath
@@ -696,12 +6344,16 @@ class HistoryFilterComboBox(Gtk.ComboBoxText):
 	def onChange(self, comboBox):
 		if self.ignoreChange:
 			return
+		if self.get_active_id() is None:
+			return # Typed text is applied with Enter or a completion
 		self.resetApplyChangeTimer()
 		self.applyChangeTimer = GLib.timeout_add(400, self.applyChange)
 
 	def applyChange(self):
 		if self.applyChangeCallback is not None:
 			value = self.get_active_id()
+			if value is None:
+				value = self.get_child().get_text().strip()
 			self.applyChangeCallback(value)
 
 	def setInitActiveId(self, active_id):
@@ -709,60 +6361,147 @@ class HistoryFilterComboBox(Gtk.ComboBoxText):
 		self.set_active_id(active_id)
 		self.ignoreChange = False
 
-	def populate(self):
-		raise NotImplemented()
+	def populate(self, activeId):
+		raise NotImplementedError()
+
+	#--- Completion
+	def getCompletions(self, text):
+		raise NotImplementedError()
+
+	def onEntryChanged(self, entry):
+		if self.ignoreChange or self.get_active_id() is not None:
+			return # The text of a row
+		self.updateCompletion()
+
+	def updateCompletion(self):
+		self.completionStore.clear()
+		if self.get_active_id() is not None:
+			return
+		for value in self.getCompletions(self.get_child().get_text()):
+			self.completionStore.append([value])
+
+	def onMatchSelected(self, completion, model, treeIter):
+		entry = self.get_child()
+		entry.set_text(model[treeIter][0])
+		entry.set_position(-1)
+		self.onEntryActivate(entry)
+		return True
+
+	def onEntryActivate(self, entry):
+		self.resetApplyChangeTimer()
+		self.applyChange()
 
 class HistoryBranchFilterComboBox(HistoryFilterComboBox):
-	def populate(self):
-		self.timeit()
-		cmd = [
-			'git',
-			'-C',
-			cwdAbs,
-			'branch',
-			'--list',
-			'--all',
-			'--sort=-committerdate',
-		]
-		self.lsBranchProcess = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-		lsBranchStdout = self.lsBranchProcess.stdout
-		# print(lsBranchStdout)
-		self.timeit('process')
+	# Rows for HEAD, --all and the most recent branches. Any branch
+	# is completed from the RefIndex of the history.
+	def __init__(self):
+		super().__init__()
+		self.refIndex = None
+		self.initActiveId = None
 
+	def populate(self, activeId):
 		self.append('HEAD', 'Current Branch (HEAD)')
 		self.append('--all', 'All Branches (--all)')
-		for line in lsBranchStdout.splitlines():
-			line = line.strip()
-			if line.startswith('* '): # selected
-				line = line[2:]
-			self.append(line, line)
-		self.timeit('append_text')
+		self.setInitActiveId(activeId)
+		self.initActiveId = activeId
+
+	def setRefIndex(self, refIndex):
+		isFirst = self.refIndex is None
+		self.refIndex = refIndex
+		if isFirst:
+			for name in refIndex.getBranchNames()[:GitzConfig.filterCompletions]:
+				self.append(name, name)
+			if self.get_active_id() is None and self.get_child().get_text() == '':
+				self.setInitActiveId(self.initActiveId)
+		self.updateCompletion()
+
+	def getCompletions(self, text):
+		if self.refIndex is None or text == '':
+			return []
+		return self.refIndex.searchBranches(text, GitzConfig.filterCompletions)
 
 class HistoryFileFilterComboBox(HistoryFilterComboBox):
-	def populate(self):
+	# Rows for All Files and the top level of cwd. Any file or folder
+	# is completed from a PathIndex.
+	def __init__(self, session):
+		super().__init__()
+		self.session = session
+		self.pathIndex = PathIndex()
+		self.lsFilesProcess = None
+		self.connect('notify::popup-shown', self.onPopupShown)
+
+	def populate(self, activeId):
+		# Listing every file waits until the filter is first used
+		self.append('', 'All Files')
+		self.setInitActiveId(activeId)
+
+	def loadPathIndex(self):
+		if self.lsFilesProcess is not None:
+			return
+		if GitzConfig.pathCommitIndex and GitzConfig.nativeGraph:
+			self.session.pathCommitIndex.load() # Ready by the time a file is picked
 		self.timeit()
-		cmd = [
-			'git',
-			'-C',
-			cwdAbs,
-			'ls-files',
-		]
-		self.lsFilesProcess = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-		lsFilesStdout = self.lsFilesProcess.stdout
-		# print(lsFilesStdout)
-		self.timeit('process')
+		def onPaths(paths):
+			self.pathIndex.append(paths)
+		def onDone():
+			self.timeit('process', self.pathIndex.count)
+			for path in self.pathIndex.getTopLevel():
+				self.append(path, path)
+			self.updateCompletion()
+			self.timeit('append_text')
+		self.lsFilesProcess = self.session.backend.listFiles(onPaths, onDone)
+
+	def onPopupShown(self, comboBox, pspec):
+		if self.get_property('popup-shown'):
+			self.loadPathIndex()
+
+	def getCompletions(self, text):
+		self.loadPathIndex()
+		return self.pathIndex.search(text, GitzConfig.filterCompletions)
+
+
+class NoticeBar(HBox):
+	# A message above the history, with a button when it offers an action
+	def __init__(self, actionLabel):
+		HBox.__init__(self)
+		self.label = Gtk.Label()
+		self.label.set_xalign(0.0)
+		if isGtk3:
+			self.label.set_line_wrap(True)
+		elif isGtk4:
+			self.label.set_wrap(True)
+		self.actionButton = Gtk.Button.new_with_label(actionLabel)
+		self.closeButton = GtkButton.new_from_icon_name('window-close')
+		self.closeButton.connect('clicked', self.onCloseClicked)
+		self.pack_start(self.label, expand=True, fill=True, padding=0)
+		self.pack_start(self.actionButton, expand=False, fill=True, padding=0)
+		self.pack_start(self.closeButton, expand=False, fill=True, padding=0)
+		if isGtk3:
+			# Hidden until there is a notice, even when the window is shown
+			self.label.show()
+			self.closeButton.show()
+			self.set_no_show_all(True)
+		self.set_visible(False)
+
+	def setNotice(self, notice):
+		if notice is None:
+			self.set_visible(False)
+			return
+		text, canAct = notice
+		self.label.set_text(text)
+		self.actionButton.set_visible(canAct)
+		self.set_visible(True)
 
-		self.append('', 'All Files')
-		for line in lsFilesStdout.splitlines():
-			# self.append([line, line])
-			self.append(line, line)
-		self.timeit('append_text')
+	def onCloseClicked(self, button):
+		self.set_visible(False)
 
 
 class MainWindow(ApplicationWindow):
-	def __init__(self, app):
+	def __init__(self, app, session):
 		Gtk.Window.__init__(self, title="gitz", application=app)
-		self.set_title("gitz - {}".format(cwdAbs))
+		self.session = session
+		self.session.windowCount += 1
+		self.set_title("gitz - {}".format(session.cwdAbs))
 		self.set_icon_name("git-gui")
 		self.set_default_size(1800, 720)
 		if isGtk3:
@@ -774,9 +6513,13 @@ class MainWindow(ApplicationWindow):
 		settings.set_property("gtk-application-prefer-dark-theme", True)
 
 		#--- Left
-		self.historyView = HistoryView()
-		historyTextBuffer = self.historyView.get_buffer()
-		historyTextBuffer.connect('notify::cursor-position', self.onHistoryViewMoveCursor)
+		if GitzConfig.historyWidget == 'list':
+			self.historyView = HistoryListView(session)
+			self.historyView.onShaSelected = self.onHistoryShaSelected
+		else:
+			self.historyView = HistoryView(session)
+			historyTextBuffer = self.historyView.get_buffer()
+			historyTextBuffer.connect('notify::cursor-position', self.onHistoryViewMoveCursor)
 
 		self.historySearchBar = TextSearchBar()
 		self.historySearchBar.setTextView(self.historyView)
@@ -789,24 +6532,35 @@ class MainWindow(ApplicationWindow):
 		# self.branchFilterIcon.set_icon_size(Gtk.IconSize.LARGE)
 		self.branchFilterComboBox = HistoryBranchFilterComboBox()
 		self.branchFilterComboBox.applyChangeCallback = self.historyView.setBranchFilter
+		self.historyView.onRefsLoaded = self.branchFilterComboBox.setRefIndex
 		self.fileFilterIcon = GtkIcon.new_from_icon_name('text-plain')
 		# self.fileFilterIcon.set_icon_size(Gtk.IconSize.LARGE)
-		self.fileFilterComboBox = HistoryFileFilterComboBox()
-		self.fileFilterComboBox.applyChangeCallback = self.historyView.setFileFilter
+		self.fileFilterComboBox = HistoryFileFilterComboBox(session)
+		self.fileFilterComboBox.applyChangeCallback = self.onFileFilterApplied
+		self.blameFilterButton = Gtk.Button.new_with_label("Blame")
+		self.blameFilterButton.set_sensitive(False)
+		self.blameFilterButton.connect('clicked', self.onBlameFilterClicked)
 
 		self.filterRow = HBox()
 		self.filterRow.pack_start(self.branchFilterIcon, expand=False, fill=True, padding=0)
 		self.filterRow.pack_start(self.branchFilterComboBox, expand=True, fill=True, padding=0)
 		self.filterRow.pack_start(self.fileFilterIcon, expand=False, fill=True, padding=0)
 		self.filterRow.pack_start(self.fileFilterComboBox, expand=True, fill=True, padding=0)
+		self.filterRow.pack_start(self.blameFilterButton, expand=False, fill=True, padding=0)
+
+		self.commitGraphNotice = NoticeBar("Write commit-graph")
+		self.commitGraphNotice.actionButton.connect('clicked', self.onWriteCommitGraphClicked)
+		self.commitGraphNotice.setNotice(session.commitGraphSetup.notice)
+		session.commitGraphSetup.listeners.append(self.commitGraphNotice.setNotice)
 
 		self.leftPaneBox = VBox()
 		self.leftPaneBox.pack_start(self.filterRow, expand=False, fill=True, padding=0)
+		self.leftPaneBox.pack_start(self.commitGraphNotice, expand=False, fill=True, padding=0)
 		self.leftPaneBox.pack_start(self.historySearchBar, expand=False, fill=True, padding=0)
 		self.leftPaneBox.pack_start(self.leftPane, expand=True, fill=True, padding=0)
 
 		#--- Right
-		self.commitView = CommitView()
+		self.commitView = CommitView(session)
 
 		self.commitSearchBar = TextSearchBar()
 		self.commitSearchBar.setTextView(self.commitView)
@@ -817,16 +6571,28 @@ class MainWindow(ApplicationWindow):
 
 		self.showAllButton = Gtk.Button.new_with_label("Show Full Commit")
 		self.showAllButton.connect('clicked', self.onCommitViewShowAll)
+		self.blameFileButton = Gtk.Button.new_with_label("Blame File")
+		self.blameFileButton.connect('clicked', self.onBlameFileClicked)
+
+		self.buttonRow = HBox()
+		self.buttonRow.pack_start(self.showAllButton, expand=True, fill=True, padding=0)
+		self.buttonRow.pack_start(self.blameFileButton, expand=False, fill=True, padding=0)
 
 		self.rightPaneBox = VBox()
 		self.rightPaneBox.pack_start(self.commitSearchBar, expand=False, fill=True, padding=0)
 		self.rightPaneBox.pack_start(self.rightPane, expand=True, fill=True, padding=0)
-		self.rightPaneBox.pack_start(self.showAllButton, expand=False, fill=True, padding=0)
+		self.rightPaneBox.pack_start(self.buttonRow, expand=False, fill=True, padding=0)
+
+		# The BlamePanel is added below the commit once a file is blamed
+		self.blamePanel = None
+		self.blameId = 0
+		self.rightPaned = VPaned()
+		self.rightPaned.add1(self.rightPaneBox)
 
 		#---
 		self.pane = HPaned()
 		self.pane.add1(self.leftPaneBox)
-		self.pane.add2(self.rightPaneBox)
+		self.pane.add2(self.rightPaned)
 		self.pane.set_position(600)
 		self.add(self.pane)
 
@@ -837,6 +6603,7 @@ class MainWindow(ApplicationWindow):
 			self.keyController = Gtk.EventControllerKey()
 			self.keyController.connect('key-pressed', self.onKeyPressGtk4, self)
 			self.add_controller(self.keyController)
+		self.connect('destroy', self.onDestroy)
 
 		#---
 		self.historyView.grab_focus()
@@ -848,6 +6615,17 @@ class MainWindow(ApplicationWindow):
 		self.commitView.setDirPath(dirPath)
 		self.set_title("gitz - {}".format(dirPath))
 
+	def onDestroy(self, window):
+		# The session outlives the window in a resident App
+		self.session.unwatchRefs(self.historyView.refresh)
+		self.session.commitGraphSetup.listeners.remove(self.commitGraphNotice.setNotice)
+		self.session.windowCount -= 1
+		self.historyView.cancelPopulate()
+		self.commitView.cancelLoadCommit()
+		self.commitView.cancelPrefetch()
+		if self.blamePanel is not None:
+			self.blamePanel.blameView.clearBlame()
+
 	# https://docs.gtk.org/gtk3/signal.Widget.key-press-event.html
 	# https://docs.gtk.org/gdk3/struct.EventKey.html
 	def onKeyPressGtk3(self, widget, event, *args):
@@ -866,6 +6644,11 @@ class MainWindow(ApplicationWindow):
 			self.close()
 		elif ctrl and keyval == 119: # Ctrl+W
 			self.close()
+		elif ctrl and keyval == 98: # Ctrl+B
+			if self.get_focus() == self.commitView:
+				self.blameCommitFile()
+			else:
+				self.blameFileFilter()
 		elif ctrl and keyval == 102: # Ctrl+F
 			if self.get_focus() == self.historyView:
 				self.historySearchBar.set_search_mode(True)
@@ -887,6 +6670,13 @@ class MainWindow(ApplicationWindow):
 		value = comboBox.get_active_text()
 		self.historyView.setFileFilter(value)
 
+	def onFileFilterApplied(self, value):
+		self.historyView.setFileFilter(value)
+		self.blameFilterButton.set_sensitive(not (value is None or value == ''))
+
+	def onWriteCommitGraphClicked(self, button):
+		self.session.commitGraphSetup.write()
+
 	def onCommitViewShowAll(self, button):
 		self.commitView.showAll()
 		self.showAllButton.set_visible(False)
@@ -894,46 +6684,117 @@ class MainWindow(ApplicationWindow):
 	def onHistoryViewMoveCursor(self, buffer, data=None):
 		if not self.historyView.tagsReady:
 			return # Not yet ready
+		if self.historyView.appendingChunk:
+			return # Streaming more history, the cursor is restored right after
+
+		row = self.historyView.getSelectedRow()
+		sha = self.historyView.historyStore.getSha(row) if row != -1 else None
+		if sha:
+			self.historyView.highlightSelectedRow(row)
+			self.onHistoryShaSelected(sha)
+
+	#--- Blame
+	def onBlameFilterClicked(self, button):
+		self.blameFileFilter()
+
+	def onBlameFileClicked(self, button):
+		self.blameCommitFile()
+
+	def blameFileFilter(self):
+		# The file of the file filter, at the selected commit
+		fileFilter = self.historyView.fileFilter
+		if fileFilter is None or fileFilter == '':
+			return
+		rev = self.commitView.currentSha or 'HEAD'
+		def onTopLevel():
+			path = self.session.toRepoPath(fileFilter) if self.session.topLevel is not None else None
+			if path:
+				self.openBlame(path, rev)
+		self.session.loadTopLevel(onTopLevel)
+
+	def blameCommitFile(self):
+		# The file of the diff at the cursor, at the shown commit. A file
+		# the commit deleted is blamed before it.
+		target = self.commitView.getFileAtCursor()
+		if target is None or self.commitView.currentSha == '':
+			return
+		path, deleted, line = target
+		sha = self.commitView.currentSha
+		isRelative = self.commitView.getRelativeDir(self.commitView.showingAll) is not None
+		def onTopLevel():
+			if self.session.topLevel is None:
+				return
+			# The diff shows paths relative to cwd with --relative
+			repoPath = self.session.toRepoPath(path) if isRelative else path
+			if repoPath:
+				self.openBlame(repoPath, sha + '^' if deleted else sha, line)
+		self.session.loadTopLevel(onTopLevel)
+
+	def openBlame(self, path, rev, line=0):
+		# path is relative to the top of the repository
+		self.showBlamePanel()
+		self.blameId += 1
+		blameId = self.blameId
+		def onBlame(blame):
+			if blameId == self.blameId:
+				self.blamePanel.setBlame(blame, line)
+		self.session.blameCache.load(path, rev, onBlame)
+
+	def showBlamePanel(self):
+		if self.blamePanel is None:
+			self.blamePanel = BlamePanel()
+			self.blamePanel.blameView.onCommitActivated = self.historyView.jumpToSha
+			self.blamePanel.parentButton.connect('clicked', self.onBlameParentClicked)
+			self.blamePanel.closeButton.connect('clicked', self.onBlameCloseClicked)
+			self.rightPaned.add2(self.blamePanel)
+			self.rightPaned.set_position(self.rightPaneBox.get_allocated_height() // 2)
+			if isGtk3:
+				self.blamePanel.show_all()
+		else:
+			self.blamePanel.set_visible(True)
 
-		line = self.historyView.getLineAt(buffer.props.cursor_position)
-		match = LOG_PATTERN.match(line)
-		if match:
-			sha = match.group(3)
-			if sha:
-				historyBuf = self.historyView.get_buffer()
-
-				historyBuf.remove_tag(self.historyView.tag_selected, historyBuf.get_start_iter(), historyBuf.get_end_iter())
-
-				cursorIter = historyBuf.get_iter_at_offset(buffer.props.cursor_position)
-				lineNumber = cursorIter.get_line()
-
-				def highlightGroup(group):
-					start = match.start(group)
-					end = match.end(group)
-					# startIter = historyBuf.get_iter_at_line_offset(lineNumber, start)
-					# endIter = historyBuf.get_iter_at_line_offset(lineNumber, end)
-					startIter = GtkTextBuffer_get_iter_at_line_offset(historyBuf, lineNumber, start) # PyGTK GTK4 Workaround
-					endIter = GtkTextBuffer_get_iter_at_line_offset(historyBuf, lineNumber, end) # PyGTK GTK4 Workaround
-					historyBuf.apply_tag(self.historyView.tag_selected, startIter, endIter)
-				highlightGroup(3)
-
+	def onBlameParentClicked(self, button):
+		blame = self.blamePanel.blameView.blame
+		if blame is None or blame.error is not None:
+			return
+		self.blameId += 1
+		blameId = self.blameId
+		def onBlame(parentBlame, parentLine):
+			if blameId == self.blameId:
+				self.blamePanel.setBlame(parentBlame, parentLine)
+		self.session.blameCache.loadParent(blame, self.blamePanel.blameView.getCursorLine(), onBlame)
+
+	def onBlameCloseClicked(self, button):
+		self.blamePanel.set_visible(False)
+		self.blamePanel.blameView.clearBlame()
+		self.historyView.grab_focus()
 
-				self.commitView.selectSha(sha)
-				self.showAllButton.set_visible(not self.commitView.showingAll)
+	def onHistoryShaSelected(self, sha):
+		self.commitView.selectSha(sha)
+		self.showAllButton.set_visible(not self.commitView.showingAll)
+		self.commitView.prefetch(self.historyView.getNeighborShas(GitzConfig.prefetchCommits))
 
 
 
-class App(Gtk.Application):
-	def __init__(self):
-		Gtk.Application.__init__(self, flags=Gio.ApplicationFlags.HANDLES_OPEN)
+class App(Gtk.Application, StepTimer):
+	def __init__(self, resident=False):
+		# Only a resident App is unique, see forwardLaunch
+		Gtk.Application.__init__(self,
+			application_id=residentAppId if resident else None,
+			flags=Gio.ApplicationFlags.HANDLES_OPEN,
+		)
 		GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, self.quit)
-		self.dirPath = None
+		self.resident = resident
 
 	def do_activate(self):
+		self.openWindow(cwdAbs, None)
+
+	def openWindow(self, repoPath, dirPath):
+		# Windows on the same repoPath share a RepoSession
 		self.timeit()
-		self.win = MainWindow(self)
-		if self.dirPath is not None:
-			self.win.setDirPath(self.dirPath)
+		self.win = MainWindow(self, getRepoSession(repoPath))
+		if dirPath is not None:
+			self.win.setDirPath(dirPath)
 		self.timeit('construct')
 
 		if isGtk3:
@@ -942,42 +6803,43 @@ class App(Gtk.Application):
 			self.win.present()
 		self.timeit('show_all')
 
-		self.win.historyView.populate()
-		self.timeit('historyView.populate')
-
-		self.win.branchFilterComboBox.populate()
-		self.win.branchFilterComboBox.setInitActiveId(self.win.historyView.branchFilter)
+		# The loads run in the background and fill in each widget as
+		# their data arrives, the file list once the filter is opened.
+		# The combo boxes have their first rows before refs arrive.
+		self.win.branchFilterComboBox.populate(self.win.historyView.branchFilter)
 		self.timeit('branchFilterComboBox.populate')
 
-		self.win.fileFilterComboBox.populate()
-		self.win.fileFilterComboBox.setInitActiveId('')
+		self.win.fileFilterComboBox.populate('')
 		self.timeit('fileFilterComboBox.populate')
 
+		self.win.historyView.populate()
+		self.timeit('historyView.populate')
+
+		self.win.session.watchRefs(self.win.historyView.refresh)
+
 	# Note: The docs mention it's (self, files, hints) but in reality it's (self, files, n_files, hints).
 	# The doc text mentions a n_files argument, but it's not mentioned in the argument list.
 	# I used (self, *args) and print(args) to confirm this.
 	# https://lazka.github.io/pgi-docs/Gio-2.0/classes/Application.html#Gio.Application.do_open
+	# The hint is '' for the paths on our own command line. A launch
+	# forwarded to a resident App sends its cwd, and whether the path is
+	# its cwd because none was given.
 	def do_open(self, files, n_files, hints):
 		if n_files >= 1:
-			self.dirPath = files[0].get_path()
-			print('do_open', self.dirPath)
-			self.activate()
+			launch = json.loads(hints) if hints else {}
+			dirPath = files[0].get_path() if launch.get('dirPath', True) else None
+			print('do_open', dirPath)
+			self.openWindow(launch.get('cwd', cwdAbs), dirPath)
 
 	def do_startup(self):
 		Gtk.Application.do_startup(self)
-
-	def timeit(self, label=None, *args):
-		if label:
-			t2 = time.time()
-			d = t2 - self.t
-			log("{} {}: {:.4f}s".format(self.__class__.__name__, label, d), *args)
-			self.t = t2
-		else:
-			self.t = time.time()
-			log()
+		if self.resident:
+			self.hold() # Keep running once the last window is closed
 
 
 
-app = App()
-exit_status = app.run(sys.argv)
-sys.exit(exit_status)
+if __name__ == '__main__':
+	argv = initTracing(sys.argv)
+	app = App(resident=isResidentLaunch(argv))
+	exit_status = app.run([arg for arg in argv if arg != '--resident'])
+	sys.exit(exit_status)